@@ -0,0 +1,286 @@
+"""
+Benchmark ทั้ง pipeline (process_file_in_background) กับ stub ของ circuitStatus SOAP ที่รันในเครื่อง
+ไม่ต้องเรียก API จริง: stub สร้างข้อมูลรายชั่วโมงทั้งเดือนของแต่ละวงจร โดยกำหนดชั่วโมงที่หายไป,
+ที่อยู่ที่เป็น mojibake, เวลาตอบสนอง และอัตรา HTTP 500 ได้
+แต่ละขนาดของไฟล์รายชื่อวงจรรันใน process ใหม่ (cache ว่าง) แล้ววัด แถว/วินาที, p50/p99 ต่อวงจร และหน่วยความจำสูงสุด
+
+latency ต่อวงจร = เวลาตั้งแต่เริ่มดึงข้อมูลของวงจรจนบันทึกผลของแถวนั้น (รวมเวลารอแถวก่อนหน้าตามลำดับเดิม)
+หน่วยความจำสูงสุด (ru_maxrss) มีเฉพาะ Linux/macOS: main = process ของงาน, render = process สร้างไฟล์ที่ใช้มากที่สุด
+
+ผลถูกเทียบกับ baseline ที่บันทึกไว้ (แยกตามขนาดและค่าของ stub) หากช้าลง/ใช้หน่วยความจำมากขึ้นเกิน --tolerance จะ exit 1
+baseline ขึ้นกับเครื่อง ให้บันทึกใหม่ด้วย --save-baseline เมื่อเปลี่ยนเครื่องหรือยอมรับผลใหม่
+
+วิธีใช้:
+    python benchmarks/bench_end_to_end.py --rows 100 1000
+    python benchmarks/bench_end_to_end.py --rows 10000 --latency 0.2 --error-rate 0.01 --gap-rate 0.05 --mojibake-rate 0.3
+    python benchmarks/bench_end_to_end.py --rows 100 1000 --save-baseline
+"""
+import argparse
+import calendar
+import datetime
+import html
+import io
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+import openpyxl
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines", "bench_end_to_end.json")
+ADDRESS = "สำนักงานเขตพื้นที่การศึกษา จังหวัดตัวอย่าง"
+PROVINCES = ["กรุงเทพมหานคร", "เชียงใหม่", "ขอนแก่น", "สงขลา", "ชลบุรี"]
+# ค่าที่มีผลต่อผลลัพธ์ ใช้เป็น key ของ baseline ร่วมกับจำนวนแถว
+SCENARIO_OPTIONS = ("month", "latency", "error_rate", "gap_rate", "mojibake_rate", "fetch_workers", "render_workers")
+
+
+# --- stub ของ circuitStatus ---
+def build_payload(nod_id, month, gap_rate, mojibake):
+    """ข้อมูลรายชั่วโมงทั้งเดือนของวงจรหนึ่งแบบ PHP json_encode (สุ่มแบบคงที่ตาม NodeID)"""
+    rnd = random.Random(nod_id)
+    year, month_number = map(int, month.split("-"))
+    start = datetime.datetime(year, month_number, 1)
+    address = ADDRESS.encode("utf-8").decode("latin-1") if mojibake else ADDRESS
+    bandwidth = rnd.choice(["10 Mbps", "100 Mbps", "1000Mbps", "FTTx 20M"])
+    rows = []
+    for hour in range(calendar.monthrange(year, month_number)[1] * 24):
+        if rnd.random() < gap_rate:
+            continue
+        ts = start + datetime.timedelta(hours=hour)
+        rows.append({
+            "Customer_Curcuit_ID": f"GIN{nod_id}",
+            "Address": address,
+            "Timestamp": {"date": ts.strftime("%Y-%m-%d %H:%M:%S.000000"), "timezone_type": 3, "timezone": "Asia/Bangkok"},
+            "Bandwidth": bandwidth,
+            "In_Averagebps": f"{rnd.random() * 1e8:.4f}",
+            "Out_Averagebps": f"{rnd.random() * 1e8:.4f}",
+        })
+    return json.dumps(rows).replace("/", "\\/")
+
+
+def start_stub_server(options):
+    """เริ่ม stub ใน thread (port ว่างใดก็ได้) คืนค่า URL"""
+    request_random = random.Random(0)
+    random_lock = threading.Lock()
+
+    class CircuitStatusHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers["Content-Length"])).decode("utf-8")
+            nod_id = re.search(r"<nodID>(.*?)</nodID>", body).group(1)
+            with random_lock:
+                delay = options["latency"] * request_random.uniform(0.5, 1.5)
+                failed = request_random.random() < options["error_rate"]
+            time.sleep(delay)
+            if failed:
+                self.send_response(500)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            mojibake = random.Random(f"mojibake/{nod_id}").random() < options["mojibake_rate"]
+            ret = html.escape(build_payload(nod_id, options["month"], options["gap_rate"], mojibake))
+            data = ('<?xml version="1.0" encoding="UTF-8"?>'
+                    '<SOAP-ENV:Envelope xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/">'
+                    '<SOAP-ENV:Body><ns1:circuitStatusResponse xmlns:ns1="http://1.179.233.116/soap/#Service_Solarwinds_gin">'
+                    f'<return xsi:type="xsd:string" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">{ret}</return>'
+                    '</ns1:circuitStatusResponse></SOAP-ENV:Body></SOAP-ENV:Envelope>').encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/xml; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), CircuitStatusHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}/api_csoc_02/server_solarwinds_gin.php"
+
+
+def build_workbook(rows):
+    """ไฟล์ Excel รายชื่อวงจร rows แถว (NodeID ไม่ซ้ำกัน และชื่อไฟล์ใน ZIP ไม่ซ้ำกัน)"""
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(['NodeID', 'Interface ID', 'กระทรวง / สังกัด', 'กรม / สังกัด', 'จังหวัด', 'ชื่อหน่วยงาน', 'Node Name'])
+    for i in range(rows):
+        sheet.append([100000 + i, 1 + i % 4, "กระทรวงศึกษาธิการ", f"สำนักงานเขต {i % 20 + 1}",
+                      PROVINCES[i % len(PROVINCES)], f"โรงเรียนตัวอย่าง {i // 10}", f"NODE-{i:05d}"])
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+    return buffer.getvalue()
+
+
+def _max_rss_mb(who):
+    if resource is None:
+        return None
+    rss = resource.getrusage(who).ru_maxrss
+    return round(rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def _percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+# --- การวัดหนึ่งขนาด (รันใน process ใหม่) ---
+def run_scenario(rows, options):
+    """สร้างไฟล์ rows แถว แล้วรัน process_file_in_background กับ stub คืนค่าผลการวัด"""
+    work_dir = tempfile.mkdtemp(prefix="bench_e2e_")
+    # final อ่านค่าเหล่านี้ตอน import จึงต้องตั้งก่อน
+    os.environ.update({
+        "SOLARWINDS_API_URL": start_stub_server(options),
+        "SOLARWIND_CACHE_PATH": os.path.join(work_dir, "cache.sqlite3"),
+        "SOLARWIND_JOB_STORE_PATH": os.path.join(work_dir, "jobs.sqlite3"),
+        "SOLARWIND_MONTH_TO_DATE_PATH": os.path.join(work_dir, "month_to_date.sqlite3"),
+        "SOLARWIND_TIMESERIES_DIR": os.path.join(work_dir, "timeseries"),
+        "SOLARWIND_WORKBOOK_CACHE_PATH": os.path.join(work_dir, "workbooks.sqlite3"),
+        "SOLARWIND_RENDER_CACHE_PATH": os.path.join(work_dir, "render_cache.sqlite3"),
+    })
+    sys.path.insert(0, PACKAGE_DIR)
+    import final
+    final.logger.setLevel(logging.ERROR)
+    final.console_handler.setLevel(logging.ERROR) # log ของ process สร้างไฟล์ถูกส่งกลับมาผ่าน handler นี้
+
+    workbook = build_workbook(rows)
+    # จุดวัด latency ต่อวงจร: เวลาเริ่มดึงข้อมูล (ตาม NodeID) และเวลาบันทึกผล (ตามลำดับแถว)
+    fetch_started = {}
+    row_done = {}
+    fetch_circuit_shared = final.fetch_circuit_shared
+    add_result = final.job_store.add_result
+
+    def timed_fetch(nod_id, *args):
+        fetch_started.setdefault(nod_id, time.perf_counter())
+        return fetch_circuit_shared(nod_id, *args)
+
+    def timed_add_result(*args, **kwargs):
+        processed = add_result(*args, **kwargs)
+        row_done[processed - 1] = time.perf_counter()
+        return processed
+
+    final.fetch_circuit_shared = timed_fetch
+    final.job_store.add_result = timed_add_result
+
+    job_id = "benchmark"
+    final.job_store.create(job_id, report_month=options["month"])
+    started = time.perf_counter()
+    final.process_file_in_background(io.BytesIO(workbook), job_id, fetch_workers=options["fetch_workers"],
+                                     report_month=options["month"], report_mode="full", render_workers=options["render_workers"])
+    elapsed = time.perf_counter() - started
+    status = final.job_store.get(job_id)
+    if final._render_pool is not None:
+        final._render_pool.shutdown()
+    if status["zip_file_path"] and os.path.exists(status["zip_file_path"]):
+        os.remove(status["zip_file_path"])
+
+    latencies = [row_done[index] - fetch_started[str(100000 + index)] for index in range(rows)
+                 if index in row_done and str(100000 + index) in fetch_started]
+    results = final.job_store.results(job_id)
+    counters = (status["metrics"] or {}).get("counters", {})
+    shutil.rmtree(work_dir, ignore_errors=True)
+    return {
+        "rows": rows,
+        "seconds": round(elapsed, 3),
+        "rows_per_second": round(rows / elapsed, 2),
+        "p50_ms": round(_percentile(latencies, 50) * 1000, 1) if latencies else None,
+        "p99_ms": round(_percentile(latencies, 99) * 1000, 1) if latencies else None,
+        "peak_rss_mb": _max_rss_mb(resource.RUSAGE_SELF) if resource else None,
+        "peak_render_rss_mb": _max_rss_mb(resource.RUSAGE_CHILDREN) if resource else None,
+        "failed_rows": sum(1 for result in results if result["error_message"]),
+        "api_errors": sum(counters.get("api_errors", {}).values()),
+        "api_retries": counters.get("api_retries", 0),
+        "error": status["error"],
+    }
+
+
+# --- baseline ---
+def scenario_key(rows, options):
+    return json.dumps({"rows": rows, **{name: options[name] for name in SCENARIO_OPTIONS}}, sort_keys=True)
+
+
+def compare(result, baseline, tolerance):
+    """คืนค่ารายการข้อความของค่าที่แย่ลงเกิน tolerance (สัดส่วน)"""
+    regressions = []
+    if baseline.get("rows_per_second") and result["rows_per_second"] < baseline["rows_per_second"] * (1 - tolerance):
+        regressions.append(f"rows/s {result['rows_per_second']} < baseline {baseline['rows_per_second']}")
+    for name in ("p50_ms", "p99_ms", "peak_rss_mb", "peak_render_rss_mb"):
+        if baseline.get(name) and result.get(name) and result[name] > baseline[name] * (1 + tolerance):
+            regressions.append(f"{name} {result[name]} > baseline {baseline[name]}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=[100, 1000], help="จำนวนแถวของไฟล์รายชื่อวงจร (หลายค่าได้)")
+    parser.add_argument("--month", default="2025-07", help="เดือนของข้อมูล (YYYY-MM)")
+    parser.add_argument("--latency", type=float, default=0.05, help="เวลาตอบสนองเฉลี่ยของ stub (วินาที, สุ่ม 0.5-1.5 เท่า)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="สัดส่วนคำขอที่ stub ตอบ HTTP 500")
+    parser.add_argument("--gap-rate", type=float, default=0.02, help="สัดส่วนชั่วโมงที่ไม่มีข้อมูล")
+    parser.add_argument("--mojibake-rate", type=float, default=0.2, help="สัดส่วนวงจรที่ที่อยู่เป็น mojibake (UTF-8 ที่ถูกอ่านเป็น latin-1)")
+    parser.add_argument("--fetch-workers", type=int, default=8, help="fetch_workers ของ process_file_in_background")
+    parser.add_argument("--render-workers", type=int, default=None, help="render_workers ของ process_file_in_background (ค่าเริ่มต้น: RENDER_WORKERS ตามเครื่อง)")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="ไฟล์ baseline (JSON)")
+    parser.add_argument("--save-baseline", action="store_true", help="บันทึกผลครั้งนี้เป็น baseline แทนการเปรียบเทียบ")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="สัดส่วนที่ยอมให้แย่ลงได้ก่อนถือว่า regression")
+    args = parser.parse_args()
+    options = {name: getattr(args, name) for name in SCENARIO_OPTIONS}
+
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            baselines = json.load(f)
+
+    print(f"{'rows':>6} {'seconds':>9} {'rows/s':>8} {'p50 ms':>8} {'p99 ms':>9} {'main MB':>8} {'render MB':>10} {'failed':>7}")
+    regressions = []
+    context = multiprocessing.get_context("spawn")
+    for rows in args.rows:
+        # process ใหม่ต่อขนาด: cache/สถานะของ final และ ru_maxrss เริ่มใหม่ทุกครั้ง
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            result = pool.submit(run_scenario, rows, options).result()
+        print(f"{rows:>6} {result['seconds']:>9.2f} {result['rows_per_second']:>8.1f} {result['p50_ms'] or 0:>8.1f} "
+              f"{result['p99_ms'] or 0:>9.1f} {result['peak_rss_mb'] or 0:>8.1f} {result['peak_render_rss_mb'] or 0:>10.1f} "
+              f"{result['failed_rows']:>7}")
+        if result["error"]:
+            print(f"  งานล้มเหลว: {result['error']}", file=sys.stderr)
+            regressions.append(f"rows={rows}: {result['error']}")
+        key = scenario_key(rows, options)
+        if args.save_baseline:
+            baselines[key] = {**result, "machine": f"{platform.system()} {platform.machine()} {os.cpu_count()} CPU, Python {platform.python_version()}"}
+        elif key in baselines:
+            for message in compare(result, baselines[key], args.tolerance):
+                print(f"  ⚠️ {message}")
+                regressions.append(f"rows={rows}: {message}")
+        else:
+            print("  (ไม่มี baseline สำหรับค่านี้)")
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(baselines, f, ensure_ascii=False, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"บันทึก baseline ลง {args.baseline}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,208 @@
+"""
+Micro-benchmark ของส่วนที่ใช้ CPU: process_json_data, export_to_csv และ export_to_pdf (แยกกัน)
+ชุดข้อมูล: full (744 ชั่วโมงครบเดือน), sparse (มีข้อมูลราว 30% ของชั่วโมง), fttx (Bandwidth แบบ FTTx)
+และ bad_timestamps (Timestamp ที่ parse ไม่ได้หรือไม่มี 10%)
+วัดเวลา (ค่าต่ำสุดจาก --repeat รอบ) และหน่วยความจำที่จองสูงสุดระหว่างเรียก (tracemalloc, วัดแยกจากการจับเวลา)
+เวลาที่ใช้เทียบกับ baseline คือ relative = เวลาต่ำสุด / เวลาต่ำสุดของงานอ้างอิง (json dumps/loads ของชุดข้อมูลเดียวกัน)
+ซึ่งจับเวลาสลับกันในรอบเดียวกัน เพื่อหักผลของความเร็วเครื่องที่เปลี่ยนไประหว่างรัน (เช่น CPU ถูกลดความถี่)
+
+ผลถูกเทียบกับ baseline ที่ commit ไว้ จะ exit 1 เมื่อ relative ช้าลงเกิน --tolerance
+หรือหน่วยความจำต่างจาก baseline (มากขึ้นหรือน้อยลง) เกิน --alloc-tolerance
+เมื่อเป็นการเปลี่ยนแปลงที่ตั้งใจให้บันทึกใหม่ด้วย --save-baseline
+เวลาขึ้นกับเครื่องและมีความแปรปรวน (เร็วขึ้นจึงแสดงเป็นหมายเหตุเท่านั้น) ส่วนหน่วยความจำขึ้นกับเวอร์ชันของ pandas/reportlab เป็นหลัก
+
+วิธีใช้:
+    python benchmarks/bench_micro.py
+    python benchmarks/bench_micro.py --fixture full --function export_to_pdf --top 10
+    python benchmarks/bench_micro.py --save-baseline
+"""
+import argparse
+import datetime
+import io
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import final
+import report_render
+
+final.logger.setLevel(logging.ERROR) # ชุด bad_timestamps ตั้งใจให้เกิดคำเตือน
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines", "bench_micro.json")
+ADDRESS = "สำนักงานเขตพื้นที่การศึกษา จังหวัดตัวอย่าง"
+MONTH_START = datetime.datetime(2025, 7, 1)
+MONTH_HOURS = 31 * 24
+FUNCTIONS = ("process_json_data", "export_to_csv", "export_to_pdf")
+
+
+def _item(hour, rnd, bandwidth="100 Mbps", date=None):
+    ts = MONTH_START + datetime.timedelta(hours=hour)
+    return {
+        "Customer_Curcuit_ID": "GIN0001234",
+        "Address": ADDRESS,
+        "Timestamp": {"date": date or ts.strftime("%Y-%m-%d %H:%M:%S.000000"), "timezone_type": 3, "timezone": "Asia/Bangkok"},
+        "Bandwidth": bandwidth,
+        "In_Averagebps": f"{rnd.random() * 1e8:.4f}",
+        "Out_Averagebps": f"{rnd.random() * 1e8:.4f}",
+    }
+
+
+def build_fixtures():
+    """ข้อมูลดิบแบบที่ได้จาก decode_return_text (สุ่มแบบคงที่ ผลจึงเหมือนเดิมทุกครั้ง)"""
+    rnd = random.Random(0)
+    full = [_item(hour, rnd) for hour in range(MONTH_HOURS)]
+    sparse = [_item(hour, rnd) for hour in range(MONTH_HOURS) if rnd.random() < 0.3]
+    fttx = [_item(hour, rnd, bandwidth=rnd.choice(["FTTx 1000/500", "FTTx", "FTTx-Business 30M"])) for hour in range(MONTH_HOURS)]
+    bad_timestamps = []
+    for hour in range(MONTH_HOURS):
+        roll = rnd.random()
+        if roll < 0.04:
+            bad_timestamps.append(_item(hour, rnd, date="0000-00-00 00:00:00.000000"))
+        elif roll < 0.08:
+            bad_timestamps.append(_item(hour, rnd, date="2025-07-32 25:61:00"))
+        elif roll < 0.10:
+            item = _item(hour, rnd)
+            del item["Timestamp"]
+            bad_timestamps.append(item)
+        else:
+            bad_timestamps.append(_item(hour, rnd))
+    return {"full": full, "sparse": sparse, "fttx": fttx, "bad_timestamps": bad_timestamps}
+
+
+def make_call(function, raw):
+    """คืนค่าฟังก์ชันไม่มีอาร์กิวเมนต์ที่เรียกฟังก์ชันที่วัดหนึ่งครั้ง (เตรียมผลของ process_json_data ไว้ก่อนสำหรับ export)"""
+    if function == "process_json_data":
+        return lambda: final.process_json_data(raw, "benchmark")
+    headers, data, monthly_averages = final.process_json_data(raw, "benchmark")
+    export = getattr(report_render, function)
+
+    def call():
+        success, message = export(headers, data, monthly_averages, io.BytesIO(), "benchmark", "benchmark")
+        if not success:
+            raise RuntimeError(message)
+    return call
+
+
+def measure_time(call, raw, repeat):
+    """คืนค่า (เวลาต่ำสุด, มัธยฐาน, เวลาต่ำสุดของงานอ้างอิง) โดยจับเวลางานอ้างอิงสลับกับฟังก์ชันที่วัดทุกรอบ"""
+    reference = lambda: json.loads(json.dumps(raw))
+    call() # อุ่นเครื่อง (ฟอนต์, style, cache ของ format)
+    reference()
+    times = []
+    reference_times = []
+    for _ in range(repeat):
+        times.append(timeit.timeit(call, number=1))
+        reference_times.append(timeit.timeit(reference, number=1))
+    return min(times), statistics.median(times), min(reference_times)
+
+
+def measure_allocations(call, top):
+    """คืนค่า (หน่วยความจำสูงสุดที่จองระหว่างเรียก, รายการตำแหน่งที่จองค้างมากที่สุด top อันดับ)"""
+    tracemalloc.start(25 if top else 1)
+    try:
+        before = tracemalloc.take_snapshot() if top else None
+        tracemalloc.reset_peak()
+        start_size, _ = tracemalloc.get_traced_memory()
+        result = call()
+        _, peak = tracemalloc.get_traced_memory()
+        sites = []
+        if top:
+            stats = tracemalloc.take_snapshot().compare_to(before, "lineno")
+            sites = [f"{stat.size_diff / 1024:>10.1f} KB {stat.count_diff:>7} blocks  {stat.traceback}" for stat in stats[:top]]
+        del result
+    finally:
+        tracemalloc.stop()
+    return peak - start_size, sites
+
+
+def compare(result, baseline, tolerance, alloc_tolerance):
+    """คืนค่า (รายการที่ต่างจาก baseline เกินกำหนด, รายการที่เร็วขึ้นเกิน tolerance)"""
+    drifts = []
+    notes = []
+    if baseline.get("relative"):
+        change = result["relative"] / baseline["relative"] - 1
+        message = f"relative {result['relative']} vs baseline {baseline['relative']} ({change:+.0%})"
+        if change > tolerance:
+            drifts.append(message)
+        elif change < -tolerance:
+            notes.append(message)
+    if baseline.get("peak_kb"):
+        change = result["peak_kb"] / baseline["peak_kb"] - 1
+        if abs(change) > alloc_tolerance:
+            drifts.append(f"peak_kb {result['peak_kb']} vs baseline {baseline['peak_kb']} ({change:+.0%})")
+    return drifts, notes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--fixture", action="append", help="วัดเฉพาะชุดข้อมูลนี้ (ระบุซ้ำได้)")
+    parser.add_argument("--function", action="append", choices=FUNCTIONS, help="วัดเฉพาะฟังก์ชันนี้ (ระบุซ้ำได้)")
+    parser.add_argument("--repeat", type=int, default=7, help="จำนวนรอบที่จับเวลาต่อรายการ")
+    parser.add_argument("--top", type=int, default=0, help="แสดงตำแหน่งในโค้ดที่จองหน่วยความจำค้างมากที่สุด N อันดับ")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="ไฟล์ baseline (JSON)")
+    parser.add_argument("--save-baseline", action="store_true", help="บันทึกผลครั้งนี้เป็น baseline แทนการเปรียบเทียบ")
+    parser.add_argument("--tolerance", type=float, default=0.4, help="สัดส่วนที่ relative ช้ากว่า baseline ได้")
+    parser.add_argument("--alloc-tolerance", type=float, default=0.1, help="สัดส่วนที่หน่วยความจำต่างจาก baseline ได้")
+    args = parser.parse_args()
+
+    fixtures = build_fixtures()
+    unknown = set(args.fixture or ()) - set(fixtures)
+    if unknown:
+        parser.error(f"ไม่มีชุดข้อมูล: {', '.join(sorted(unknown))} (มี {', '.join(fixtures)})")
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            baselines = json.load(f)
+
+    drifts = []
+    print(f"{'fixture':<15} {'function':<18} {'items':>6} {'min ms':>9} {'median ms':>10} {'relative':>9} {'peak KB':>10}")
+    for fixture_name, raw in fixtures.items():
+        if args.fixture and fixture_name not in args.fixture:
+            continue
+        for function in FUNCTIONS:
+            if args.function and function not in args.function:
+                continue
+            call = make_call(function, raw)
+            best, median, reference = measure_time(call, raw, args.repeat)
+            peak, sites = measure_allocations(call, args.top)
+            result = {"min_ms": round(best * 1000, 2), "median_ms": round(median * 1000, 2),
+                      "relative": round(best / reference, 3), "peak_kb": round(peak / 1024, 1)}
+            print(f"{fixture_name:<15} {function:<18} {len(raw):>6} {result['min_ms']:>9.2f} {result['median_ms']:>10.2f} "
+                  f"{result['relative']:>9.3f} {result['peak_kb']:>10.1f}")
+            for site in sites:
+                print(f"    {site}")
+            key = f"{fixture_name}/{function}"
+            if args.save_baseline:
+                baselines[key] = result
+            elif key in baselines:
+                key_drifts, notes = compare(result, baselines[key], args.tolerance, args.alloc_tolerance)
+                for message in notes:
+                    print(f"  (เร็วกว่า baseline: {message})")
+                for message in key_drifts:
+                    print(f"  ⚠️ {message}")
+                    drifts.append(f"{key}: {message}")
+            else:
+                print("  (ไม่มี baseline สำหรับรายการนี้)")
+
+    if args.save_baseline:
+        baselines["_machine"] = (f"{platform.system()} {platform.machine()} {os.cpu_count()} CPU, Python {platform.python_version()}, "
+                                 f"pandas {final.pd.__version__}, PDF renderer {report_render.PDF_RENDERER}")
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(baselines, f, ensure_ascii=False, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"บันทึก baseline ลง {args.baseline}")
+    elif drifts:
+        print(f"ผลต่างจาก baseline {len(drifts)} รายการ (บันทึกใหม่ด้วย --save-baseline หากเป็นการเปลี่ยนแปลงที่ตั้งใจ)")
+    return 1 if drifts else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
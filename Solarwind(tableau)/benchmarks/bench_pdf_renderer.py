@@ -0,0 +1,78 @@
+"""
+Benchmark เปรียบเทียบความเร็วการสร้าง PDF (หน้า/วินาที)
+ระหว่าง platypus (Table หนึ่งตารางต่อวัน แบบเดิม) กับการวาดผังหน้าคงที่ลง canvas โดยตรง
+
+วิธีใช้:
+    python benchmarks/bench_pdf_renderer.py --days 31 --circuits 10
+"""
+import argparse
+import datetime
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import final
+import report_render
+
+final.logger.setLevel(logging.WARNING)
+
+ADDRESS = "สำนักงานเขตพื้นที่การศึกษา จังหวัดตัวอย่าง"
+
+
+def build_circuit(days):
+    """สร้างข้อมูลรายชั่วโมงของวงจรหนึ่งผ่าน process_json_data แบบเดียวกับที่ได้จาก API"""
+    start = datetime.datetime(2025, 7, 1)
+    raw = []
+    for hour in range(days * 24):
+        ts = start + datetime.timedelta(hours=hour)
+        raw.append({
+            "Customer_Curcuit_ID": "GIN0001234",
+            "Address": ADDRESS,
+            "Timestamp": {"date": ts.strftime("%Y-%m-%d %H:%M:%S.000000"), "timezone_type": 3, "timezone": "Asia/Bangkok"},
+            "Bandwidth": "100 Mbps",
+            "In_Averagebps": f"{(hour * 7919) % 100000000 / 3:.4f}",
+            "Out_Averagebps": f"{(hour * 104729) % 100000000 / 7:.4f}",
+        })
+    return final.process_json_data(raw, "benchmark")
+
+
+def measure(renderer, circuit, circuits, out_dir):
+    headers, data, monthly_averages = circuit
+    start = time.perf_counter()
+    for i in range(circuits):
+        filename = os.path.join(out_dir, f"{renderer}_{i}.pdf")
+        success, message = report_render.export_to_pdf(headers, data, monthly_averages, filename, "benchmark", f"circuit {i}", renderer=renderer)
+        if not success:
+            raise RuntimeError(message)
+    elapsed = time.perf_counter() - start
+    size = os.path.getsize(os.path.join(out_dir, f"{renderer}_0.pdf"))
+    return elapsed, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--days", type=int, default=31, help="จำนวนวัน (หน้า) ต่อวงจร")
+    parser.add_argument("--circuits", type=int, default=10, help="จำนวนไฟล์ PDF ที่สร้างต่อวิธี")
+    args = parser.parse_args()
+
+    circuit = build_circuit(args.days)
+    pages = args.days * args.circuits
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="bench_pdf_") as out_dir:
+        # อุ่นเครื่อง (ลงทะเบียนฟอนต์ / สร้าง style และผังหน้าครั้งแรก) ก่อนจับเวลา
+        for renderer in ("platypus", "canvas"):
+            measure(renderer, circuit, 1, out_dir)
+        print(f"{'renderer':<10} {'pages':>6} {'seconds':>9} {'pages/s':>9} {'KB/file':>8}")
+        for renderer in ("platypus", "canvas"):
+            elapsed, size = measure(renderer, circuit, args.circuits, out_dir)
+            results[renderer] = elapsed
+            print(f"{renderer:<10} {pages:>6} {elapsed:>9.2f} {pages / elapsed:>9.1f} {size / 1024:>8.1f}")
+    print(f"canvas เร็วกว่า platypus {results['platypus'] / results['canvas']:.1f}x")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,90 @@
+"""
+Benchmark เปรียบเทียบการ decode SOAP response ของ circuitStatus
+ระหว่างวิธีเดิม (regex + ET.fromstring + unicode_escape + ftfy ทั้งก้อน)
+กับวิธีใหม่ (extract_soap_return + decode_return_text)
+
+วิธีใช้:
+    python benchmarks/bench_soap_decoder.py --hours 744 --repeat 20
+"""
+import argparse
+import datetime
+import html
+import json
+import logging
+import os
+import re
+import sys
+import timeit
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import final
+
+final.logger.setLevel(logging.WARNING)
+
+ADDRESS = "สำนักงานเขตพื้นที่การศึกษา จังหวัดตัวอย่าง"
+
+
+def build_payload(hours, variant):
+    """สร้าง JSON แบบเดียวกับที่ PHP json_encode ส่งกลับมา"""
+    address = ADDRESS
+    if variant == "mojibake":
+        address = ADDRESS.encode("utf-8").decode("latin-1")
+    start = datetime.datetime(2025, 7, 1)
+    rows = []
+    for hour in range(hours):
+        ts = start + datetime.timedelta(hours=hour)
+        rows.append({
+            "Customer_Curcuit_ID": "GIN0001234",
+            "Address": address,
+            "Timestamp": {"date": ts.strftime("%Y-%m-%d %H:%M:%S.000000"), "timezone_type": 3, "timezone": "Asia/Bangkok"},
+            "Bandwidth": "100 Mbps",
+            "In_Averagebps": f"{(hour * 7919) % 100000000 / 3:.4f}",
+            "Out_Averagebps": f"{(hour * 104729) % 100000000 / 7:.4f}",
+        })
+    return json.dumps(rows, ensure_ascii=(variant != "utf8")).replace("/", "\\/")
+
+
+def build_response(hours, variant):
+    body = html.escape(build_payload(hours, variant))
+    xml = ('<?xml version="1.0" encoding="UTF-8"?>'
+           '<SOAP-ENV:Envelope xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/">'
+           '<SOAP-ENV:Body><ns1:circuitStatusResponse xmlns:ns1="http://1.179.233.116/soap/#Service_Solarwinds_gin">'
+           f'<return xsi:type="xsd:string" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">{body}</return>'
+           '</ns1:circuitStatusResponse></SOAP-ENV:Body></SOAP-ENV:Envelope>')
+    return xml.encode("utf-8")
+
+
+def decode_legacy(response_bytes):
+    text = response_bytes.decode("utf-8")
+    match = re.search(r"(<\?xml.*?</SOAP-ENV:Envelope>)", text, re.DOTALL)
+    root = ET.fromstring(match.group(1))
+    return final._decode_return_text_legacy(root.find(".//{*}return").text)
+
+
+def decode_fast(response_bytes):
+    chunks = (response_bytes[i:i + final.SOAP_CHUNK_SIZE] for i in range(0, len(response_bytes), final.SOAP_CHUNK_SIZE))
+    return final.decode_return_text(final.extract_soap_return(chunks))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--hours", type=int, default=744, help="จำนวนชั่วโมงใน payload (ค่าเริ่มต้น 744 = 31 วัน)")
+    parser.add_argument("--repeat", type=int, default=20, help="จำนวนรอบที่วัดต่อวิธี")
+    args = parser.parse_args()
+
+    print(f"{'variant':<10} {'size':>10} {'legacy ms':>10} {'fast ms':>10} {'speedup':>8}")
+    for variant in ("escaped", "utf8", "mojibake"):
+        response_bytes = build_response(args.hours, variant)
+        if decode_legacy(response_bytes) != decode_fast(response_bytes):
+            print(f"{variant}: ผลลัพธ์ของสองวิธีไม่ตรงกัน", file=sys.stderr)
+            return 1
+        final._fix_mojibake.cache_clear()
+        legacy = min(timeit.repeat(lambda: decode_legacy(response_bytes), number=1, repeat=args.repeat))
+        fast = min(timeit.repeat(lambda: (final._fix_mojibake.cache_clear(), decode_fast(response_bytes)), number=1, repeat=args.repeat))
+        print(f"{variant:<10} {len(response_bytes):>10,} {legacy * 1000:>10.2f} {fast * 1000:>10.2f} {legacy / fast:>7.1f}x")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
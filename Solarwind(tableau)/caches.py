@@ -0,0 +1,279 @@
+"""cache บนดิสก์ (SQLite) ของ final.py: ผลลัพธ์ circuitStatus, ไฟล์รายงานที่สร้างแล้ว และรายชื่อวงจรที่อ่านจากไฟล์"""
+import datetime
+import hashlib
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+import zlib
+
+import pandas as pd
+
+from report_render import JobContextFilter
+
+# logger ลูกของ logger 'solarwind' ใน final.py (log ไปยัง handler ของ final.py)
+logger = logging.getLogger('solarwind.cache')
+logger.addFilter(JobContextFilter())
+
+def open_database(path, create_schema=None, check_same_thread=True):
+    """เปิด SQLite แบบ WAL แล้วสร้างตารางด้วย create_schema(conn) ทุก store เรียกเมื่อใช้ครั้งแรก import final.py จึงไม่แตะไฟล์ฐานข้อมูล"""
+    conn = sqlite3.connect(path, check_same_thread=check_same_thread, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    if create_schema is not None:
+        with conn:
+            create_schema(conn)
+    return conn
+
+class SQLiteCache:
+    """ฐาน cache บน SQLite ที่ลบรายการที่ไม่ได้ใช้นานที่สุด (LRU) เมื่อเกิน max_bytes subclass กำหนด _TABLE (มีคอลัมน์ size, accessed_at) และ _SCHEMA"""
+    _TABLE = None
+    _SCHEMA = ()
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._db = None
+
+    @property
+    def _conn(self):
+        """connection เดียวที่ใช้ร่วมกันทุก thread (เรียกภายใต้ self._lock)"""
+        if self._db is None:
+            self._db = open_database(self.path, self._create_schema, check_same_thread=False)
+        return self._db
+
+    def _create_schema(self, conn):
+        for statement in self._SCHEMA:
+            conn.execute(statement)
+
+    def _evict(self, keep=None):
+        """ลบรายการที่ไม่ได้ใช้นานที่สุดจนขนาดรวมไม่เกิน max_bytes ยกเว้นแถว rowid=keep (เรียกภายใต้ self._lock) คืนค่า (จำนวน, bytes)"""
+        total_size = self._conn.execute(f"SELECT COALESCE(SUM(size), 0) FROM {self._TABLE}").fetchone()[0]
+        freed = 0
+        victims = []
+        for rowid, size in self._conn.execute(f"SELECT rowid, size FROM {self._TABLE} ORDER BY accessed_at").fetchall():
+            if total_size - freed <= self.max_bytes:
+                break
+            if rowid != keep:
+                victims.append((rowid,))
+                freed += size
+        self._conn.executemany(f"DELETE FROM {self._TABLE} WHERE rowid = ?", victims)
+        return len(victims), freed
+
+# --- Cache ผลลัพธ์ circuitStatus ---
+_CACHE_MONTH_RE = re.compile(r"\d{4}-(0[1-9]|1[0-2])-")
+
+class CircuitResponseCache(SQLiteCache):
+    """เก็บผลลัพธ์ของ get_data_from_api ตาม (NodeID, Interface ID, เดือนของข้อมูล) รายการที่ดึงหลังสิ้นเดือนใช้ได้ตลอด นอกนั้นหมดอายุตาม ttl_seconds"""
+    _TABLE = 'circuit_cache'
+    _SCHEMA = ("""
+        CREATE TABLE IF NOT EXISTS circuit_cache (
+            nod_id TEXT NOT NULL,
+            itf_id TEXT NOT NULL,
+            month TEXT NOT NULL,
+            payload BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            fetched_at REAL NOT NULL,
+            accessed_at REAL NOT NULL,
+            PRIMARY KEY (nod_id, itf_id, month)
+        )""", "CREATE INDEX IF NOT EXISTS idx_circuit_cache_accessed ON circuit_cache (accessed_at)")
+
+    def __init__(self, path, ttl_seconds=3600, max_bytes=512 * 1024 * 1024):
+        super().__init__(path, max_bytes)
+        self.ttl_seconds = ttl_seconds
+
+    @staticmethod
+    def current_month():
+        return datetime.datetime.now().strftime('%Y-%m')
+
+    @staticmethod
+    def month_end(month):
+        """เวลา (epoch) ของต้นเดือนถัดไปตามเวลาท้องถิ่น"""
+        year, month_number = map(int, month.split('-'))
+        if month_number == 12:
+            year, month_number = year + 1, 0
+        return datetime.datetime(year, month_number + 1, 1).timestamp()
+
+    @staticmethod
+    def data_month(data):
+        """เดือน (YYYY-MM) ของ Timestamp ล่าสุดในข้อมูลดิบ หรือ None หากไม่มี Timestamp ที่ใช้ได้"""
+        items = data if isinstance(data, list) else [data]
+        months = [ts['date'][:7] for ts in (item.get("Timestamp") for item in items if isinstance(item, dict))
+                  if isinstance(ts, dict) and isinstance(ts.get('date'), str) and _CACHE_MONTH_RE.match(ts['date'])]
+        return max(months, default=None)
+
+    def get(self, nod_id, itf_id, month):
+        """คืนค่าข้อมูลที่เก็บไว้ หรือ None หากไม่มี/หมดอายุ"""
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT payload, fetched_at FROM circuit_cache WHERE nod_id = ? AND itf_id = ? AND month = ?",
+                (nod_id, itf_id, month)).fetchone()
+            if row is None:
+                return None
+            payload, fetched_at = row
+            if fetched_at < self.month_end(month) and now - fetched_at > self.ttl_seconds:
+                return None
+            self._conn.execute(
+                "UPDATE circuit_cache SET accessed_at = ? WHERE nod_id = ? AND itf_id = ? AND month = ?",
+                (now, nod_id, itf_id, month))
+        return json.loads(zlib.decompress(payload).decode('utf-8'))
+
+    def put(self, nod_id, itf_id, data):
+        """บันทึกข้อมูลภายใต้เดือนของข้อมูล (ดู data_month) คืนค่าเดือนนั้น หรือ None หากระบุเดือนไม่ได้ (ไม่บันทึก)"""
+        month = self.data_month(data)
+        if month is None:
+            return None
+        payload = zlib.compress(json.dumps(data, ensure_ascii=False).encode('utf-8'))
+        now = time.time()
+        with self._lock, self._conn:
+            rowid = self._conn.execute(
+                "INSERT OR REPLACE INTO circuit_cache (nod_id, itf_id, month, payload, size, fetched_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (nod_id, itf_id, month, payload, len(payload), now, now)).lastrowid
+            removed, freed = self._evict(keep=rowid)
+        if removed:
+            logger.info(f"🗑️ ลบข้อมูล cache เก่า {removed} รายการ ({freed:,} bytes)")
+        return month
+
+# --- Cache ไฟล์ CSV/PDF ที่สร้างแล้ว ---
+class RenderCache(SQLiteCache):
+    """เก็บไฟล์ CSV (zlib) และ PDF ที่สร้างแล้วโดยใช้ key ของข้อมูลรายงาน (ดู key) salt เป็นข้อความหรือฟังก์ชันที่คืนค่าข้อความ"""
+    _TABLE = 'rendered_reports'
+    _SCHEMA = ("""
+        CREATE TABLE IF NOT EXISTS rendered_reports (
+            digest TEXT PRIMARY KEY,
+            csv BLOB NOT NULL,
+            pdf BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            accessed_at REAL NOT NULL
+        )""", "CREATE INDEX IF NOT EXISTS idx_rendered_reports_accessed ON rendered_reports (accessed_at)")
+
+    def __init__(self, path, max_bytes=1024 * 1024 * 1024, salt=''):
+        super().__init__(path, max_bytes)
+        self.salt = salt
+
+    def key(self, headers, data, monthly_averages):
+        """sha256 ของ salt, headers, monthly_averages และค่าของแต่ละคอลัมน์ (ต่อด้วย NUL แทน json.dumps ทีละแถว)"""
+        if callable(self.salt):
+            self.salt = self.salt()
+        digest = hashlib.sha256(json.dumps([self.salt, headers, monthly_averages, len(data)], ensure_ascii=False, default=str).encode('utf-8'))
+        for header in headers:
+            values = [row[header] for row in data]
+            try:
+                text = '\0'.join(values)
+                kind = b'S' if text.count('\0') == max(0, len(values) - 1) else None
+            except TypeError:
+                kind = None
+            # ค่าที่ไม่ใช่ข้อความหรือมี NUL อยู่ในค่าใช้ json.dumps ทั้งคอลัมน์ (บันทึกชนิดและความยาวไว้ key จึงไม่กำกวม)
+            if kind is None:
+                kind, text = b'J', json.dumps(values, ensure_ascii=False, default=str)
+            encoded = text.encode('utf-8', 'surrogatepass')
+            digest.update(kind + len(encoded).to_bytes(8, 'little') + encoded)
+        return digest.hexdigest()
+
+    def get(self, digest):
+        """คืนค่า (csv_bytes, pdf_bytes) ที่เก็บไว้ หรือ None หากไม่มี"""
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT csv, pdf FROM rendered_reports WHERE digest = ?", (digest,)).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("UPDATE rendered_reports SET accessed_at = ? WHERE digest = ?", (time.time(), digest))
+        return zlib.decompress(row[0]), row[1]
+
+    def put(self, digest, csv_bytes, pdf_bytes):
+        csv_payload = zlib.compress(csv_bytes)
+        size = len(csv_payload) + len(pdf_bytes)
+        with self._lock, self._conn:
+            rowid = self._conn.execute("INSERT OR REPLACE INTO rendered_reports (digest, csv, pdf, size, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                                       (digest, csv_payload, pdf_bytes, size, time.time())).lastrowid
+            removed, freed = self._evict(keep=rowid)
+        if removed:
+            logger.info(f"🗑️ ลบไฟล์ใน cache ของรายงานที่สร้างแล้ว {removed} รายการ ({freed:,} bytes)")
+
+# --- Cache รายชื่อวงจรที่อ่านจากไฟล์ ---
+class WorkbookCache(SQLiteCache):
+    """เก็บรายชื่อวงจรที่อ่านแล้วทีละชุดพร้อม dtype โดยใช้ sha256 ของเนื้อหาไฟล์เป็น key (put/get แปลงทีละชุด)"""
+    _TABLE = 'workbook_lists'
+    _SCHEMA = (
+        "DROP TABLE IF EXISTS parsed_workbooks", # รูปแบบเดิมที่เก็บทั้งไฟล์เป็นข้อความ JSON เดียว
+        """
+        CREATE TABLE IF NOT EXISTS workbook_lists (
+            digest TEXT PRIMARY KEY,
+            columns TEXT NOT NULL,
+            dtypes TEXT NOT NULL,
+            chunks INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            accessed_at REAL NOT NULL
+        )""",
+        """
+        CREATE TABLE IF NOT EXISTS workbook_chunks (
+            digest TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            payload BLOB NOT NULL,
+            PRIMARY KEY (digest, seq)
+        )""",
+        # ชุดของรายการที่ถูกลบ (รวมถึงที่ _evict ลบ) ถูกลบตาม
+        """
+        CREATE TRIGGER IF NOT EXISTS workbook_lists_delete AFTER DELETE ON workbook_lists BEGIN
+            DELETE FROM workbook_chunks WHERE digest = OLD.digest;
+        END""",
+    )
+    _DTYPES = ('int64', 'float64', 'bool', 'object', 'str')
+
+    def __init__(self, path, max_bytes=64 * 1024 * 1024):
+        super().__init__(path, max_bytes)
+
+    def get(self, digest):
+        """คืนค่า iterator ของ DataFrame ทีละชุดที่เก็บไว้ หรือ None หากไม่มี"""
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT columns, dtypes, chunks FROM workbook_lists WHERE digest = ?", (digest,)).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("UPDATE workbook_lists SET accessed_at = ? WHERE digest = ?", (time.time(), digest))
+        return self._iter_chunks(digest, json.loads(row[0]), json.loads(row[1]), row[2])
+
+    def _iter_chunks(self, digest, columns, dtypes, chunks):
+        for seq in range(chunks):
+            with self._lock:
+                row = self._conn.execute("SELECT payload FROM workbook_chunks WHERE digest = ? AND seq = ?", (digest, seq)).fetchone()
+            if row is None:
+                raise KeyError(f"รายการ {digest} ถูกลบออกจาก cache ระหว่างอ่าน")
+            values = json.loads(zlib.decompress(row[0]).decode('utf-8'))
+            yield pd.DataFrame({column: pd.Series(column_values, dtype=dtype)
+                                for column, dtype, column_values in zip(columns, dtypes, values)})
+
+    def put(self, digest, chunks):
+        """บันทึก DataFrame ทีละชุด (ข้ามไปหากมีชนิดข้อมูลที่เก็บเป็น JSON ไม่ได้ เช่นวันที่ หรือขนาดหลังบีบอัดเกิน max_bytes)"""
+        columns, dtypes = [], []
+        size = 0
+        stored = True
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM workbook_lists WHERE digest = ?", (digest,))
+            seq = -1
+            for seq, chunk in enumerate(chunks):
+                if not seq:
+                    columns = list(chunk.columns)
+                    dtypes = [str(dtype) for dtype in chunk.dtypes]
+                    if any(dtype not in self._DTYPES for dtype in dtypes):
+                        stored = False
+                        break
+                try:
+                    payload = zlib.compress(json.dumps([chunk[column].tolist() for column in columns], ensure_ascii=False).encode('utf-8'))
+                except (TypeError, ValueError):
+                    stored = False
+                    break
+                size += len(payload)
+                if size > self.max_bytes:
+                    stored = False
+                    break
+                self._conn.execute("INSERT INTO workbook_chunks (digest, seq, payload) VALUES (?, ?, ?)", (digest, seq, payload))
+            if stored:
+                rowid = self._conn.execute("INSERT INTO workbook_lists (digest, columns, dtypes, chunks, size, accessed_at) VALUES (?, ?, ?, ?, ?, ?)",
+                                           (digest, json.dumps(columns, ensure_ascii=False), json.dumps(dtypes), seq + 1, size, time.time())).lastrowid
+                self._evict(keep=rowid)
+            else:
+                self._conn.execute("DELETE FROM workbook_chunks WHERE digest = ?", (digest,))
+        return stored
@@ -4,38 +4,716 @@ import html
 import json
 import xml.etree.ElementTree as ET
 from ftfy import fix_text
+from ftfy.badness import is_bad
 import io
 import csv
 import datetime
 import os
+import sys
 import argparse
 import pandas as pd
-from flask import Flask, request, render_template, jsonify, send_from_directory
+from pandas.io.parsers import TextParser
+import numpy as np
+import openpyxl
+from flask import Flask, request, render_template, jsonify, send_from_directory, Response, stream_with_context
 import tempfile
 import threading
 import uuid
-from reportlab.lib.pagesizes import letter
-from reportlab.platypus import SimpleDocTemplate, Table, Paragraph, Spacer, PageBreak
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.units import inch
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
+import socket
 import logging
-from queue import Queue
+import logging.handlers
+import multiprocessing
 import zipfile
-import shutil # สำหรับลบ directory
+import posixpath # สำหรับชื่อไฟล์ภายใน ZIP
+import shutil
+import cProfile
 import time # สำหรับ threading.Timer ในการ cleanup
+from xml.sax.saxutils import escape as xml_escape
+from requests.adapters import HTTPAdapter
+from collections import deque, Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, FIRST_COMPLETED, wait as wait_futures
+from concurrent.futures.process import BrokenProcessPool
+import struct
+import pickle
+import zlib
+import codecs
+import gzip
+import functools
+import contextlib
+import contextvars
+import bisect
+import heapq
+from array import array
+import hashlib
+import itertools
+import math
+import random
+import urllib.parse
+# ส่วนสร้างไฟล์ CSV/PDF อยู่ในโมดูลแยกที่ไม่มีสถานะตอน import เพื่อให้ process ที่สร้างไฟล์ไม่ต้อง import final.py ทั้งไฟล์
+from report_render import (PDF_RENDERER, THAI_FONT_NAME, THAI_FONT_PATH, THAI_FONT_REGISTERED,
+                           JobContextFilter, current_job_id, init_render_worker, render_circuit_reports)
+# cache บนดิสก์ (SQLite) อยู่ในโมดูลแยก final.py สร้าง instance ที่ใช้ร่วมกันด้านล่าง
+from caches import CircuitResponseCache, RenderCache, WorkbookCache, open_database
 
 app = Flask(__name__)
 
-# --- สถานะการประมวลผลและ Lock สำหรับ Thread-safe ---
-processing_status = {}
-status_lock = threading.Lock()
+# --- จำนวน worker สำหรับดึงข้อมูลจาก API พร้อมกัน (ปรับได้ผ่าน environment variable) ---
+FETCH_WORKERS = max(1, int(os.environ.get('SOLARWIND_FETCH_WORKERS', '8'))) # จำนวนคำขอ API พร้อมกันเริ่มต้น รวมทุกงานใน process (แบ่งกันแบบ round-robin)
+# --- จำนวนงานที่ประมวลผลพร้อมกันได้ งานที่เกินจะรอในคิว ---
+MAX_CONCURRENT_JOBS = max(1, int(os.environ.get('SOLARWIND_MAX_CONCURRENT_JOBS', '2')))
+
+# --- จำนวน process สำหรับสร้างไฟล์ PDF/CSV (0 = สร้างใน thread ของงานเอง) ---
+RENDER_WORKERS = max(0, int(os.environ.get('SOLARWIND_RENDER_WORKERS', str(os.cpu_count() or 1))))
+# วิธีสร้าง PDF (SOLARWIND_PDF_RENDERER) กำหนดใน report_render.PDF_RENDERER
+# --- cache ของไฟล์ CSV/PDF ที่สร้างแล้ว ตาม hash ของข้อมูลรายงาน (ขนาดสูงสุด 0 = ปิด) ---
+RENDER_CACHE_PATH = os.environ.get('SOLARWIND_RENDER_CACHE_PATH', os.path.join(tempfile.gettempdir(), 'solarwind_render_cache.sqlite3'))
+RENDER_CACHE_MAX_BYTES = int(os.environ.get('SOLARWIND_RENDER_CACHE_MAX_BYTES', str(1024 * 1024 * 1024)))
+# เพิ่มค่านี้ทุกครั้งที่แก้รูปแบบของไฟล์ใน export_to_csv/export_to_pdf เพื่อไม่ให้ใช้ไฟล์ที่สร้างด้วยรูปแบบเดิม
+RENDER_TEMPLATE_VERSION = 2
+
+# --- ค่าตั้งต้นสำหรับเชื่อมต่อ Solarwinds SOAP API ---
+SOLARWINDS_API_URL = os.environ.get('SOLARWINDS_API_URL', "http://1.179.233.116:8082/api_csoc_02/server_solarwinds_gin.php")
+SOLARWINDS_SOAP_ACTION = "http://1.179.233.116/api_csoc_02/server_solarwinds_gin.php/circuitStatus"
+SOLARWINDS_API_TIMEOUT = float(os.environ.get('SOLARWINDS_API_TIMEOUT', '10'))
+SOAP_CHUNK_SIZE = 64 * 1024 # ขนาด chunk ที่อ่านจาก response ทีละส่วน
+# ลองใหม่เมื่อเชื่อมต่อไม่ได้/timeout/HTTP 5xx, 429 โดยรอแบบ exponential backoff (สุ่ม 0 ถึง min(MAX, BASE * 2^ครั้งที่))
+SOLARWINDS_API_MAX_ATTEMPTS = max(1, int(os.environ.get('SOLARWINDS_API_MAX_ATTEMPTS', '3')))
+SOLARWINDS_API_RETRY_BASE = float(os.environ.get('SOLARWINDS_API_RETRY_BASE', '0.5'))
+SOLARWINDS_API_RETRY_MAX = float(os.environ.get('SOLARWINDS_API_RETRY_MAX', '8'))
+# circuit breaker: ล้มเหลวติดกันครบ THRESHOLD ครั้งจะหยุดเรียก API เป็นเวลา RESET วินาที แล้วลองเรียกหนึ่งครั้ง
+# ระหว่างหยุด คำขอจะรอได้ไม่เกิน SOLARWINDS_API_BREAKER_MAX_WAIT วินาที ก่อนถือว่าล้มเหลว (กำหนดหลัง JOB_STALE_SECONDS)
+SOLARWINDS_API_BREAKER_THRESHOLD = max(1, int(os.environ.get('SOLARWINDS_API_BREAKER_THRESHOLD', '5')))
+SOLARWINDS_API_BREAKER_RESET = float(os.environ.get('SOLARWINDS_API_BREAKER_RESET', '30'))
+# hedged request: ส่งคำขอซ้ำอีกหนึ่งครั้งเมื่อคำขอแรกนานเกิน percentile ของเวลาตอบสนองล่าสุด (1 = เปิด)
+SOLARWINDS_API_HEDGE = os.environ.get('SOLARWINDS_API_HEDGE', '0') == '1'
+SOLARWINDS_API_HEDGE_PERCENTILE = float(os.environ.get('SOLARWINDS_API_HEDGE_PERCENTILE', '95'))
+# คำขอซ้ำใช้โควตาแยกของตัวเอง (ไม่กินสิทธิ์ของ api_concurrency) และไม่ส่งเลยขณะที่คำขอปกติใช้ limit เต็ม
+SOLARWINDS_API_HEDGE_BUDGET = max(1, int(os.environ.get('SOLARWINDS_API_HEDGE_BUDGET', '2')))
+# จำนวนคำขอ API พร้อมกันปรับอัตโนมัติ (AIMD) ระหว่าง MIN ถึง MAX โดยเริ่มที่ FETCH_WORKERS
+# เพิ่มเมื่อเวลาตอบสนองไม่เกิน LATENCY_TOLERANCE เท่าของเวลาปกติ (p10) และลดเป็น DECREASE_FACTOR เท่าเมื่อ timeout/5xx
+SOLARWINDS_API_MIN_CONCURRENCY = max(1, int(os.environ.get('SOLARWINDS_API_MIN_CONCURRENCY', '1')))
+SOLARWINDS_API_MAX_CONCURRENCY = max(FETCH_WORKERS, int(os.environ.get('SOLARWINDS_API_MAX_CONCURRENCY', str(FETCH_WORKERS * 2))))
+SOLARWINDS_API_LATENCY_TOLERANCE = float(os.environ.get('SOLARWINDS_API_LATENCY_TOLERANCE', '2'))
+SOLARWINDS_API_DECREASE_FACTOR = float(os.environ.get('SOLARWINDS_API_DECREASE_FACTOR', '0.5'))
+
+# --- ระดับการบีบอัดไฟล์ CSV ใน ZIP (PDF เก็บแบบไม่บีบอัดซ้ำ) ---
+ZIP_COMPRESSLEVEL = int(os.environ.get('SOLARWIND_ZIP_COMPRESSLEVEL', '6'))
+
+# --- Cache ผลลัพธ์จาก API (SQLite) ---
+CACHE_DB_PATH = os.environ.get('SOLARWIND_CACHE_PATH', os.path.join(tempfile.gettempdir(), 'solarwind_circuit_cache.sqlite3'))
+CACHE_TTL_SECONDS = int(os.environ.get('SOLARWIND_CACHE_TTL', '3600'))  # อายุข้อมูลใน cache (ยกเว้นข้อมูลที่ดึงมาหลังสิ้นเดือนของข้อมูลแล้ว ซึ่งไม่หมดอายุ)
+CACHE_MAX_BYTES = int(os.environ.get('SOLARWIND_CACHE_MAX_BYTES', str(512 * 1024 * 1024)))
+
+# --- เหตุการณ์ของแต่ละงานที่ส่งแบบ push ผ่าน /events/<job_id> ---
+JOB_LOG_HISTORY = int(os.environ.get('SOLARWIND_JOB_LOG_HISTORY', '5000')) # จำนวนบรรทัด log ล่าสุดที่เก็บไว้ต่องาน
+JOB_EVENT_RESULT_WINDOW = int(os.environ.get('SOLARWIND_JOB_EVENT_RESULT_WINDOW', '1000')) # จำนวนผลรายแถวล่าสุดที่เก็บในหน่วยความจำ (ที่เก่ากว่าอ่านจาก job_store)
+EVENT_STREAM_KEEPALIVE = 15 # วินาที
+EVENT_STORE_POLL_SECONDS = 1 # ความถี่ในการอ่าน job_store เมื่องานทำงานอยู่ใน process อื่น
+# --- บีบอัด response ของ /status ด้วย gzip เมื่อมีขนาดตั้งแต่ค่านี้ (bytes) ---
+STATUS_GZIP_MIN_BYTES = int(os.environ.get('SOLARWIND_STATUS_GZIP_MIN_BYTES', '4096'))
+
+# --- สถานะงานเก็บใน SQLite (ใช้ร่วมกันได้ระหว่างหลาย worker process) ---
+JOB_STORE_PATH = os.environ.get('SOLARWIND_JOB_STORE_PATH', os.path.join(tempfile.gettempdir(), 'solarwind_jobs.sqlite3'))
+# ไฟล์ของแต่ละงาน (เช่นไฟล์ Excel ต้นฉบับสำหรับ resume) อยู่ในโฟลเดอร์ <JOB_FILES_DIR>/<job_id>
+JOB_FILES_DIR = os.environ.get('SOLARWIND_JOB_FILES_DIR', os.path.join(tempfile.gettempdir(), 'solarwind_job_files'))
+JOB_STALE_SECONDS = int(os.environ.get('SOLARWIND_JOB_STALE_SECONDS', '300')) # งานที่ไม่มีความคืบหน้านานเกินนี้ถือว่า process ที่ทำงานหยุดไปแล้ว
+# เวลารอ circuit breaker ไม่เกินครึ่งหนึ่งของ JOB_STALE_SECONDS (ค่าที่ตั้งมากกว่านั้นจะถูกลดลง)
+# ระหว่างรอไม่มีความคืบหน้า แต่ job_store.start_heartbeat ยังบันทึก updated_at ทุก JOB_STALE_SECONDS / 3 วินาที
+# ส่วนนี้จึงเป็นขอบเขตสำรองเมื่อ heartbeat บันทึกไม่สำเร็จ (เช่นฐานข้อมูลถูกล็อก)
+SOLARWINDS_API_BREAKER_MAX_WAIT = min(float(os.environ.get('SOLARWINDS_API_BREAKER_MAX_WAIT', str(JOB_STALE_SECONDS / 2))),
+                                      JOB_STALE_SECONDS / 2)
+
+# --- โหมดรายงาน: 'full' ประมวลผลทั้งเดือนใหม่ทุกครั้ง / 'incremental' ต่อยอดจากการสร้างรายงานครั้งก่อนของเดือนเดียวกัน ---
+REPORT_MODES = ('full', 'incremental')
+REPORT_MODE = os.environ.get('SOLARWIND_REPORT_MODE', 'full')
+MONTH_TO_DATE_PATH = os.environ.get('SOLARWIND_MONTH_TO_DATE_PATH', os.path.join(tempfile.gettempdir(), 'solarwind_month_to_date.sqlite3'))
+MONTH_TO_DATE_RETENTION_DAYS = int(os.environ.get('SOLARWIND_MONTH_TO_DATE_RETENTION_DAYS', '62')) # สถานะที่ไม่ได้ใช้นานเกินนี้จะถูกลบ
+
+# --- คลังข้อมูลรายชั่วโมงของทุกวงจรบนดิสก์ (ตั้งเป็นค่าว่างเพื่อปิด) ---
+TIMESERIES_DIR = os.environ.get('SOLARWIND_TIMESERIES_DIR', os.path.join(tempfile.gettempdir(), 'solarwind_timeseries'))
+
+# --- อ่านไฟล์รายชื่อวงจร (Excel/CSV) และ cache ผลที่อ่านแล้วตาม hash ของเนื้อหาไฟล์ ---
+REQUIRED_COLUMNS = ['NodeID', 'Interface ID', 'กระทรวง / สังกัด', 'กรม / สังกัด', 'จังหวัด', 'ชื่อหน่วยงาน', 'Node Name']
+WORKBOOK_CACHE_PATH = os.environ.get('SOLARWIND_WORKBOOK_CACHE_PATH', os.path.join(tempfile.gettempdir(), 'solarwind_workbook_cache.sqlite3'))
+WORKBOOK_CACHE_MAX_BYTES = int(os.environ.get('SOLARWIND_WORKBOOK_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+CHUNK_ROWS = max(1, int(os.environ.get('SOLARWIND_CHUNK_ROWS', '500'))) # จำนวนแถวที่แปลงเป็น dict ต่อครั้งระหว่างประมวลผล
+
+class JobStore:
+    """สถานะงาน ผลรายแถว และ checkpoint ใน SQLite ที่ทุก worker process เห็นร่วมกัน (งานของ process อื่นที่ค้างเกิน stale_seconds ถือว่าหยุดกลางคัน)"""
+    _FIELDS = ('total', 'processed', 'completed', 'canceled', 'error', 'zip_file_path', 'report_month', 'report_mode',
+               'queue_position', 'cache_hits', 'cache_misses', 'coalesced', 'metrics', 'created_at', 'owner', 'updated_at')
+    _COUNTERS = ('processed', 'cache_hits', 'cache_misses', 'coalesced')
+    STALE_ERROR = "งานหยุดกลางคันเนื่องจาก process ที่ประมวลผลหยุดทำงาน"
+    CANCEL_ERROR = "การประมวลผลถูกยกเลิก"
+
+    def __init__(self, path, stale_seconds=300, files_dir=None):
+        self.path = path
+        self.stale_seconds = stale_seconds
+        self.files_dir = files_dir or os.path.join(os.path.dirname(os.path.abspath(path)), 'solarwind_job_files')
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._local = threading.local()
+        self._schema_lock = threading.Lock()
+        self._schema_ready = False
+        self._heartbeat_lock = threading.Lock()
+        self._heartbeat_jobs = Counter() # job_id -> จำนวนผู้เรียก start_heartbeat ที่ยังไม่ stop
+        self._heartbeat_thread = None
+
+    def _create_schema(self, conn):
+        with self._schema_lock:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_id TEXT PRIMARY KEY,
+                    total INTEGER NOT NULL DEFAULT -1,
+                    processed INTEGER NOT NULL DEFAULT 0,
+                    completed INTEGER NOT NULL DEFAULT 0,
+                    canceled INTEGER NOT NULL DEFAULT 0,
+                    error TEXT,
+                    zip_file_path TEXT,
+                    report_month TEXT,
+                    report_mode TEXT NOT NULL DEFAULT 'full',
+                    queue_position INTEGER NOT NULL DEFAULT 0,
+                    cache_hits INTEGER NOT NULL DEFAULT 0,
+                    cache_misses INTEGER NOT NULL DEFAULT 0,
+                    coalesced INTEGER NOT NULL DEFAULT 0,
+                    metrics TEXT,
+                    owner TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )""")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS job_results (
+                    job_id TEXT NOT NULL,
+                    seq INTEGER NOT NULL,
+                    node_name TEXT,
+                    csv_success INTEGER NOT NULL,
+                    pdf_success INTEGER NOT NULL,
+                    error_message TEXT,
+                    PRIMARY KEY (job_id, seq)
+                )""")
+            # ตารางรุ่นก่อนเก็บเนื้อหาไฟล์ Excel (workbook BLOB) ย้ายออกไปเป็นไฟล์ในโฟลเดอร์ของงาน
+            migrate_sources = 'workbook' in [column[1] for column in conn.execute("PRAGMA table_info(job_sources)")]
+            if migrate_sources:
+                conn.execute("ALTER TABLE job_sources RENAME TO job_sources_blob")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS job_sources (
+                    job_id TEXT PRIMARY KEY,
+                    filename TEXT,
+                    path TEXT NOT NULL
+                )""")
+            if migrate_sources:
+                for job_id, filename in conn.execute("SELECT job_id, filename FROM job_sources_blob").fetchall():
+                    workbook = conn.execute("SELECT workbook FROM job_sources_blob WHERE job_id = ?", (job_id,)).fetchone()[0]
+                    conn.execute("INSERT INTO job_sources (job_id, filename, path) VALUES (?, ?, ?)",
+                                 (job_id, filename, self._write_source(job_id, workbook)))
+                conn.execute("DROP TABLE job_sources_blob")
+            # ตารางรุ่นก่อนเก็บเนื้อหาไฟล์ (csv/pdf BLOB) งานเดิมจะสร้างแถวเหล่านั้นใหม่เมื่อทำงานต่อ
+            if 'csv' in [column[1] for column in conn.execute("PRAGMA table_info(job_artifacts)")]:
+                conn.execute("DROP TABLE job_artifacts")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS job_artifacts (
+                    job_id TEXT NOT NULL,
+                    seq INTEGER NOT NULL,
+                    kind TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    file_offset INTEGER NOT NULL,
+                    size INTEGER NOT NULL,
+                    method INTEGER,
+                    crc INTEGER NOT NULL,
+                    PRIMARY KEY (job_id, seq, kind)
+                )""")
+        self._schema_ready = True
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = open_database(self.path, None if self._schema_ready else self._create_schema)
+        return conn
+
+    def _is_stale(self, values):
+        return (not values['completed'] and values['owner'] != self.owner
+                and values['updated_at'] < time.time() - self.stale_seconds)
+
+    def _to_status(self, row):
+        values = dict(zip(self._FIELDS, row))
+        stale = self._is_stale(values)
+        return {
+            'total': values['total'],
+            'processed': values['processed'],
+            'completed': bool(values['completed']) or stale,
+            'error': self.STALE_ERROR if stale else values['error'],
+            'canceled': bool(values['canceled']),
+            'cache': {'hits': values['cache_hits'], 'misses': values['cache_misses']},
+            'coalesced': values['coalesced'],
+            'zip_file_path': values['zip_file_path'],
+            'report_month': values['report_month'],
+            'report_mode': values['report_mode'],
+            'queue_position': values['queue_position'],
+            'metrics': json.loads(values['metrics']) if values['metrics'] else None,
+            'timestamp': datetime.datetime.fromtimestamp(values['created_at'])
+        }
+
+    def create(self, job_id, report_month=None, report_mode='full'):
+        now = time.time()
+        with self._conn() as conn:
+            conn.execute("INSERT INTO jobs (job_id, report_month, report_mode, owner, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                         (job_id, report_month, report_mode, self.owner, now, now))
+
+    def get(self, job_id):
+        """คืนค่าสถานะงาน (ไม่รวม results) หรือ None หากไม่พบ (อ่านอย่างเดียว)"""
+        row = self._conn().execute(f"SELECT {', '.join(self._FIELDS)} FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return self._to_status(row) if row is not None else None
+
+    def fail_stale_jobs(self):
+        """บันทึกงานของ process อื่นที่ไม่มีความคืบหน้านานเกิน stale_seconds เป็นข้อผิดพลาด คืนค่าจำนวนงาน"""
+        with self._conn() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET completed = 1, error = ? WHERE completed = 0 AND owner != ? AND updated_at < ?",
+                (self.STALE_ERROR, self.owner, time.time() - self.stale_seconds))
+        return cursor.rowcount
+
+    def start_heartbeat(self, job_id):
+        """บันทึก updated_at ของงานทุก stale_seconds / 3 วินาทีจนกว่าจะเรียก stop_heartbeat"""
+        with self._heartbeat_lock:
+            self._heartbeat_jobs[job_id] += 1
+            if self._heartbeat_thread is None:
+                self._heartbeat_thread = threading.Thread(target=self._heartbeat, name="job-heartbeat", daemon=True)
+                self._heartbeat_thread.start()
+
+    def stop_heartbeat(self, job_id):
+        with self._heartbeat_lock:
+            self._heartbeat_jobs[job_id] -= 1
+            if self._heartbeat_jobs[job_id] <= 0:
+                del self._heartbeat_jobs[job_id]
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(max(1, self.stale_seconds / 3))
+            with self._heartbeat_lock:
+                job_ids = list(self._heartbeat_jobs)
+            if not job_ids:
+                continue
+            try:
+                with self._conn() as conn:
+                    conn.executemany("UPDATE jobs SET updated_at = ? WHERE job_id = ? AND owner = ? AND completed = 0",
+                                     [(time.time(), job_id, self.owner) for job_id in job_ids])
+            except Exception as e:
+                logger.warning(f"⚠️ บันทึกสถานะว่างานยังทำงานอยู่ไม่สำเร็จ: {e}")
+
+    def complete(self, job_id, zip_file_path):
+        """บันทึกว่างานสร้าง ZIP สำเร็จ (ล้างข้อผิดพลาดหยุดกลางคัน) คืนค่า False หากงานถูก process อื่นรับไปทำต่อแล้ว"""
+        with self._conn() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET completed = 1, error = NULL, zip_file_path = ?, updated_at = ? WHERE job_id = ? AND owner = ?",
+                (zip_file_path, time.time(), job_id, self.owner))
+        return cursor.rowcount > 0
+
+    def update(self, job_id, **fields):
+        assignments = ', '.join(f"{name} = ?" for name in fields)
+        with self._conn() as conn:
+            conn.execute(f"UPDATE jobs SET {assignments}, updated_at = ? WHERE job_id = ?",
+                         (*fields.values(), time.time(), job_id))
+
+    def increment(self, job_id, counter, amount=1):
+        if counter not in self._COUNTERS:
+            raise ValueError(f"Unknown counter: {counter}")
+        with self._conn() as conn:
+            conn.execute(f"UPDATE jobs SET {counter} = {counter} + ?, updated_at = ? WHERE job_id = ?",
+                         (amount, time.time(), job_id))
+
+    def add_result(self, job_id, result, locations=None):
+        """บันทึกผลและ checkpoint ของแถวถัดไปพร้อมเพิ่ม processed ใน transaction เดียว คืนค่า processed ใหม่"""
+        with self._conn() as conn:
+            conn.execute("UPDATE jobs SET processed = processed + 1, updated_at = ? WHERE job_id = ?", (time.time(), job_id))
+            processed = conn.execute("SELECT processed FROM jobs WHERE job_id = ?", (job_id,)).fetchone()[0]
+            conn.execute(
+                "INSERT OR REPLACE INTO job_results (job_id, seq, node_name, csv_success, pdf_success, error_message) VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, processed - 1, result['node_name'], int(result['csv_success']), int(result['pdf_success']), result['error_message']))
+            self._save_artifacts(conn, job_id, processed - 1, locations)
+        return processed
+
+    @staticmethod
+    def _save_artifacts(conn, job_id, seq, locations):
+        conn.execute("DELETE FROM job_artifacts WHERE job_id = ? AND seq = ?", (job_id, seq))
+        conn.executemany("INSERT INTO job_artifacts (job_id, seq, kind, name, path, file_offset, size, method, crc) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                         [(job_id, seq, kind, *location) for kind, location in (locations or {}).items() if location is not None])
+
+    def save_artifacts(self, job_id, seq, locations):
+        """บันทึกตำแหน่งไฟล์ของแถว seq ใหม่ (เมื่อไฟล์ถูกคัดลอกไปยัง ZIP ใหม่ระหว่างทำงานต่อ)"""
+        with self._conn() as conn:
+            self._save_artifacts(conn, job_id, seq, locations)
+
+    def results(self, job_id, cursor=0, limit=None):
+        """คืนค่าผลรายแถวตั้งแต่แถวที่ cursor (นับจาก 0) ตามลำดับ สูงสุด limit แถว (None = ทั้งหมด)"""
+        rows = self._conn().execute(
+            "SELECT node_name, csv_success, pdf_success, error_message FROM job_results WHERE job_id = ? AND seq >= ? ORDER BY seq LIMIT ?",
+            (job_id, cursor, -1 if limit is None else limit)).fetchall()
+        return [{'node_name': node_name, 'csv_success': bool(csv_success), 'pdf_success': bool(pdf_success), 'error_message': error_message}
+                for node_name, csv_success, pdf_success, error_message in rows]
+
+    def iter_artifacts(self, job_id, limit):
+        """คืนค่า (seq, {'csv' | 'pdf': ตำแหน่งไฟล์ หรือ None}) ของแถวที่ checkpoint ไว้ก่อนแถวที่ limit ตามลำดับ"""
+        conn = self._conn()
+        for start in range(0, limit, CHUNK_ROWS):
+            end = min(limit, start + CHUNK_ROWS)
+            rows = {seq: {kind: None for kind, success in (('csv', csv_success), ('pdf', pdf_success)) if not success}
+                    for seq, csv_success, pdf_success in conn.execute(
+                        "SELECT seq, csv_success, pdf_success FROM job_results WHERE job_id = ? AND seq >= ? AND seq < ?",
+                        (job_id, start, end))}
+            for seq, kind, *location in conn.execute(
+                    "SELECT seq, kind, name, path, file_offset, size, method, crc FROM job_artifacts WHERE job_id = ? AND seq >= ? AND seq < ?",
+                    (job_id, start, end)):
+                rows.setdefault(seq, {})[kind] = tuple(location)
+            for seq in range(start, end):
+                yield seq, rows.get(seq, {})
+
+    def truncate(self, job_id, processed):
+        """ลบผลและตำแหน่งไฟล์ตั้งแต่แถวที่ processed (นับจาก 0) เพื่อสร้างแถวเหล่านั้นใหม่"""
+        with self._conn() as conn:
+            conn.execute("DELETE FROM job_results WHERE job_id = ? AND seq >= ?", (job_id, processed))
+            conn.execute("DELETE FROM job_artifacts WHERE job_id = ? AND seq >= ?", (job_id, processed))
+            conn.execute("UPDATE jobs SET processed = ?, updated_at = ? WHERE job_id = ?", (processed, time.time(), job_id))
+
+    def has_checkpoint(self, job_id):
+        return self._conn().execute("SELECT 1 FROM job_sources WHERE job_id = ?", (job_id,)).fetchone() is not None
+
+    def _remove_artifact_files(self, conn, job_id):
+        for (path,) in conn.execute("SELECT DISTINCT path FROM job_artifacts WHERE job_id = ?", (job_id,)).fetchall():
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning(f"⚠️ ลบไฟล์ checkpoint ไม่สำเร็จ: {path}: {e}")
+
+    def job_dir(self, job_id):
+        return os.path.join(self.files_dir, job_id)
+
+    def _write_source(self, job_id, workbook):
+        os.makedirs(self.job_dir(job_id), exist_ok=True)
+        path = os.path.join(self.job_dir(job_id), 'source')
+        with open(path, 'wb') as f:
+            f.write(workbook)
+        return path
+
+    def _remove_job_dir(self, job_id):
+        shutil.rmtree(self.job_dir(job_id), ignore_errors=True)
+
+    def save_source(self, job_id, filename, workbook):
+        """เขียนไฟล์ Excel ต้นฉบับลงโฟลเดอร์ของงาน แล้วบันทึกเฉพาะตำแหน่งไฟล์"""
+        path = self._write_source(job_id, workbook)
+        with self._conn() as conn:
+            conn.execute("INSERT OR REPLACE INTO job_sources (job_id, filename, path) VALUES (?, ?, ?)", (job_id, filename, path))
+
+    def _source_path(self, job_id):
+        row = self._conn().execute("SELECT path FROM job_sources WHERE job_id = ?", (job_id,)).fetchone()
+        return row[0] if row and os.path.exists(row[0]) else None
+
+    def load_source(self, job_id):
+        """คืนค่า bytes ของไฟล์ Excel ต้นฉบับ หรือ None หากไม่มี checkpoint"""
+        path = self._source_path(job_id)
+        if path is None:
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def clear_checkpoint(self, job_id):
+        """ลบไฟล์ Excel ตำแหน่งไฟล์รายแถว และไฟล์ .part/.hold ที่ยังเหลืออยู่ (เมื่องานสร้าง ZIP สำเร็จแล้ว)"""
+        with self._conn() as conn:
+            self._remove_artifact_files(conn, job_id)
+            conn.execute("DELETE FROM job_artifacts WHERE job_id = ?", (job_id,))
+            conn.execute("DELETE FROM job_sources WHERE job_id = ?", (job_id,))
+        self._remove_job_dir(job_id)
+
+    def resume(self, job_id):
+        """เปิดงานที่ถูกยกเลิกหรือหยุดกลางคันให้ทำต่อใน process นี้ คืนค่าจำนวนแถวที่เสร็จแล้ว หรือ None หากทำต่อไม่ได้"""
+        if self._source_path(job_id) is None:
+            return None
+        now = time.time()
+        with self._conn() as conn:
+            # ทำต่อได้เฉพาะงานที่ยกเลิกแล้ว งานที่ fail_stale_jobs บันทึกว่าหยุดกลางคัน
+            # และงานของ process ที่หยุดทำงานไปแล้วซึ่งยังไม่ถูกบันทึกเป็นข้อผิดพลาด (ดู _is_stale)
+            cursor = conn.execute(
+                "UPDATE jobs SET completed = 0, canceled = 0, error = NULL, owner = ?, updated_at = ? "
+                "WHERE job_id = ? AND zip_file_path IS NULL AND (error IS NULL OR error IN (?, ?)) "
+                "AND ((completed = 1 AND (canceled = 1 OR error = ?)) OR (completed = 0 AND owner != ? AND updated_at < ?)) "
+                "AND EXISTS (SELECT 1 FROM job_sources WHERE job_sources.job_id = jobs.job_id)",
+                (self.owner, now, job_id, self.CANCEL_ERROR, self.STALE_ERROR, self.STALE_ERROR, self.owner, now - self.stale_seconds))
+            if cursor.rowcount == 0:
+                return None
+            return conn.execute("SELECT processed FROM jobs WHERE job_id = ?", (job_id,)).fetchone()[0]
+
+    def request_cancel(self, job_id):
+        """ตั้งค่าสถานะยกเลิก คืนค่า False หากไม่พบงาน"""
+        with self._conn() as conn:
+            cursor = conn.execute("UPDATE jobs SET canceled = 1 WHERE job_id = ?", (job_id,))
+        return cursor.rowcount > 0
+
+    def is_canceled(self, job_id):
+        row = self._conn().execute("SELECT canceled FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return bool(row and row[0])
+
+    def list_jobs(self):
+        """คืนค่า [(job_id, สถานะ)] ของทุกงาน"""
+        rows = self._conn().execute(f"SELECT job_id, {', '.join(self._FIELDS)} FROM jobs").fetchall()
+        return [(row[0], self._to_status(row[1:])) for row in rows]
+
+    def delete(self, job_id):
+        """ลบงานและผลรายแถว คืนค่าสถานะก่อนลบ หรือ None หากไม่พบ"""
+        status = self.get(job_id)
+        with self._conn() as conn:
+            self._remove_artifact_files(conn, job_id)
+            for table in ('job_results', 'job_artifacts', 'job_sources', 'jobs'):
+                conn.execute(f"DELETE FROM {table} WHERE job_id = ?", (job_id,))
+        self._remove_job_dir(job_id)
+        return status
+
+job_store = JobStore(JOB_STORE_PATH, stale_seconds=JOB_STALE_SECONDS, files_dir=JOB_FILES_DIR)
+# JobStore ของงานที่กำลังประมวลผล: งานจากเว็บใช้ job_store ส่วน run_batch ใช้ฐานข้อมูลชั่วคราวของตัวเอง
+# thread ที่ทำงานแทนงาน (fetch_pool, hedge_executor) ได้ค่านี้ไปด้วยผ่าน contextvars.copy_context
+current_job_store = contextvars.ContextVar('current_job_store', default=job_store)
+
+class JobEventLog:
+    """ลำดับเหตุการณ์ (log, progress, result) ของงานหนึ่งที่อ่านต่อจาก cursor ได้ ผลเก่าที่ไม่อยู่ในหน่วยความจำอ่านซ้ำจาก load_results"""
+    def __init__(self, max_logs=JOB_LOG_HISTORY, first_id=1, load_results=None, max_results=JOB_EVENT_RESULT_WINDOW):
+        self.max_logs = max_logs
+        self.max_results = max_results
+        self.load_results = load_results
+        self.closed = False
+        self._cond = threading.Condition()
+        self._ids = []
+        self._events = []
+        self._log_count = 0
+        self._result_ids = array('q') # id ของเหตุการณ์ผลของแต่ละแถว เรียงตาม index
+        self._dropped_results = 0 # จำนวนผลแถวแรกๆ ที่ไม่ได้อยู่ในหน่วยความจำแล้ว
+        self._total = 0
+        self._next_id = first_id
+
+    def publish(self, event_type, data, final=False):
+        with self._cond:
+            if self.closed:
+                return
+            self._ids.append(self._next_id)
+            self._events.append((self._next_id, event_type, data))
+            self._next_id += 1
+            if event_type == 'log':
+                self._log_count += 1
+                if self._log_count > self.max_logs + self.max_logs // 4:
+                    self._log_count -= self._drop_old('log', self._log_count - self.max_logs)
+            elif event_type == 'result':
+                self._result_ids.append(self._ids[-1])
+                self._total = data['total']
+                in_memory = len(self._result_ids) - self._dropped_results
+                if self.load_results is not None and in_memory > self.max_results + self.max_results // 4:
+                    self._dropped_results += self._drop_old('result', in_memory - self.max_results)
+            self.closed = final
+            self._cond.notify_all()
+
+    def _drop_old(self, event_type, count):
+        dropped = 0
+        kept = []
+        for event in self._events:
+            if dropped < count and event[1] == event_type:
+                dropped += 1
+                continue
+            kept.append(event)
+        self._events = kept
+        self._ids = [event[0] for event in kept]
+        return dropped
+
+    def read(self, cursor, timeout=None, replay=True):
+        """คืนค่า (เหตุการณ์ที่ id มากกว่า cursor, closed) โดยรอได้ไม่เกิน timeout วินาที (replay=False ไม่อ่านผลเก่าจาก load_results)"""
+        with self._cond:
+            if timeout and not self.closed and (not self._ids or self._ids[-1] <= cursor):
+                self._cond.wait(timeout)
+            start = bisect.bisect_right(self._ids, cursor)
+            events = self._events[start:]
+            closed = self.closed
+            first = bisect.bisect_right(self._result_ids, cursor)
+            replay_ids = self._result_ids[first:min(self._dropped_results, first + self.max_results)] if replay else ()
+            total = self._total
+        if not replay_ids:
+            return events, closed
+        # ส่งเฉพาะเหตุการณ์ที่ id ไม่เกินผลสุดท้ายที่อ่านซ้ำ ส่วนที่เหลือจะได้ในการอ่านครั้งถัดไป
+        events = [event for event in events if event[0] < replay_ids[-1]]
+        replayed = [(event_id, 'result', {'result': result, 'index': index, 'processed': index + 1, 'total': total})
+                    for index, event_id, result in zip(itertools.count(first), replay_ids, self.load_results(first, len(replay_ids)))]
+        return list(heapq.merge(replayed, events, key=lambda event: event[0])), False
+
+class JobEventBroker:
+    """เก็บ JobEventLog ของทุกงานใน process"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._jobs = {}
+
+    def open(self, job_id):
+        """คืนค่า JobEventLog ของงาน หากของเดิมปิดไปแล้ว (งานถูกทำต่อ) จะเริ่มใหม่โดยใช้ id ต่อจากเดิม"""
+        with self._lock:
+            events = self._jobs.get(job_id)
+            if events is None or events.closed:
+                events = self._jobs[job_id] = JobEventLog(first_id=events._next_id if events else 1,
+                                                          load_results=functools.partial(current_job_store.get().results, job_id))
+            return events
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def publish(self, job_id, event_type, data, final=False):
+        events = self.get(job_id)
+        if events is not None:
+            events.publish(event_type, data, final=final)
+
+    def discard(self, job_id):
+        with self._lock:
+            events = self._jobs.pop(job_id, None)
+        if events is not None:
+            events.publish('done', {}, final=True) # ปลุกผู้อ่านที่ยังรออยู่ให้จบการเชื่อมต่อ
+
+job_events = JobEventBroker()
+
+# --- ตัววัดเวลาแต่ละขั้นและตัวนับของบริการ (ส่งออกแบบ Prometheus ที่ /metrics) ---
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60) # วินาที
+METRIC_HELP = {
+    'solarwind_stage_seconds': 'เวลาของแต่ละขั้น (api_wait, soap_decode, transform, csv, pdf, zip) ต่อวงจร',
+    'solarwind_api_requests_total': 'จำนวนคำขอ API แยกตามผล (ok, error)',
+    'solarwind_api_errors_total': 'ข้อผิดพลาดในการเรียก API แยกตามชนิด',
+    'solarwind_api_retries_total': 'จำนวนครั้งที่ลองเรียก API ใหม่',
+    'solarwind_api_hedged_requests_total': 'จำนวนคำขอซ้ำ (hedged request)',
+    'solarwind_cache_requests_total': 'การอ่าน cache ของ circuitStatus แยกตามผล (hits, misses)',
+    'solarwind_render_cache_requests_total': 'การอ่าน cache ของไฟล์ CSV/PDF ที่สร้างแล้ว แยกตามผล (hits, misses)',
+    'solarwind_rows_processed_total': 'จำนวนแถวที่ประมวลผลแล้ว แยกตามผล (ok, error)',
+    'solarwind_bytes_written_total': 'ขนาดไฟล์ที่เขียนลง ZIP (ก่อนบีบอัด) แยกตามชนิด',
+    'solarwind_jobs_finished_total': 'จำนวนงานที่จบแล้ว แยกตามผล (completed, failed, canceled)',
+}
+
+class ServiceMetrics:
+    """histogram เวลาแต่ละขั้นและตัวนับของทั้ง process สำหรับ /metrics พร้อมสรุปแยกของแต่ละงาน (ดู finish_job)"""
+    def __init__(self, buckets=METRIC_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._histograms = {} # stage -> [จำนวนต่อช่อง (ไม่สะสม, ช่องสุดท้ายคือ +Inf), ผลรวม]
+        self._counters = Counter() # (ชื่อ, label) -> ค่า
+        self._jobs = {} # job_id -> {'started', 'stages': {stage: [count, total, max]}, 'counters': Counter}
+
+    def observe(self, stage, seconds, job_id=None):
+        job_id = job_id or current_job_id.get()
+        with self._lock:
+            job = self._jobs.get(job_id)
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = self._histograms[stage] = [[0] * (len(self.buckets) + 1), 0.0]
+            histogram[0][bisect.bisect_left(self.buckets, seconds)] += 1
+            histogram[1] += seconds
+            if job is not None:
+                stats = job['stages'].setdefault(stage, [0, 0.0, 0.0])
+                stats[0] += 1
+                stats[1] += seconds
+                stats[2] = max(stats[2], seconds)
+
+    @contextlib.contextmanager
+    def time(self, stage, job_id=None):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started, job_id)
+
+    def inc(self, name, label=None, amount=1, job_id=None):
+        job_id = job_id or current_job_id.get()
+        with self._lock:
+            job = self._jobs.get(job_id)
+            self._counters[name, label] += amount
+            if job is not None:
+                job['counters'][name, label] += amount
+
+    def start_job(self, job_id):
+        with self._lock:
+            self._jobs[job_id] = {'started': time.monotonic(), 'stages': {}, 'counters': Counter()}
+
+    def finish_job(self, job_id):
+        """คืนค่าสรุปของงาน (เฉพาะการทำงานครั้งนี้ใน process นี้) แล้วเลิกเก็บแยก"""
+        with self._lock:
+            job = self._jobs.pop(job_id, None)
+        if job is None:
+            return None
+        elapsed = time.monotonic() - job['started']
+        counters = {}
+        for (name, label), value in sorted(job['counters'].items(), key=lambda item: (item[0][0], item[0][1] or '')):
+            key = name.removeprefix('solarwind_').removesuffix('_total')
+            if label is None:
+                counters[key] = value
+            else:
+                counters.setdefault(key, {})[label] = value
+        rows = sum(counters.get('rows_processed', {}).values())
+        return {
+            'elapsed_seconds': round(elapsed, 3),
+            'rows': rows,
+            'rows_per_second': round(rows / elapsed, 3) if elapsed > 0 else None,
+            'stages': {stage: {'count': count, 'total_seconds': round(total, 4), 'mean_seconds': round(total / count, 4),
+                               'max_seconds': round(peak, 4)}
+                       for stage, (count, total, peak) in job['stages'].items()},
+            'counters': counters
+        }
+
+    def render(self, gauges=()):
+        """ข้อความรูปแบบ Prometheus text exposition (version 0.0.4) gauges: รายการ (ชื่อ, คำอธิบาย, ค่า)"""
+        with self._lock:
+            histograms = {stage: (list(counts), total) for stage, (counts, total) in self._histograms.items()}
+            counters = dict(self._counters)
+        lines = [f"# HELP solarwind_stage_seconds {METRIC_HELP['solarwind_stage_seconds']}", "# TYPE solarwind_stage_seconds histogram"]
+        for stage, (counts, total) in sorted(histograms.items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += count
+                lines.append(f'solarwind_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'solarwind_stage_seconds_sum{{stage="{stage}"}} {total}')
+            lines.append(f'solarwind_stage_seconds_count{{stage="{stage}"}} {cumulative}')
+        label_names = {'solarwind_api_requests_total': 'outcome', 'solarwind_api_errors_total': 'kind',
+                       'solarwind_cache_requests_total': 'result', 'solarwind_render_cache_requests_total': 'result',
+                       'solarwind_rows_processed_total': 'result',
+                       'solarwind_bytes_written_total': 'kind', 'solarwind_jobs_finished_total': 'result'}
+        for name, help_text in METRIC_HELP.items():
+            if name == 'solarwind_stage_seconds':
+                continue
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+            for (counter_name, label), value in sorted(counters.items(), key=lambda item: item[0][1] or ''):
+                if counter_name == name:
+                    lines.append(f'{name}{{{label_names[name]}="{label}"}} {value}' if label is not None else f"{name} {value}")
+        for name, help_text, value in gauges:
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {value}"]
+        return "\n".join(lines) + "\n"
+
+service_metrics = ServiceMetrics()
+
+def job_status_snapshot(job_id):
+    """สรุปสถานะงาน (ไม่รวมรายการ results) สำหรับส่งเป็นเหตุการณ์"""
+    status = current_job_store.get().get(job_id)
+    if status is None:
+        return None
+    return {
+        'total': status['total'],
+        'processed': status['processed'],
+        'completed': status['completed'],
+        'canceled': status['canceled'],
+        'error': status['error'],
+        'zip_ready': bool(status['zip_file_path']),
+        'cache': status['cache'],
+        'coalesced': status['coalesced'],
+        'report_month': status['report_month'],
+        'report_mode': status['report_mode'],
+        'queue_position': status['queue_position'],
+        'api_concurrency': api_concurrency.snapshot(),
+        'metrics': status['metrics']
+    }
 
-# --- ตั้งค่า Logger และ Log Queue ---
-log_queue = Queue() # สร้าง Queue สำหรับเก็บ log
+def publish_job_progress(job_id, final=False):
+    snapshot = job_status_snapshot(job_id)
+    if snapshot is not None:
+        job_events.publish(job_id, 'done' if final else 'progress', snapshot, final=final)
 
-logger = logging.getLogger(__name__)
+# --- ตั้งค่า Logger ---
+logger = logging.getLogger('solarwind') # report_render ใช้ logger ลูก 'solarwind.render' ซึ่งส่ง log มายัง handler ของ logger นี้
 logger.setLevel(logging.INFO) # ตั้งค่าระดับ log ที่จะบันทึก
 
 # ลบ handler เก่าออกก่อนเพื่อป้องกันการเพิ่มซ้ำเมื่อ reload (สำหรับ Flask dev server)
@@ -43,71 +721,42 @@ if logger.handlers:
     for handler in list(logger.handlers):
         logger.removeHandler(handler)
 
-class QueueHandler(logging.Handler):
-    """
-    Handler ที่จะส่ง log record ไปยัง Queue
-    """
-    def __init__(self, queue):
-        super().__init__()
-        self.queue = queue
-
+class JobEventHandler(logging.Handler):
+    """ส่ง log ที่ผูกกับงานไปยังเหตุการณ์ของงานนั้น (job_events) เพื่อแสดงบนหน้าเว็บ"""
     def emit(self, record):
         try:
-            # ONLY send the formatted message to the queue, without full log details
-            # This is where we control what goes to the frontend
-            msg = self.format(record)
-            
-            # --- IMPORTANT: Custom formatting for frontend logs ---
-            # Remove timestamp, level, and job ID from logs sent to frontend for clarity
-            # Example: "2025-07-17 08:54:55,123 - INFO - Job f17846f3-4d62-44d9-a0a1-0176c18acd5c: กำลังประมวลผล NodeID: 185271..."
+            job_id = getattr(record, 'job_id', None)
+            if not job_id:
+                return
+            # ส่งเฉพาะข้อความ ไม่รวม timestamp / level ไปยังหน้าเว็บ
+            # Example: "2025-07-17 08:54:55,123 - INFO - Job f17846f3-...: กำลังประมวลผล NodeID: 185271..."
             # We want just: "กำลังประมวลผล NodeID: 185271..."
-            log_pattern = re.compile(r"^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2},\d{3} - (INFO|WARNING|ERROR|CRITICAL) - (Job [0-9a-f-]+: )?(.*)")
+            msg = self.format(record)
+            log_pattern = re.compile(r"^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2},\d{3} - (INFO|WARNING|ERROR|CRITICAL) - (Job [0-9a-f-]+: )?(.*)", re.DOTALL)
             match = log_pattern.match(msg)
-            if match:
-                clean_msg = match.group(3) # Get the message part
-                self.queue.put(clean_msg)
-            else:
-                self.queue.put(msg) # Fallback if pattern doesn't match
-            # --- End Custom formatting ---
-
+            clean_msg = match.group(3) if match else msg
+            job_events.publish(job_id, 'log', {'message': clean_msg, 'level': record.levelname})
         except Exception:
             self.handleError(record)
 
+for log_filter in list(logger.filters):
+    logger.removeFilter(log_filter)
+logger.addFilter(JobContextFilter())
+
 # Console Handler (แสดง log ใน Terminal) - เก็บ format เต็มไว้สำหรับ debugging
 console_handler = logging.StreamHandler()
 console_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
 logger.addHandler(console_handler)
 
-# Queue Handler (ส่ง log ไปยัง Queue สำหรับ Frontend)
-queue_handler = QueueHandler(log_queue)
+# Job Event Handler (ส่ง log ไปยังหน้าเว็บของงานนั้น)
+job_event_handler = JobEventHandler()
 # ไม่ต้องตั้ง formatter ที่นี่ เพราะเราจะ format เองใน emit()
-logger.addHandler(queue_handler)
-
-# --- ตั้งค่าฟอนต์ภาษาไทยสำหรับ PDF ---
-THAI_FONT_NAME = 'THSarabunNew'
-# ตรวจสอบให้แน่ใจว่า 'THSarabunNew.ttf' อยู่ใน directory เดียวกันกับ app.py
-THAI_FONT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'THSarabunNew.ttf')
-
-THAI_FONT_REGISTERED = False
-if os.path.exists(THAI_FONT_PATH):
-    try:
-        pdfmetrics.registerFont(TTFont(THAI_FONT_NAME, THAI_FONT_PATH))
-        THAI_FONT_REGISTERED = True
-        logger.info(f"Thai font '{THAI_FONT_NAME}' registered successfully from '{THAI_FONT_PATH}'.")
-    except Exception as e:
-        logger.error(f"ERROR: Could not register Thai font '{THAI_FONT_NAME}'. Error: {e}")
-else:
-    logger.warning(f"WARNING: Thai font file '{THAI_FONT_PATH}' not found. Please ensure the font file is in the same directory as the script.")
+logger.addHandler(job_event_handler)
 
-# --- ฟังก์ชันสำหรับประมวลผลข้อมูล ---
-def get_data_from_api(nod_id, itf_id, job_id):
-    """ดึงข้อมูลจาก API และแปลงเป็น JSON"""
-    url = "http://1.179.233.116:8082/api_csoc_02/server_solarwinds_gin.php"
-    headers = {
-        "Content-Type": "text/xml; charset=utf-8",
-        "SOAPAction": "http://1.179.233.116/api_csoc_02/server_solarwinds_gin.php/circuitStatus"
-    }
-    body = f"""<?xml version="1.1" encoding="utf-8"?>
+# --- SOAP client สำหรับ Solarwinds API ---
+class SolarwindsSoapClient:
+    """client ของ circuitStatus ที่ใช้ requests.Session ร่วมกัน (keep-alive) และ SOAP envelope ที่เตรียมไว้ล่วงหน้า"""
+    ENVELOPE_TEMPLATE = """<?xml version="1.1" encoding="utf-8"?>
 <soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/"
                xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
                xmlns:xsd="http://www.w3.org/2001/XMLSchema">
@@ -119,25 +768,442 @@ def get_data_from_api(nod_id, itf_id, job_id):
   </soap:Body>
 </soap:Envelope>"""
 
+    def __init__(self, url, soap_action, timeout=10, pool_size=FETCH_WORKERS):
+        self.url = url
+        self.timeout = timeout
+        self.headers = {
+            "Content-Type": "text/xml; charset=utf-8",
+            "SOAPAction": soap_action
+        }
+        # แยก template เป็น 3 ส่วน (ก่อน nodID, ระหว่าง nodID-itfID, หลัง itfID) แล้ว encode ไว้ครั้งเดียว
+        head, rest = self.ENVELOPE_TEMPLATE.split("{nod_id}")
+        middle, tail = rest.split("{itf_id}")
+        self._envelope_parts = (head.encode('utf-8'), middle.encode('utf-8'), tail.encode('utf-8'))
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def render_envelope(self, nod_id, itf_id):
+        """สร้าง SOAP body (bytes) จาก template ที่เตรียมไว้"""
+        head, middle, tail = self._envelope_parts
+        return b"".join((head, xml_escape(str(nod_id)).encode('utf-8'), middle, xml_escape(str(itf_id)).encode('utf-8'), tail))
+
+    def circuit_status(self, nod_id, itf_id, stream=False):
+        """เรียก circuitStatus และคืนค่า response (raise เมื่อ HTTP status ผิดพลาด)"""
+        resp = self.session.post(self.url, data=self.render_envelope(nod_id, itf_id), headers=self.headers, timeout=self.timeout, stream=stream)
+        try:
+            resp.raise_for_status()
+        except requests.exceptions.HTTPError:
+            resp.close()
+            raise
+        return resp
+
+# client ตัวเดียวที่ทุกงานใน Flask process ใช้ร่วมกัน
+soap_client = SolarwindsSoapClient(SOLARWINDS_API_URL, SOLARWINDS_SOAP_ACTION, timeout=SOLARWINDS_API_TIMEOUT,
+                                   pool_size=SOLARWINDS_API_MAX_CONCURRENCY * 2)
+
+# --- ความทนทานของการเรียก API (ลองใหม่, circuit breaker, hedged request) ---
+class CircuitBreaker:
+    """หยุดเรียก API เมื่อล้มเหลวติดกัน failure_threshold ครั้ง แล้วให้คำขอเดียวลองใหม่เมื่อครบ reset_seconds (half-open)"""
+    def __init__(self, failure_threshold=5, reset_seconds=30):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._cond = threading.Condition()
+        self._failures = 0
+        self._opened_at = None # None = เรียกได้ตามปกติ
+        self._probing = False
+
+    @property
+    def is_open(self):
+        return self._opened_at is not None
+
+    def allow(self, max_wait):
+        """รอจนกว่าจะเรียก API ได้ คืนค่า False หากรอนานเกิน max_wait วินาที"""
+        deadline = time.monotonic() + max_wait
+        with self._cond:
+            while True:
+                if self._opened_at is None:
+                    return True
+                now = time.monotonic()
+                retry_at = self._opened_at + self.reset_seconds
+                if now >= retry_at and not self._probing:
+                    self._probing = True
+                    return True
+                if now >= deadline:
+                    return False
+                # รอจนถึงเวลาลองใหม่ หรือจนกว่าคำขอที่กำลังลองอยู่จะได้ผล
+                self._cond.wait(min(max(retry_at - now, 0) or self.reset_seconds, deadline - now))
+
+    def record_success(self):
+        with self._cond:
+            if self._opened_at is not None:
+                logger.info("🔌 API กลับมาตอบสนองแล้ว ดึงข้อมูลต่อตามปกติ")
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+            self._cond.notify_all()
+
+    def record_failure(self):
+        with self._cond:
+            self._failures += 1
+            if self._probing or (self._opened_at is None and self._failures >= self.failure_threshold):
+                self._opened_at = time.monotonic()
+                self._probing = False
+                logger.warning(f"🔌 API ล้มเหลวติดกัน {self._failures} ครั้ง หยุดดึงข้อมูลชั่วคราว {self.reset_seconds:g} วินาที")
+                self._cond.notify_all()
+
+class LatencyTracker:
+    """เก็บเวลาตอบสนองของคำขอที่สำเร็จล่าสุด window รายการ เพื่อคำนวณ percentile (ต้องมีอย่างน้อย min_samples รายการ)"""
+    def __init__(self, window=200, min_samples=20):
+        self.min_samples = min_samples
+        self._lock = threading.Lock()
+        self._samples = deque(maxlen=window)
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, q):
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return None
+            samples = sorted(self._samples)
+        return samples[min(len(samples) - 1, int(len(samples) * q / 100))]
+
+class AdaptiveConcurrencyLimit:
+    """จำกัดจำนวนคำขอ API พร้อมกันแบบ AIMD: เพิ่มทีละน้อยเมื่อสำเร็จโดยไม่ช้าลง และลดเป็น decrease_factor เท่าเมื่อ API รับไม่ไหว"""
+    def __init__(self, initial, min_limit=1, max_limit=None, decrease_factor=0.5, latency_tolerance=2.0, latency=None):
+        self.min_limit = min_limit
+        self.max_limit = max_limit or initial
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+        self.latency = latency
+        self._cond = threading.Condition()
+        self._limit = float(min(max(initial, min_limit), self.max_limit))
+        self._in_flight = 0
+        self._last_decrease = 0.0
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    def acquire(self):
+        """รอจนกว่าจำนวนคำขอที่ทำงานอยู่จะน้อยกว่า limit คืนค่าเวลาเริ่ม (ใช้ส่งให้ release)"""
+        with self._cond:
+            while self._in_flight >= int(self._limit):
+                self._cond.wait()
+            self._in_flight += 1
+            return time.monotonic()
+
+    def release(self, started, overloaded=False, latency=None):
+        """คืนสิทธิ์ของคำขอ (overloaded=True เมื่อ timeout หรือ API รับไม่ไหว, latency ของคำขอที่สำเร็จใช้ปรับ limit)"""
+        baseline = self.latency.percentile(10) if self.latency is not None and latency is not None else None
+        with self._cond:
+            saturated = self._in_flight >= int(self._limit)
+            self._in_flight -= 1
+            if overloaded:
+                if started >= self._last_decrease:
+                    previous = int(self._limit)
+                    self._limit = max(self.min_limit, self._limit * self.decrease_factor)
+                    self._last_decrease = time.monotonic()
+                    logger.warning(f"📉 API ตอบช้า/ผิดพลาด ลดจำนวนคำขอพร้อมกันจาก {previous} เหลือ {int(self._limit)}")
+            elif latency is not None and saturated and (baseline is None or latency <= baseline * self.latency_tolerance):
+                self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+            self._cond.notify_all()
+
+    @property
+    def saturated(self):
+        """True เมื่อคำขอที่ทำงานอยู่เต็ม limit (คำขอใหม่ต้องรอ)"""
+        with self._cond:
+            return self._in_flight >= int(self._limit)
+
+    def snapshot(self):
+        with self._cond:
+            return {'limit': int(self._limit), 'in_flight': self._in_flight, 'min': self.min_limit, 'max': self.max_limit}
+
+api_breaker = CircuitBreaker(SOLARWINDS_API_BREAKER_THRESHOLD, SOLARWINDS_API_BREAKER_RESET)
+api_latency = LatencyTracker()
+api_concurrency = AdaptiveConcurrencyLimit(FETCH_WORKERS, min_limit=SOLARWINDS_API_MIN_CONCURRENCY, max_limit=SOLARWINDS_API_MAX_CONCURRENCY,
+                                           decrease_factor=SOLARWINDS_API_DECREASE_FACTOR,
+                                           latency_tolerance=SOLARWINDS_API_LATENCY_TOLERANCE, latency=api_latency)
+# thread สำหรับคำขอแรกและคำขอซ้ำเมื่อเปิด hedged request (คำขอซ้ำพร้อมกันไม่เกิน SOLARWINDS_API_HEDGE_BUDGET)
+hedge_executor = (ThreadPoolExecutor(max_workers=SOLARWINDS_API_MAX_CONCURRENCY + SOLARWINDS_API_HEDGE_BUDGET, thread_name_prefix="api-hedge")
+                  if SOLARWINDS_API_HEDGE else None)
+hedge_budget = threading.BoundedSemaphore(SOLARWINDS_API_HEDGE_BUDGET)
+
+# --- Cache ผลลัพธ์ circuitStatus บนดิสก์ ---
+response_cache = CircuitResponseCache(CACHE_DB_PATH, ttl_seconds=CACHE_TTL_SECONDS, max_bytes=CACHE_MAX_BYTES)
+
+# --- รวมคำขอวงจรเดียวกันที่ทำงานพร้อมกัน (single-flight) ---
+class SingleFlight:
+    """ให้คำขอที่มี key เดียวกันและทำงานพร้อมกันใช้ผลลัพธ์จากการเรียกครั้งเดียว"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn, *args):
+        """คืนค่า (ผลลัพธ์, shared) โดย shared เป็น True หากได้ผลร่วมกับคำขอที่กำลังทำงานอยู่"""
+        with self._lock:
+            future = self._calls.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = Future()
+                self._calls[key] = future
+        if not is_leader:
+            return future.result(), True
+
+        try:
+            result = fn(*args)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+        return result, False
+
+# ใช้ร่วมกันทุกงานใน process เพื่อไม่ให้ดึง/แปลงข้อมูลวงจรเดียวกันซ้ำซ้อน
+circuit_flight = SingleFlight()
+
+# --- thread ดึงข้อมูลที่ใช้ร่วมกันทุกงาน ---
+class FairFetchPool:
+    """thread ดึงข้อมูล workers ตัวที่ทุกงานใช้ร่วมกัน หยิบคำขอจากคิวของแต่ละงานสลับกัน (จำกัดต่องานได้ด้วย max_running)"""
+    def __init__(self, workers):
+        self.workers = workers
+        self._cond = threading.Condition()
+        self._queues = OrderedDict() # job_id -> deque ของ (future, fn, args)
+        self._running = Counter() # job_id -> จำนวนคำขอที่กำลังทำงาน
+        self._limits = {} # job_id -> max_running
+        self._threads = []
+
+    def submit(self, job_id, fn, *args, max_running=None):
+        future = Future()
+        with self._cond:
+            self._queues.setdefault(job_id, deque()).append((future, fn, args))
+            if max_running is not None:
+                self._limits[job_id] = max(1, max_running)
+            if len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._worker, name=f"fetch-{len(self._threads)}", daemon=True)
+                self._threads.append(thread)
+                thread.start()
+            self._cond.notify()
+        return future
+
+    def cancel(self, job_id):
+        """ยกเลิกคำขอของงานที่ยังไม่เริ่มทำงาน (คำขอที่กำลังทำงานอยู่จะทำต่อจนเสร็จ)"""
+        with self._cond:
+            tasks = self._queues.pop(job_id, ())
+            if not self._running[job_id]:
+                self._limits.pop(job_id, None)
+        for future, _, _ in tasks:
+            future.cancel()
+
+    def _next_task(self):
+        # คิวแรกตามลำดับ round-robin ที่งานยังมีคำขอทำงานอยู่น้อยกว่า max_running (None หากไม่มี)
+        for job_id, tasks in self._queues.items():
+            if self._running[job_id] < self._limits.get(job_id, self.workers):
+                break
+        else:
+            return None, None
+        task = tasks.popleft()
+        if tasks:
+            self._queues.move_to_end(job_id)
+        else:
+            del self._queues[job_id]
+        self._running[job_id] += 1
+        return job_id, task
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                job_id, task = self._next_task()
+                while task is None:
+                    self._cond.wait()
+                    job_id, task = self._next_task()
+            future, fn, args = task
+            try:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    result = fn(*args)
+                except BaseException as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+            finally:
+                with self._cond:
+                    self._running[job_id] -= 1
+                    if not self._running[job_id]:
+                        del self._running[job_id]
+                        if job_id not in self._queues:
+                            self._limits.pop(job_id, None)
+                    self._cond.notify_all()
+
+fetch_pool = FairFetchPool(SOLARWINDS_API_MAX_CONCURRENCY) # จำนวนคำขอ API จริงถูกจำกัดอีกชั้นด้วย api_concurrency
+
+# --- ฟังก์ชันสำหรับประมวลผลข้อมูล ---
+def extract_soap_return(chunks):
+    """คืนข้อความใน <return> ทันทีที่ parse ถึงจาก chunk ของ SOAP response (None หากไม่พบ XML, '' หาก <return> ว่าง)"""
+    parser = None
+    head = b""
+    for chunk in chunks:
+        if not chunk:
+            continue
+        if parser is None:
+            head += chunk
+            start = head.find(b"<?xml")
+            if start < 0:
+                head = head[-4:] # เผื่อกรณี '<?xml' ถูกตัดคร่อมระหว่าง chunk
+                continue
+            parser = ET.XMLPullParser(events=("end",))
+            chunk = head[start:]
+            head = b""
+        parser.feed(chunk)
+        for _, elem in parser.read_events():
+            if elem.tag == "return" or elem.tag.endswith("}return"):
+                return elem.text or ""
+    if parser is None:
+        return None
+    parser.close() # raise ET.ParseError หาก XML ไม่สมบูรณ์
+    return ""
+
+def _decode_return_text_legacy(raw_text):
+    """วิธี decode แบบเดิม: html.unescape -> unicode_escape -> ftfy ทั้งก้อน -> json.loads"""
+    html_unescaped = html.unescape(raw_text)
+    fixed_text = fix_text(bytes(html_unescaped, "utf-8").decode("unicode_escape"))
+    return json.loads(fixed_text)
+
+@functools.lru_cache(maxsize=4096)
+def _fix_mojibake(value):
+    # ค่าอย่าง Address ซ้ำกันทุกชั่วโมง จึงตรวจ/แก้เพียงครั้งเดียวต่อข้อความ
+    return fix_text(value) if is_bad(value) else value
+
+def _fix_mojibake_values(value):
+    if isinstance(value, str):
+        return value if value.isascii() else _fix_mojibake(value)
+    if isinstance(value, list):
+        return [_fix_mojibake_values(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _fix_mojibake_values(v) for k, v in value.items()}
+    return value
+
+def decode_return_text(raw_text):
+    """แปลงข้อความใน <return> เป็น JSON ในรอบเดียว โดยเรียก ftfy เฉพาะข้อความที่มี mojibake"""
+    text = html.unescape(raw_text) if "&" in raw_text else raw_text
+    try:
+        parsed_json = json.loads(text)
+    except json.JSONDecodeError:
+        return _decode_return_text_legacy(raw_text)
+    return _fix_mojibake_values(parsed_json)
+
+def fetch_soap_return(nod_id, itf_id, hedge=False):
+    """เรียก circuitStatus หนึ่งครั้งภายใต้ api_concurrency คืนข้อความใน <return> (hedge=True ไม่ใช้สิทธิ์และไม่ปรับ limit)"""
+    started = api_concurrency.acquire() if not hedge else time.monotonic()
     try:
-        resp = requests.post(url, data=body, headers=headers, timeout=10)
-        resp.raise_for_status()
-        match = re.search(r"(<\?xml.*?</SOAP-ENV:Envelope>)", resp.text, re.DOTALL)
-        if not match:
+        with soap_client.circuit_status(nod_id, itf_id, stream=True) as resp:
+            chunks = resp.iter_content(chunk_size=SOAP_CHUNK_SIZE)
+            raw_text = extract_soap_return(chunks)
+            for _ in chunks: # อ่านส่วนที่เหลือให้หมด เพื่อคืน connection กลับเข้า pool
+                pass
+    except BaseException as e:
+        if not hedge:
+            api_concurrency.release(started, overloaded=_is_retryable_api_error(e))
+        service_metrics.observe('api_wait', time.monotonic() - started)
+        service_metrics.inc('solarwind_api_requests_total', 'error')
+        service_metrics.inc('solarwind_api_errors_total', _api_error_kind(e))
+        raise
+    latency = time.monotonic() - started
+    if not hedge:
+        api_concurrency.release(started, latency=latency)
+    api_latency.record(latency)
+    service_metrics.observe('api_wait', latency)
+    service_metrics.inc('solarwind_api_requests_total', 'ok')
+    return raw_text
+
+def _fetch_soap_return_hedged(nod_id, itf_id):
+    """ส่งคำขอซ้ำเมื่อคำขอแรกช้ากว่า percentile ที่กำหนด (ภายใต้ hedge_budget) แล้วใช้ผลที่สำเร็จก่อน"""
+    delay = api_latency.percentile(SOLARWINDS_API_HEDGE_PERCENTILE) if hedge_executor is not None else None
+    if delay is None:
+        return fetch_soap_return(nod_id, itf_id)
+    futures = [hedge_executor.submit(contextvars.copy_context().run, fetch_soap_return, nod_id, itf_id)]
+    done, _ = wait_futures(futures, timeout=delay)
+    if not done and not api_breaker.is_open and not api_concurrency.saturated and hedge_budget.acquire(blocking=False):
+        logger.info(f"⏱️ NodeID: {nod_id}, Interface ID: {itf_id} ตอบช้ากว่า {delay:.2f} วินาที ส่งคำขอซ้ำ")
+        hedged = hedge_executor.submit(contextvars.copy_context().run, fetch_soap_return, nod_id, itf_id, True)
+        hedged.add_done_callback(lambda _: hedge_budget.release())
+        futures.append(hedged)
+        service_metrics.inc('solarwind_api_hedged_requests_total')
+    pending = set(futures)
+    while pending:
+        done, pending = wait_futures(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                return future.result()
+    return futures[0].result() # ล้มเหลวทุกคำขอ: raise ข้อผิดพลาดของคำขอแรก
+
+def _is_retryable_api_error(error):
+    """ข้อผิดพลาดชั่วคราวที่ควรลองใหม่: เชื่อมต่อไม่ได้, timeout, response ขาดกลางคัน และ HTTP 5xx/429"""
+    if isinstance(error, requests.exceptions.HTTPError):
+        status = error.response.status_code if error.response is not None else None
+        return status is None or status >= 500 or status == 429
+    return isinstance(error, requests.exceptions.RequestException)
+
+def _api_error_kind(error):
+    """ชนิดของข้อผิดพลาดจาก API สำหรับ label ของ solarwind_api_errors_total"""
+    if isinstance(error, requests.exceptions.HTTPError):
+        status = error.response.status_code if error.response is not None else None
+        return f"http_{status // 100}xx" if status else 'http'
+    if isinstance(error, requests.exceptions.Timeout):
+        return 'timeout'
+    if isinstance(error, requests.exceptions.ConnectionError):
+        return 'connection'
+    if isinstance(error, requests.exceptions.RequestException):
+        return 'request'
+    if isinstance(error, ET.ParseError):
+        return 'xml'
+    return 'other'
+
+def fetch_soap_return_with_retry(nod_id, itf_id):
+    """เรียก API ผ่าน circuit breaker และลองใหม่เมื่อเป็นข้อผิดพลาดชั่วคราว (raise ข้อผิดพลาดสุดท้ายเมื่อไม่สำเร็จ)"""
+    for attempt in range(SOLARWINDS_API_MAX_ATTEMPTS):
+        if not api_breaker.allow(SOLARWINDS_API_BREAKER_MAX_WAIT):
+            service_metrics.inc('solarwind_api_errors_total', 'breaker_open')
+            raise requests.exceptions.ConnectionError(f"API ไม่ตอบสนองนานเกิน {SOLARWINDS_API_BREAKER_MAX_WAIT:g} วินาที (circuit breaker)")
+        try:
+            raw_text = _fetch_soap_return_hedged(nod_id, itf_id)
+        except Exception as e:
+            if not _is_retryable_api_error(e):
+                api_breaker.record_success() # API ตอบกลับมา (ข้อผิดพลาดเฉพาะคำขอนี้)
+                raise
+            api_breaker.record_failure()
+            if attempt + 1 >= SOLARWINDS_API_MAX_ATTEMPTS:
+                raise
+            delay = random.uniform(0, min(SOLARWINDS_API_RETRY_MAX, SOLARWINDS_API_RETRY_BASE * 2 ** attempt))
+            logger.warning(f"🔁 ดึงข้อมูล NodeID: {nod_id}, Interface ID: {itf_id} ไม่สำเร็จ ({e}) ลองใหม่ใน {delay:.1f} วินาที "
+                           f"(ครั้งที่ {attempt + 2}/{SOLARWINDS_API_MAX_ATTEMPTS})")
+            service_metrics.inc('solarwind_api_retries_total')
+            time.sleep(delay)
+        else:
+            api_breaker.record_success()
+            return raw_text
+
+def get_data_from_api(nod_id, itf_id, job_id):
+    """ดึงข้อมูลจาก API และแปลงเป็น JSON (ลองใหม่เมื่อเกิดข้อผิดพลาดชั่วคราว ดู fetch_soap_return_with_retry)"""
+    try:
+        raw_text = fetch_soap_return_with_retry(nod_id, itf_id)
+        if raw_text is None:
             logger.warning(f"ไม่พบ XML Response สำหรับ NodeID: {nod_id}, Interface ID: {itf_id}")
             return None
-        
-        root = ET.fromstring(match.group(1))
-        return_tag = root.find(".//{*}return")
-        if return_tag is None or not return_tag.text:
+        if not raw_text:
             logger.warning(f"API ไม่มีข้อมูลตอบกลับสำหรับ NodeID: {nod_id}, Interface ID: {itf_id}")
             return None
 
-        raw_text = return_tag.text
-        html_unescaped = html.unescape(raw_text)
-        fixed_text = fix_text(bytes(html_unescaped, "utf-8").decode("unicode_escape"))
-        parsed_json = json.loads(fixed_text)
-        return parsed_json
+        with service_metrics.time('soap_decode'):
+            return decode_return_text(raw_text)
     except requests.exceptions.RequestException as req_e:
         logger.error(f"❌ ดึงข้อมูล NodeID: {nod_id}, Interface ID: {itf_id} ล้มเหลว: {req_e}")
         return None
@@ -145,600 +1211,1556 @@ def get_data_from_api(nod_id, itf_id, job_id):
         logger.error(f"❌ XML Parsing ผิดพลาดสำหรับ NodeID: {nod_id}, Interface ID: {itf_id}: {parse_e}")
         return None
     except json.JSONDecodeError as json_e:
+        service_metrics.inc('solarwind_api_errors_total', 'json')
         logger.error(f"❌ JSON Decoding ผิดพลาดสำหรับ NodeID: {nod_id}, Interface ID: {itf_id}: {json_e}")
         return None
     except Exception as e:
         logger.error(f"❌ ข้อผิดพลาดไม่คาดคิดสำหรับ NodeID: {nod_id}, Interface ID: {itf_id}: {e}")
         return None
 
-def process_json_data(raw_json_data, job_id):
-    """ประมวลผลข้อมูล JSON เพื่อให้พร้อมสำหรับสร้างไฟล์"""
-    column_mapping = {
-        "รหัสหน่วยงาน": "Customer_Curcuit_ID",
-        "ชื่อหน่วยงาน": "Address",
-        "วันที่และเวลา": "Timestamp",
-        "ขนาดBandwidth (หน่วย Mbps)": "Bandwidth",
-        "ปริมาณการใช้งาน incoming (หน่วย bps)": "In_Averagebps",
-        "ปริมาณการใช้งาน outcoming (หน่วย bps)": "Out_Averagebps"
-    }
-    desired_headers_th = list(column_mapping.keys())
-    
-    # ตรวจสอบว่า raw_json_data เป็น list หรือ dict
-    data_to_process = raw_json_data if isinstance(raw_json_data, list) else [raw_json_data]
-
-    # --- Step 1: Parse all existing timestamps and find earliest/latest dates ---
-    formatted_data = []
-    earliest_json_date = None
-    latest_json_date = None
+def _count_cache_access(job_id, outcome):
+    current_job_store.get().increment(job_id, f"cache_{outcome}")
+    service_metrics.inc('solarwind_cache_requests_total', outcome, job_id=job_id)
 
-    for item in data_to_process:
-        date_time_value = item.get("Timestamp")
-        if isinstance(date_time_value, dict) and 'date' in date_time_value:
-            try:
-                # Parse timestamp from JSON string. Keep original format to reconstruct for output
-                dt_obj = datetime.datetime.strptime(date_time_value['date'], '%Y-%m-%d %H:%M:%S.%f')
-                formatted_item = item.copy()
-                formatted_item['Parsed_Timestamp'] = dt_obj
-                formatted_data.append(formatted_item)
-
-                if earliest_json_date is None or dt_obj < earliest_json_date:
-                    earliest_json_date = dt_obj
-                if latest_json_date is None or dt_obj > latest_json_date:
-                    latest_json_date = dt_obj
-            except ValueError:
-                # If date parsing fails, just add the item without a parsed timestamp
-                # These items won't be considered for filling gaps
-                formatted_data.append(item.copy()) 
-                logger.warning(f"⚠️ ไม่สามารถ parse วันที่ได้: {date_time_value.get('date')}. รายการนี้จะถูกข้ามการเติมข้อมูล.")
+def _count_coalesced(job_id):
+    current_job_store.get().increment(job_id, 'coalesced')
 
-        else:
-            # If 'Timestamp' is not a dict or 'date' is missing, add as is
-            formatted_data.append(item.copy())
-
-    # If no valid dates were found, just process the raw data as is
-    if earliest_json_date is None or latest_json_date is None:
-        logger.warning(f"ไม่พบข้อมูลวันที่ที่ถูกต้องใน JSON สำหรับการเติมวันที่/ชั่วโมงที่ขาดหายไป")
-        processed_data = []
-        for item in data_to_process: # Use original data_to_process to ensure all items are included
-            row_data = {}
-            for th_header, json_key in column_mapping.items():
-                value = item.get(json_key, '')
-                if th_header in ["ปริมาณการใช้งาน incoming (หน่วย bps)", "ปริมาณการใช้งาน outcoming (หน่วย bps)"]:
-                    try:
-                        value_float = float(value)
-                        row_data[th_header] = f"{int(value_float):,}" # Format with comma
-                    except (ValueError, TypeError):
-                        row_data[th_header] = str(value)
-                elif th_header == "วันที่และเวลา" and isinstance(value, dict) and 'date' in value:
-                    try:
-                        dt_obj = datetime.datetime.strptime(value['date'], '%Y-%m-%d %H:%M:%S.%f')
-                        row_data[th_header] = dt_obj.strftime('%Y-%m-%d %H.%M.%S')
-                    except ValueError:
-                        row_data[th_header] = str(value)
-                elif th_header == "ขนาดBandwidth (หน่วย Mbps)":
-                    if "FTTx" in str(value):
-                        row_data[th_header] = "20 Mbps." # Changed from 0 Mbps.
-                    else:
-                        try:
-                            numeric_value = float(re.search(r'[\d.]+', str(value)).group())
-                            row_data[th_header] = f"{int(numeric_value):,} Mbps." # Format with comma
-                        except (ValueError, TypeError, AttributeError):
-                            row_data[th_header] = str(value)
-                else:
-                    row_data[th_header] = str(value)
-            processed_data.append(row_data)
-        return desired_headers_th, processed_data, {} # Return empty averages
-
-    # --- Step 2: Determine the full time range for filling ---
-    first_day_of_month_start_hour = earliest_json_date.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-    # The end point for filling is the last hour of the latest_json_date
-    # We want to fill up to and including the last full hour of the latest data.
-    # If latest_json_date is 2025-07-13 10:30:00, we want to fill up to 2025-07-13 23:00:00
-    last_day_of_data_end_hour = latest_json_date.replace(hour=23, minute=0, second=0, microsecond=0)
-
-
-    # --- Step 3: Get common data for new entries (customer ID, name, bandwidth) ---
-    first_actual_entry = None
-    for item in formatted_data:
-        if 'Parsed_Timestamp' in item: # Find the first entry that actually has a parsed timestamp
-            first_actual_entry = item
-            break
-    
-    # Use default empty strings if no valid first entry is found
-    customer_id = first_actual_entry.get("Customer_Curcuit_ID", "") if first_actual_entry else ""
-    customer_name = first_actual_entry.get("Address", "") if first_actual_entry else ""
-    bandwidth = first_actual_entry.get("Bandwidth", "") if first_actual_entry else ""
-
-    # --- Step 4: Create a set of existing date-hour combinations for quick lookup ---
-    existing_date_hours = set()
-    for item in formatted_data:
-        if 'Parsed_Timestamp' in item:
-            existing_date_hours.add(item['Parsed_Timestamp'].replace(minute=0, second=0, microsecond=0)) # Store only year, month, day, hour
-
-    # --- Step 5: Generate and fill in missing entries ---
-    dates_to_add_data = []
-    current_hour_dt = first_day_of_month_start_hour
-
-    # Loop from the first hour of the month to the last hour of the latest data day
-    while current_hour_dt <= last_day_of_data_end_hour:
-        if current_hour_dt not in existing_date_hours:
-            # Create a new entry for the missing hour
-            missing_entry = {
-                "Customer_Curcuit_ID": customer_id,
-                "Address": customer_name,
-                "Timestamp": {"date": current_hour_dt.strftime('%Y-%m-%d %H:%M:%S.%f')},
-                "Bandwidth": bandwidth,
-                "In_Averagebps": "0",
-                "Out_Averagebps": "0",
-                "Parsed_Timestamp": current_hour_dt
-            }
-            dates_to_add_data.append(missing_entry)
-            logger.info(f"✨ เพิ่มข้อมูลสำหรับชั่วโมงที่ขาดหายไป: {current_hour_dt.strftime('%Y-%m-%d %H:%M')}")
-        current_hour_dt += datetime.timedelta(hours=1) # Move to the next hour
-    
-    # --- Step 6: Combine all data and sort by timestamp ---
-    combined_data = dates_to_add_data + formatted_data
-    
-    # Ensure all data is sorted by the parsed timestamp
-    # Filter out items that might not have a Parsed_Timestamp due to parsing errors
-    sorted_combined_data = sorted(
-        [item for item in combined_data if 'Parsed_Timestamp' in item],
-        key=lambda x: x['Parsed_Timestamp']
-    )
-
-    # --- Step 7: Calculate monthly averages for In_Averagebps and Out_Averagebps ---
-    total_sum_in = 0
-    total_count_in = 0
-    total_sum_out = 0
-    total_count_out = 0
-
-    for item in sorted_combined_data:
+def fetch_circuit_data(nod_id, itf_id, job_id, report_month):
+    """ดึงข้อมูลของวงจร (cache ก่อน ไม่มีจึงเรียก API แล้วบันทึกลง cache) คืนค่า (ข้อมูล, 'hits' หรือ 'misses')"""
+    try:
+        cached = response_cache.get(nod_id, itf_id, report_month)
+    except Exception as e:
+        logger.warning(f"⚠️ อ่าน cache ไม่สำเร็จสำหรับ NodeID: {nod_id}, Interface ID: {itf_id}: {e}")
+        cached = None
+    if cached is not None:
+        logger.info(f"💾 ใช้ข้อมูลจาก cache สำหรับ NodeID: {nod_id}, Interface ID: {itf_id} ({report_month})")
+        return cached, 'hits'
+
+    raw_json_data = get_data_from_api(nod_id, itf_id, job_id)
+    if raw_json_data:
         try:
-            in_bps = float(item.get("In_Averagebps", 0))
-            total_sum_in += in_bps
-            total_count_in += 1
-        except (ValueError, TypeError):
-            pass # Ignore non-numeric values
-
+            cached_month = response_cache.put(nod_id, itf_id, raw_json_data)
+            if cached_month and cached_month != report_month:
+                logger.info(f"ℹ️ ข้อมูลของ NodeID: {nod_id}, Interface ID: {itf_id} เป็นของเดือน {cached_month} ไม่ตรงกับเดือนของรายงาน ({report_month})")
+        except Exception as e:
+            logger.warning(f"⚠️ บันทึก cache ไม่สำเร็จสำหรับ NodeID: {nod_id}, Interface ID: {itf_id}: {e}")
+    return raw_json_data, 'misses'
+
+def fetch_circuit_shared(nod_id, itf_id, job_id, report_month):
+    """fetch_circuit_data ที่รวมคำขอวงจรเดียวกันซึ่งทำงานพร้อมกันเป็นครั้งเดียว (ผลใช้ร่วมกัน ห้ามแก้ไข)"""
+    (result, outcome), shared = circuit_flight.do((nod_id, itf_id, report_month), fetch_circuit_data, nod_id, itf_id, job_id, report_month)
+    _count_cache_access(job_id, outcome)
+    if shared:
+        _count_coalesced(job_id)
+        logger.info(f"🔁 ใช้ข้อมูลร่วมกับคำขอที่กำลังดึงอยู่สำหรับ NodeID: {nod_id}, Interface ID: {itf_id}")
+    return result
+
+def load_circuit(nod_id, itf_id, job_id, report_month, report_mode='full'):
+    """ดึงและแปลงข้อมูลของวงจรหนึ่งวงจร คืนค่า (headers, processed_data, monthly_averages) หรือ None"""
+    raw_json_data = fetch_circuit_shared(nod_id, itf_id, job_id, report_month)
+    if not raw_json_data:
+        return None
+    if report_mode == 'incremental':
+        with service_metrics.time('transform', job_id):
+            return transform_month_to_date(raw_json_data, nod_id, itf_id, job_id, report_month)
+    series = []
+    with service_metrics.time('transform', job_id):
+        circuit_result = process_json_data(raw_json_data, job_id, series)
+    record_circuit_traffic(nod_id, itf_id, series[0])
+    return circuit_result
+
+# --- การประมวลผลข้อมูลรายชั่วโมง (columnar ด้วย pandas/NumPy) ---
+# หัวตารางภาษาไทย -> key ใน JSON
+REPORT_COLUMN_MAPPING = {
+    "รหัสหน่วยงาน": "Customer_Curcuit_ID",
+    "ชื่อหน่วยงาน": "Address",
+    "วันที่และเวลา": "Timestamp",
+    "ขนาดBandwidth (หน่วย Mbps)": "Bandwidth",
+    "ปริมาณการใช้งาน incoming (หน่วย bps)": "In_Averagebps",
+    "ปริมาณการใช้งาน outcoming (หน่วย bps)": "Out_Averagebps"
+}
+REPORT_HEADERS = list(REPORT_COLUMN_MAPPING.keys())
+JSON_TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+_CIRCUIT_KEY_STRIDE = np.int64(1) << 32 # ใช้รวมเลขวงจรกับเลขชั่วโมงเป็น key เดียว
+_MISSING_VALUE = object() # แทน key ที่ไม่มีใน JSON (แสดงผลเป็น '' แต่นับเป็น 0 ในค่าเฉลี่ย)
+
+def _format_bandwidth(value):
+    """แปลงค่า Bandwidth เป็น 'x,xxx Mbps.' (วงจร FTTx แสดงเป็น 20 Mbps.)"""
+    text = str(value)
+    if "FTTx" in text:
+        return "20 Mbps." # Changed from 0 Mbps.
+    try:
+        numeric_value = float(re.search(r'[\d.]+', text).group())
+        return f"{int(numeric_value):,} Mbps." # Format with comma
+    except (ValueError, TypeError, AttributeError):
+        return text
+
+def _bandwidth_mbps(value):
+    """ค่า Bandwidth เป็นตัวเลข (Mbps) ตามกฎเดียวกับ _format_bandwidth หรือ NaN หากแปลงไม่ได้"""
+    text = str(value)
+    if "FTTx" in text:
+        return 20.0
+    try:
+        return float(re.search(r'[\d.]+', text).group())
+    except (ValueError, TypeError, AttributeError):
+        return np.nan
+
+def _format_bandwidth_column(values):
+    # ค่า Bandwidth ของวงจรหนึ่งมักซ้ำกันทุกชั่วโมง จึงจัดรูปแบบเฉพาะค่าที่ไม่ซ้ำแล้วกระจายกลับ
+    codes, uniques = pd.factorize(np.array([str(v) for v in values], dtype=object))
+    formatted = np.array([_format_bandwidth(u) for u in uniques], dtype=object)
+    return formatted[codes]
+
+def _to_float_column(values):
+    """แปลงค่าเป็น float ด้วยกฎเดียวกับ float() คืนค่า (array, mask ของค่าที่แปลงได้)"""
+    try:
+        numbers = np.array(values, dtype=float)
+        converted = np.ones(len(values), dtype=bool)
+        suspects = np.flatnonzero(np.isnan(numbers)) # NumPy แปลง None เป็น NaN ได้ แต่ float(None) ไม่ได้
+    except (ValueError, TypeError):
+        numbers = np.full(len(values), np.nan)
+        converted = np.zeros(len(values), dtype=bool)
+        suspects = range(len(values))
+    for i in suspects:
         try:
-            out_bps = float(item.get("Out_Averagebps", 0))
-            total_sum_out += out_bps
-            total_count_out += 1
+            numbers[i] = float(values[i])
+            converted[i] = True
         except (ValueError, TypeError):
-            pass # Ignore non-numeric values
-    
+            converted[i] = False
+    return numbers, converted
+
+def _format_bps_column(values, numbers, converted):
+    """จัดรูปแบบ bps เป็นจำนวนเต็มมี comma ค่าที่ไม่ใช่ตัวเลขแสดงตามเดิม"""
+    formatted = np.empty(len(values), dtype=object)
+    finite = converted & np.isfinite(numbers)
+    truncated = np.trunc(numbers[finite])
+    if truncated.size and np.abs(truncated).max() < 2**63:
+        formatted[finite] = list(map('{:,}'.format, truncated.astype(np.int64).tolist()))
+    else:
+        formatted[finite] = [f"{int(v):,}" for v in truncated.tolist()]
+    for i in np.flatnonzero(~finite):
+        formatted[i] = '' if values[i] is _MISSING_VALUE else str(values[i])
+    return formatted
+
+def _parse_json_timestamps(date_values):
+    """แปลง Timestamp['date'] เป็น datetime64[ns] ทั้งชุด (NaT สำหรับค่าที่ parse ไม่ได้)"""
+    is_text = np.array([isinstance(v, str) for v in date_values], dtype=bool)
+    texts = pd.Series([v if ok else None for v, ok in zip(date_values, is_text)], dtype=object)
+    parsed = pd.to_datetime(texts, format=JSON_TIMESTAMP_FORMAT, errors='coerce').to_numpy(dtype='datetime64[ns]')
+    # ข้อความที่ pandas parse ไม่ได้ ให้ลองด้วย strptime อีกครั้ง (รูปแบบที่ยืดหยุ่นกว่า เช่น เดือนหลักเดียว)
+    for i in np.flatnonzero(is_text & np.isnat(parsed)):
+        try:
+            parsed[i] = np.datetime64(datetime.datetime.strptime(date_values[i], JSON_TIMESTAMP_FORMAT), 'ns')
+        except ValueError:
+            pass
+    return parsed, is_text & np.isnat(parsed)
+
+def _format_report_timestamps(timestamps):
+    """จัดรูปแบบ datetime64 เป็น REPORT_TIMESTAMP_FORMAT ('2025-07-01 13.00.00') ทั้งชุด"""
+    # np.datetime_as_string เร็วกว่า strftime มาก ได้ '2025-07-01T13:00:00' แล้วแทนที่ตัวคั่นให้ตรงรูปแบบเดิม
+    return [text.replace('T', ' ').replace(':', '.') for text in np.datetime_as_string(timestamps, unit='s').tolist()]
+
+def _sequential_sum(values):
+    # บวกค่าตามลำดับแบบเดียวกับลูปเดิม (np.sum ใช้ pairwise summation ซึ่งอาจปัดเศษต่างกัน)
+    return float(np.add.accumulate(values)[-1]) if values.size else 0.0
+
+def _average_inputs(values, numbers, converted):
+    # key ที่ไม่มีใน JSON นับเป็น 0 ในค่าเฉลี่ย เหมือน item.get("In_Averagebps", 0) ของเดิม
+    absent = values == _MISSING_VALUE
+    if absent.any():
+        numbers = np.where(absent, 0.0, numbers)
+        converted = converted | absent
+    return numbers, converted
+
+def _monthly_averages(in_numbers, in_converted, out_numbers, out_converted):
+    count_in = int(in_converted.sum())
+    count_out = int(out_converted.sum())
+    if count_in > 0 and count_out > 0:
+        return {
+            "avg_in_month": int(_sequential_sum(in_numbers[in_converted]) / count_in),
+            "avg_out_month": int(_sequential_sum(out_numbers[out_converted]) / count_out)
+        }
+    return {}
+
+def _traffic_series(columns, real, complete):
+    """ค่ารายชั่วโมงที่เป็นตัวเลขของวงจรหนึ่งสำหรับ TrafficTimeSeriesStore (complete=False หากเป็นเฉพาะชั่วโมงที่เพิ่มขึ้น)"""
+    first = int(np.argmax(real)) if real.any() else 0
+    codes, uniques = pd.factorize(np.array([str(v) for v in columns['Bandwidth'][real].tolist()], dtype=object))
+    return {
+        'hours': columns['ts'][real].astype('datetime64[h]'),
+        'in_bps': np.where(columns['in_converted'], columns['in_numbers'], np.nan)[real],
+        'out_bps': np.where(columns['out_converted'], columns['out_numbers'], np.nan)[real],
+        'bandwidth_mbps': np.array([_bandwidth_mbps(u) for u in uniques], dtype=float)[codes] if len(codes) else np.empty(0),
+        'customer_id': str(columns['Customer_Curcuit_ID'][first]) if real.any() else '',
+        'address': str(columns['Address'][first]) if real.any() else '',
+        'complete': complete,
+    }
+
+def _format_rows(columns, timestamp_column):
+    """แปลงข้อมูลรายคอลัมน์ (dict ของ array ที่เรียงแล้ว) เป็น list ของ dict ตามหัวตารางภาษาไทย"""
+    in_values = columns['In_Averagebps'].tolist()
+    out_values = columns['Out_Averagebps'].tolist()
+    columns = [
+        [str(v) for v in columns['Customer_Curcuit_ID'].tolist()],
+        [str(v) for v in columns['Address'].tolist()],
+        timestamp_column,
+        _format_bandwidth_column(columns['Bandwidth'].tolist()),
+        _format_bps_column(in_values, columns['in_numbers'], columns['in_converted']),
+        _format_bps_column(out_values, columns['out_numbers'], columns['out_converted']),
+    ]
+    return [dict(zip(REPORT_HEADERS, row)) for row in zip(*columns)]
+
+def process_json_batch(raw_json_batch, job_id, series=None):
+    """ประมวลผลข้อมูล JSON ของหลายวงจรใน DataFrame เดียว คืนค่า list ของ (headers, processed_data, monthly_averages) ตามลำดับเดิม"""
+    items_per_circuit = [raw if isinstance(raw, list) else [raw] for raw in raw_json_batch]
+    items = [item for circuit_items in items_per_circuit for item in circuit_items]
+    timestamps = [item.get("Timestamp") for item in items]
+    date_values = [ts['date'] if isinstance(ts, dict) and 'date' in ts else None for ts in timestamps]
+    parsed, unparsable = _parse_json_timestamps(date_values)
+
+    frame = pd.DataFrame({
+        'circuit': np.repeat(np.arange(len(items_per_circuit)), [len(circuit_items) for circuit_items in items_per_circuit]),
+        'ts': parsed,
+        'Customer_Curcuit_ID': pd.Series([item.get("Customer_Curcuit_ID", '') for item in items], dtype=object),
+        'Address': pd.Series([item.get("Address", '') for item in items], dtype=object),
+        'Bandwidth': pd.Series([item.get("Bandwidth", '') for item in items], dtype=object),
+        'In_Averagebps': pd.Series([item.get("In_Averagebps", _MISSING_VALUE) for item in items], dtype=object),
+        'Out_Averagebps': pd.Series([item.get("Out_Averagebps", _MISSING_VALUE) for item in items], dtype=object),
+    })
+    if unparsable.any():
+        sample = date_values[int(np.flatnonzero(unparsable)[0])]
+        logger.warning(f"⚠️ ไม่สามารถ parse วันที่ได้ {int(unparsable.sum())} รายการ (เช่น {sample}). รายการเหล่านี้จะถูกข้ามการเติมข้อมูล.")
+
+    valid = frame[~np.isnat(parsed)]
+    results = [None] * len(items_per_circuit)
+    if series is not None:
+        series_offset = len(series)
+        series.extend([None] * len(items_per_circuit))
+
+    # --- วงจรที่ไม่มีวันที่ที่ถูกต้องเลย: แสดงข้อมูลตามลำดับเดิม โดยไม่เติมชั่วโมงและไม่มีค่าเฉลี่ย ---
+    circuits_with_dates = set(valid['circuit'].unique().tolist())
+    for circuit_index in range(len(items_per_circuit)):
+        if circuit_index in circuits_with_dates:
+            continue
+        logger.warning("ไม่พบข้อมูลวันที่ที่ถูกต้องใน JSON สำหรับการเติมวันที่/ชั่วโมงที่ขาดหายไป")
+        circuit_frame = frame[frame['circuit'] == circuit_index]
+        circuit_columns = {column: circuit_frame[column].to_numpy() for column in circuit_frame.columns}
+        circuit_columns['in_numbers'], circuit_columns['in_converted'] = _to_float_column(circuit_columns['In_Averagebps'].tolist())
+        circuit_columns['out_numbers'], circuit_columns['out_converted'] = _to_float_column(circuit_columns['Out_Averagebps'].tolist())
+        timestamp_column = [str(items[i].get("Timestamp", '')) for i in circuit_frame.index]
+        results[circuit_index] = (REPORT_HEADERS, _format_rows(circuit_columns, timestamp_column), {})
+
+    if valid.empty:
+        return results
+
+    # --- สร้างตารางชั่วโมงเต็ม (hourly grid) ของแต่ละวงจร แล้วหาชั่วโมงที่ขาด ---
+    first_rows = valid.drop_duplicates('circuit', keep='first')
+    ts_range = valid.groupby('circuit')['ts'].agg(['min', 'max'])
+    grid_start = ts_range['min'].to_numpy().astype('datetime64[M]').astype('datetime64[h]')
+    grid_end = ts_range['max'].to_numpy().astype('datetime64[D]').astype('datetime64[h]') + np.timedelta64(23, 'h')
+    hours_per_circuit = (grid_end - grid_start).astype(np.int64) + 1
+    offsets = np.arange(hours_per_circuit.sum()) - np.repeat(np.cumsum(hours_per_circuit) - hours_per_circuit, hours_per_circuit)
+    grid_circuit = np.repeat(ts_range.index.to_numpy(), hours_per_circuit)
+    grid_hours = np.repeat(grid_start, hours_per_circuit) + offsets.astype('timedelta64[h]')
+
+    existing_keys = valid['circuit'].to_numpy(dtype=np.int64) * _CIRCUIT_KEY_STRIDE + valid['ts'].to_numpy().astype('datetime64[h]').astype(np.int64)
+    grid_keys = grid_circuit.astype(np.int64) * _CIRCUIT_KEY_STRIDE + grid_hours.astype(np.int64)
+    missing = ~np.isin(grid_keys, existing_keys)
+    missing_circuit = grid_circuit[missing]
+    # แถวแรกของแต่ละวงจร (ตามลำดับเดิม) ใช้เป็นค่ารหัส/ชื่อหน่วยงาน/Bandwidth ของชั่วโมงที่เติม
+    first_row_position = np.searchsorted(first_rows['circuit'].to_numpy(), missing_circuit)
+
+    # เก็บเป็น NumPy array รายคอลัมน์ (ไม่สร้าง DataFrame ใหม่ เพื่อไม่ให้ค่า None ในคอลัมน์ object ถูกแปลงเป็น NaN)
+    missing_columns = {
+        'circuit': missing_circuit,
+        'ts': grid_hours[missing].astype('datetime64[ns]'),
+        'Customer_Curcuit_ID': first_rows['Customer_Curcuit_ID'].to_numpy(dtype=object)[first_row_position],
+        'Address': first_rows['Address'].to_numpy(dtype=object)[first_row_position],
+        'Bandwidth': first_rows['Bandwidth'].to_numpy(dtype=object)[first_row_position],
+        'In_Averagebps': np.full(len(missing_circuit), "0", dtype=object),
+        'Out_Averagebps': np.full(len(missing_circuit), "0", dtype=object),
+    }
+    if len(missing_circuit):
+        logger.info(f"✨ เติมข้อมูลสำหรับชั่วโมงที่ขาดหายไป {len(missing_circuit):,} ชั่วโมง ใน {len(np.unique(missing_circuit))} วงจร")
+
+    # --- รวมข้อมูลและเรียงตาม (วงจร, เวลา) แบบ stable เพื่อคงลำดับเดิมของเวลาที่ซ้ำกัน ---
+    combined = {column: np.concatenate([values, valid[column].to_numpy(dtype=values.dtype)])
+                for column, values in missing_columns.items()}
+    combined['real'] = np.concatenate([np.zeros(len(missing_circuit), dtype=bool), np.ones(len(valid), dtype=bool)])
+    order = np.lexsort((combined['ts'].view(np.int64), combined['circuit']))
+    combined = {column: values[order] for column, values in combined.items()}
+    in_numbers, in_converted = _to_float_column(combined['In_Averagebps'].tolist())
+    out_numbers, out_converted = _to_float_column(combined['Out_Averagebps'].tolist())
+    combined.update(in_numbers=in_numbers, in_converted=in_converted, out_numbers=out_numbers, out_converted=out_converted)
+    timestamp_column = _format_report_timestamps(combined['ts'])
+    rows = _format_rows(combined, timestamp_column)
+
+    # --- แยกผลลัพธ์กลับเป็นรายวงจร พร้อมค่าเฉลี่ยทั้งเดือน ---
+    circuit_column = combined['circuit']
+    in_numbers, in_converted = _average_inputs(combined['In_Averagebps'], in_numbers, in_converted)
+    out_numbers, out_converted = _average_inputs(combined['Out_Averagebps'], out_numbers, out_converted)
+    for circuit_index in ts_range.index.tolist():
+        start = np.searchsorted(circuit_column, circuit_index, side='left')
+        end = np.searchsorted(circuit_column, circuit_index, side='right')
+        monthly_averages = _monthly_averages(in_numbers[start:end], in_converted[start:end], out_numbers[start:end], out_converted[start:end])
+        results[circuit_index] = (REPORT_HEADERS, rows[start:end], monthly_averages)
+        if series is not None:
+            circuit_columns = {column: combined[column][start:end] for column in combined}
+            series[series_offset + circuit_index] = _traffic_series(circuit_columns, circuit_columns['real'], True)
+    return results
+
+def process_json_data(raw_json_data, job_id, series=None):
+    """ประมวลผลข้อมูล JSON ของวงจรเดียวเพื่อให้พร้อมสำหรับสร้างไฟล์ (ดู process_json_batch)"""
+    return process_json_batch([raw_json_data], job_id, series)[0]
+
+# --- รายงานสะสมของเดือน (โหมด incremental) ---
+class MonthToDateStore:
+    """สถานะรายงานสะสมของแต่ละวงจรในเดือนหนึ่ง (แถวของวันที่ปิดแล้ว ผลรวม In/Out และ digest ของข้อมูลดิบ) ใน SQLite"""
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._schema_lock = threading.Lock()
+        self._schema_ready = False
+
+    def _create_schema(self, conn):
+        with self._schema_lock:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS circuit_state (
+                    nod_id TEXT NOT NULL,
+                    itf_id TEXT NOT NULL,
+                    month TEXT NOT NULL,
+                    frozen_end TEXT NOT NULL,
+                    digest TEXT NOT NULL,
+                    fill TEXT NOT NULL,
+                    rows BLOB NOT NULL,
+                    in_sum REAL NOT NULL,
+                    in_count INTEGER NOT NULL,
+                    out_sum REAL NOT NULL,
+                    out_count INTEGER NOT NULL,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (nod_id, itf_id, month)
+                )""")
+            # ตารางหน้า PDF ของเวอร์ชันก่อน (เก็บคำสั่งวาดภายในของ reportlab) ไม่ใช้แล้ว
+            conn.execute("DROP TABLE IF EXISTS circuit_pages")
+        self._schema_ready = True
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = open_database(self.path, None if self._schema_ready else self._create_schema)
+        return conn
+
+    def load(self, nod_id, itf_id, month):
+        """คืนค่าสถานะของวงจร (dict แบบเดียวกับที่ process_json_month_to_date คืนค่า) หรือ None หากไม่มี"""
+        row = self._conn().execute(
+            "SELECT frozen_end, digest, fill, rows, in_sum, in_count, out_sum, out_count FROM circuit_state "
+            "WHERE nod_id = ? AND itf_id = ? AND month = ?", (nod_id, itf_id, month)).fetchone()
+        if row is None:
+            return None
+        frozen_end, digest, fill, rows, in_sum, in_count, out_sum, out_count = row
+        return {
+            'frozen_end': np.datetime64(frozen_end, 'h'),
+            'digest': digest,
+            'fill': json.loads(fill),
+            'rows': [dict(zip(REPORT_HEADERS, values)) for values in json.loads(zlib.decompress(rows).decode('utf-8'))],
+            'in_sum': in_sum, 'in_count': in_count, 'out_sum': out_sum, 'out_count': out_count
+        }
+
+    def save(self, nod_id, itf_id, month, state):
+        rows = zlib.compress(json.dumps([[row[header] for header in REPORT_HEADERS] for row in state['rows']], ensure_ascii=False).encode('utf-8'))
+        with self._conn() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO circuit_state (nod_id, itf_id, month, frozen_end, digest, fill, rows, in_sum, in_count, out_sum, out_count, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (nod_id, itf_id, month, str(state['frozen_end']), state['digest'], json.dumps(state['fill'], ensure_ascii=False), rows,
+                 state['in_sum'], state['in_count'], state['out_sum'], state['out_count'], time.time()))
+
+    def purge(self, max_age_seconds):
+        """ลบสถานะที่ไม่ได้ปรับปรุงนานเกิน max_age_seconds คืนค่าจำนวนวงจรที่ลบ"""
+        cutoff = time.time() - max_age_seconds
+        with self._conn() as conn:
+            removed = conn.execute("DELETE FROM circuit_state WHERE updated_at < ?", (cutoff,)).rowcount
+        return removed
+
+month_to_date_store = MonthToDateStore(MONTH_TO_DATE_PATH)
+
+_RAW_VALUE_KEYS = ("Customer_Curcuit_ID", "Address", "Bandwidth", "In_Averagebps", "Out_Averagebps")
+
+def _raw_columns_digest(date_values, raw_columns, mask):
+    """digest ของค่าที่ใช้สร้างรายงาน (วันที่ และคอลัมน์ใน _RAW_VALUE_KEYS) เฉพาะรายการที่ mask เป็น True ตามลำดับเดิม"""
+    # key ที่ไม่มีใน JSON แทนด้วย Ellipsis (ค่าที่ JSON สร้างไม่ได้) เพื่อให้ repr เหมือนกันทุก process
+    selected = [list(itertools.compress(date_values, mask))]
+    for key in _RAW_VALUE_KEYS:
+        selected.append([Ellipsis if value is _MISSING_VALUE else value for value in itertools.compress(raw_columns[key], mask)])
+    return hashlib.sha1(repr(selected).encode('utf-8')).hexdigest()
+
+def _continue_sum(previous_sum, values):
+    # บวกต่อจากผลรวมเดิมตามลำดับ ได้ค่าเดียวกับ _sequential_sum ของทั้งชุดทุกประการ
+    return float(np.add.accumulate(np.concatenate([[previous_sum], values]))[-1]) if values.size else previous_sum
+
+def process_json_month_to_date(raw_json_data, job_id, state=None, series=None):
+    """process_json_data แบบต่อยอดจาก state คืนค่า (ผลแบบ process_json_data, สถานะใหม่ หรือ None หากต่อยอดไม่ได้)"""
+    items = raw_json_data if isinstance(raw_json_data, list) else [raw_json_data]
+    timestamps = [item.get("Timestamp") for item in items]
+    date_values = [ts['date'] if isinstance(ts, dict) and 'date' in ts else None for ts in timestamps]
+    parsed, _ = _parse_json_timestamps(date_values)
+    if not items or np.isnat(parsed).any():
+        return process_json_data(raw_json_data, job_id, series), None
+    hours = parsed.astype('datetime64[h]')
+    raw_columns = {
+        "Customer_Curcuit_ID": [item.get("Customer_Curcuit_ID", '') for item in items],
+        "Address": [item.get("Address", '') for item in items],
+        "Bandwidth": [item.get("Bandwidth", '') for item in items],
+        "In_Averagebps": [item.get("In_Averagebps", _MISSING_VALUE) for item in items],
+        "Out_Averagebps": [item.get("Out_Averagebps", _MISSING_VALUE) for item in items],
+    }
+    # แถวแรก (ตามลำดับเดิม) ใช้เป็นค่ารหัส/ชื่อหน่วยงาน/Bandwidth ของชั่วโมงที่เติม
+    fill = [raw_columns["Customer_Curcuit_ID"][0], raw_columns["Address"][0], raw_columns["Bandwidth"][0]]
+
+    carry = None
+    if state is not None:
+        frozen = hours < state['frozen_end']
+        if not frozen.all() and fill == state['fill'] and _raw_columns_digest(date_values, raw_columns, frozen) == state['digest']:
+            carry = state
+    if carry is None:
+        carry = {
+            'frozen_end': hours.min().astype('datetime64[M]').astype('datetime64[h]'),
+            'digest': None,
+            'fill': fill,
+            'rows': [], 'in_sum': 0.0, 'in_count': 0, 'out_sum': 0.0, 'out_count': 0
+        }
+        frozen = np.zeros(len(items), dtype=bool)
+        if state is not None:
+            logger.info("🔄 ข้อมูลช่วงต้นเดือนเปลี่ยนจากครั้งก่อน กำลังประมวลผลใหม่ทั้งเดือน")
+
+    # --- เติมชั่วโมงที่ขาดตั้งแต่ frozen_end จนถึง 23:00 ของวันล่าสุดที่มีข้อมูล ---
+    tail = np.flatnonzero(~frozen)
+    grid_end = hours[tail].max().astype('datetime64[D]').astype('datetime64[h]') + np.timedelta64(23, 'h')
+    grid = np.arange(carry['frozen_end'], grid_end + np.timedelta64(1, 'h'), dtype='datetime64[h]')
+    missing_hours = grid[~np.isin(grid.astype(np.int64), hours[tail].astype(np.int64))]
+    missing_count = len(missing_hours)
+    if missing_count:
+        logger.info(f"✨ เติมข้อมูลสำหรับชั่วโมงที่ขาดหายไป {missing_count:,} ชั่วโมง")
+
+    # --- เรียงตามเวลาแบบ stable (ชั่วโมงที่เติมมาก่อน) เหมือน process_json_batch ---
+    fill_values = dict(zip(("Customer_Curcuit_ID", "Address", "Bandwidth"), carry['fill']), In_Averagebps="0", Out_Averagebps="0")
+    combined = {
+        'ts': np.concatenate([missing_hours.astype('datetime64[ns]'), parsed[tail]]),
+        'real': np.concatenate([np.zeros(missing_count, dtype=bool), np.ones(len(tail), dtype=bool)]),
+    }
+    for key in _RAW_VALUE_KEYS:
+        combined[key] = np.concatenate([np.full(missing_count, fill_values[key], dtype=object),
+                                        pd.Series(raw_columns[key], dtype=object).to_numpy()[tail]])
+    order = np.argsort(combined['ts'].view(np.int64), kind='stable')
+    combined = {column: values[order] for column, values in combined.items()}
+    in_numbers, in_converted = _to_float_column(combined['In_Averagebps'].tolist())
+    out_numbers, out_converted = _to_float_column(combined['Out_Averagebps'].tolist())
+    combined.update(in_numbers=in_numbers, in_converted=in_converted, out_numbers=out_numbers, out_converted=out_converted)
+    rows = _format_rows(combined, _format_report_timestamps(combined['ts']))
+    if series is not None:
+        series.append(_traffic_series(combined, combined['real'], carry is not state))
+
+    # --- ต่อผลรวมของค่าเฉลี่ย: วันที่ปิดแล้วเก็บเป็นสถานะใหม่ วันล่าสุดบวกเพิ่มเฉพาะในผลลัพธ์ครั้งนี้ ---
+    in_numbers, in_converted = _average_inputs(combined['In_Averagebps'], in_numbers, in_converted)
+    out_numbers, out_converted = _average_inputs(combined['Out_Averagebps'], out_numbers, out_converted)
+    new_frozen_end = grid_end - np.timedelta64(23, 'h')
+    split = int(np.searchsorted(combined['ts'], new_frozen_end.astype('datetime64[ns]')))
+    if carry is state and new_frozen_end == state['frozen_end']:
+        new_state = state
+    else:
+        closed_in = in_numbers[:split][in_converted[:split]]
+        closed_out = out_numbers[:split][out_converted[:split]]
+        new_state = {
+            'frozen_end': new_frozen_end,
+            'digest': _raw_columns_digest(date_values, raw_columns, hours < new_frozen_end),
+            'fill': carry['fill'],
+            'rows': carry['rows'] + rows[:split],
+            'in_sum': _continue_sum(carry['in_sum'], closed_in), 'in_count': carry['in_count'] + len(closed_in),
+            'out_sum': _continue_sum(carry['out_sum'], closed_out), 'out_count': carry['out_count'] + len(closed_out)
+        }
+    if carry is state:
+        logger.info(f"♻️ ใช้ข้อมูลเดิม {len(carry['rows']):,} ชั่วโมง ประมวลผลเพิ่ม {len(rows):,} ชั่วโมง")
+
+    open_in = in_numbers[split:][in_converted[split:]]
+    open_out = out_numbers[split:][out_converted[split:]]
+    count_in = new_state['in_count'] + len(open_in)
+    count_out = new_state['out_count'] + len(open_out)
     monthly_averages = {}
-    if total_count_in > 0 and total_count_out > 0:
-        avg_in_month = (total_sum_in / total_count_in)
-        avg_out_month = (total_sum_out / total_count_out)
+    if count_in > 0 and count_out > 0:
         monthly_averages = {
-            "avg_in_month": int(avg_in_month),
-            "avg_out_month": int(avg_out_month)
+            "avg_in_month": int(_continue_sum(new_state['in_sum'], open_in) / count_in),
+            "avg_out_month": int(_continue_sum(new_state['out_sum'], open_out) / count_out)
         }
+    return (REPORT_HEADERS, carry['rows'] + rows, monthly_averages), new_state
 
-    # --- Step 8: Final formatting for output ---
-    processed_data = []
-    for item in sorted_combined_data:
-        row_data = {}
-        for th_header, json_key in column_mapping.items():
-            # For 'วันที่และเวลา', use the 'Parsed_Timestamp' for consistent formatting
-            if th_header == "วันที่และเวลา":
-                row_data[th_header] = item['Parsed_Timestamp'].strftime('%Y-%m-%d %H.%M.%S')
-            else:
-                value = item.get(json_key, '')
-                if th_header in ["ปริมาณการใช้งาน incoming (หน่วย bps)", "ปริมาณการใช้งาน outcoming (หน่วย bps)"]:
-                    try:
-                        value_float = float(value)
-                        row_data[th_header] = f"{int(value_float):,}" # Format with comma
-                    except (ValueError, TypeError):
-                        row_data[th_header] = str(value)
-                elif th_header == "ขนาดBandwidth (หน่วย Mbps)":
-                    if "FTTx" in str(value):
-                        row_data[th_header] = "20 Mbps." # Changed from 0 Mbps.
-                    else:
-                        try:
-                            numeric_value = float(re.search(r'[\d.]+', str(value)).group())
-                            row_data[th_header] = f"{int(numeric_value):,} Mbps." # Format with comma
-                        except (ValueError, TypeError, AttributeError):
-                            row_data[th_header] = str(value)
-                else:
-                    row_data[th_header] = str(value)
-        processed_data.append(row_data)
-
-    return desired_headers_th, processed_data, monthly_averages
-
-def export_to_csv(headers, data, monthly_averages, filename, job_id, node_name):
-    """สร้างและบันทึกไฟล์ CSV โดยให้ 'รหัสหน่วยงาน' และ 'ชื่อหน่วยงาน' แสดงในทุกแถว
-       และเพิ่มแถวสำหรับค่าเฉลี่ยรวมทั้งเดือนในแถวสุดท้าย
-       
-       แก้ไข:
-       - 'ปริมาณการใช้งาน incoming (หน่วย bps)' เป็น 'In_Averagebps'
-       - 'ปริมาณการใช้งาน outcoming (หน่วย bps)' เป็น 'Out_Averagebps'
-    """
+def transform_month_to_date(raw_json_data, nod_id, itf_id, job_id, report_month):
+    """แปลงข้อมูลของวงจรหนึ่งต่อยอดจาก month_to_date_store แล้วบันทึกสถานะใหม่ คืนค่าแบบเดียวกับ process_json_data"""
     try:
-        with open(filename, 'w', newline='', encoding='utf-8-sig') as f:
-            cw = csv.writer(f)
-            if headers and data:
-                # กำหนดหัวตารางใหม่ตามที่ต้องการแสดงใน CSV
-                csv_display_headers = [
-                    "รหัสหน่วยงาน",
-                    "ชื่อหน่วยงาน",
-                    "วันที่และเวลา",
-                    "ขนาดBandwidth (หน่วย Mbps)",
-                    "In_Averagebps",  # เปลี่ยนชื่อหัวตาราง
-                    "Out_Averagebps"  # เปลี่ยนชื่อหัวตาราง
-                ]
-                cw.writerow(csv_display_headers) # เขียนหัวตารางใหม่ลงไป
-                
-                for row in data:
-                    new_row = [
-                        row.get('รหัสหน่วยงาน', ''),
-                        row.get('ชื่อหน่วยงาน', ''),
-                        row.get('วันที่และเวลา', ''),
-                        row.get('ขนาดBandwidth (หน่วย Mbps)', ''),
-                        # ดึงข้อมูลจากคีย์เดิมที่เป็นภาษาไทย ซึ่งเป็นคีย์ที่อยู่ใน 'data' ที่ถูกส่งเข้ามา
-                        row.get('ปริมาณการใช้งาน incoming (หน่วย bps)', ''),
-                        row.get('ปริมาณการใช้งาน outcoming (หน่วย bps)', '')
-                    ]
-                    cw.writerow(new_row)
-                
-                # Insert monthly average row at the very end
-                if monthly_averages:
-                    avg_in = monthly_averages['avg_in_month']
-                    avg_out = monthly_averages['avg_out_month']
-                    cw.writerow([
-                        '', '', # Empty for customer ID/name
-                        'Total', 
-                        '', # Bandwidth
-                        f'{avg_in:,}', 
-                        f'{avg_out:,}'
-                    ])
-            else:
-                cw.writerow(["No Data"])
-        logger.info(f"✅ สร้าง CSV สำหรับ '{node_name}' สำเร็จแล้ว")
-        return True, "Success"
+        state = month_to_date_store.load(nod_id, itf_id, report_month)
     except Exception as e:
-        logger.error(f"❌ สร้าง CSV สำหรับ '{node_name}' ล้มเหลว: {e}")
-        return False, str(e)
+        logger.warning(f"⚠️ อ่านสถานะรายงานสะสมของ NodeID: {nod_id}, Interface ID: {itf_id} ไม่สำเร็จ ({e}) กำลังประมวลผลทั้งเดือน")
+        state = None
+    series = []
+    circuit_result, new_state = process_json_month_to_date(raw_json_data, job_id, state, series)
+    record_circuit_traffic(nod_id, itf_id, series[0])
+    if new_state is not None and new_state is not state:
+        try:
+            month_to_date_store.save(nod_id, itf_id, report_month, new_state)
+        except Exception as e:
+            logger.warning(f"⚠️ บันทึกสถานะรายงานสะสมของ NodeID: {nod_id}, Interface ID: {itf_id} ไม่สำเร็จ: {e}")
+    return circuit_result
+
+# --- คลังข้อมูลรายชั่วโมงของทุกวงจร (memory-mapped NumPy) ---
+class TrafficTimeSeriesStore:
+    """ค่า In/Out และ Bandwidth รายชั่วโมงของแต่ละวงจร เก็บเป็นไฟล์ .npy ต่อวงจรต่อเดือนและอ่านแบบ memory map"""
+    COLUMNS = ('in_bps', 'out_bps', 'bandwidth_mbps')
+
+    def __init__(self, root):
+        self.root = root
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def month_hours(month):
+        """ชั่วโมงทั้งหมดของเดือน (YYYY-MM) เป็น datetime64[h] ตามลำดับคอลัมน์ในไฟล์"""
+        start = np.datetime64(month, 'M')
+        return np.arange(start.astype('datetime64[h]'), (start + 1).astype('datetime64[h]'), dtype='datetime64[h]')
+
+    def _path(self, month, nod_id, itf_id):
+        return os.path.join(self.root, month, f"{urllib.parse.quote(nod_id, safe='')}+{urllib.parse.quote(itf_id, safe='')}")
+
+    def _open_for_write(self, path, hour_count):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            # สร้างไฟล์แบบ exclusive เพื่อไม่ให้ทับไฟล์ที่ process อื่นเพิ่งสร้าง
+            with open(path, 'xb') as f:
+                np.save(f, np.full((len(self.COLUMNS), hour_count), np.nan))
+        except FileExistsError:
+            pass
+        return np.load(path, mmap_mode='r+')
+
+    def write(self, nod_id, itf_id, series):
+        """บันทึก series (ดู _traffic_series) ลงไฟล์ของเดือนนั้น โดยล้างค่าเดิมก่อนหาก series['complete']"""
+        hours = series['hours']
+        months = hours.astype('datetime64[M]')
+        for month in np.unique(months):
+            in_month = months == month
+            path = self._path(str(month), nod_id, itf_id)
+            with self._lock:
+                values = self._open_for_write(path + '.npy', len(self.month_hours(str(month))))
+                if series['complete']:
+                    values[:] = np.nan
+                columns = (hours[in_month] - month.astype('datetime64[h]')).astype(np.int64)
+                for row, column in enumerate(self.COLUMNS):
+                    values[row, columns] = series[column][in_month]
+                values.flush()
+                del values
+            meta = {'customer_id': series['customer_id'], 'address': series['address']}
+            if self._read_meta(path) != meta:
+                temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(temp_path, 'w', encoding='utf-8') as f:
+                    json.dump(meta, f, ensure_ascii=False)
+                os.replace(temp_path, path + '.json')
+
+    def _read_meta(self, path):
+        try:
+            with open(path + '.json', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
 
+    def read(self, month, nod_id, itf_id):
+        """คืนค่า dict ของค่ารายชั่วโมง (view แบบอ่านอย่างเดียวของ memory map) และรหัส/ชื่อหน่วยงาน หรือ None หากไม่มีข้อมูล"""
+        path = self._path(month, nod_id, itf_id)
+        try:
+            values = np.load(path + '.npy', mmap_mode='r')
+        except FileNotFoundError:
+            return None
+        series = {'hours': self.month_hours(month)}
+        series.update(zip(self.COLUMNS, values))
+        series.update(self._read_meta(path) or {'customer_id': '', 'address': ''})
+        return series
 
-def export_to_pdf(headers, data, monthly_averages, filename, job_id, node_name):
-    """สร้างและบันทึกไฟล์ PDF โดยให้แต่ละวันขึ้นหน้าใหม่ และเพิ่มค่าเฉลี่ยรวมทั้งเดือนในแถวสุดท้ายของตารางข้อมูลสุดท้าย"""
+    def circuits(self, month):
+        """คืนค่า [(NodeID, Interface ID)] ของทุกวงจรที่มีข้อมูลในเดือนหนึ่ง"""
+        try:
+            names = os.listdir(os.path.join(self.root, month))
+        except FileNotFoundError:
+            return []
+        keys = []
+        for name in sorted(names):
+            if name.endswith('.npy'):
+                nod_id, itf_id = name[:-len('.npy')].split('+')
+                keys.append((urllib.parse.unquote(nod_id), urllib.parse.unquote(itf_id)))
+        return keys
+
+    def iter_month(self, month):
+        """คืนค่า (NodeID, Interface ID, series) ของทุกวงจรในเดือนหนึ่งทีละวงจร (สำหรับ rollup ทั้งเดือน)"""
+        for nod_id, itf_id in self.circuits(month):
+            series = self.read(month, nod_id, itf_id)
+            if series is not None:
+                yield nod_id, itf_id, series
+
+    def to_raw_json(self, month, nod_id, itf_id):
+        """สร้างข้อมูลแบบเดียวกับ get_data_from_api จากค่าที่เก็บไว้ (ค่าที่ไม่ใช่ตัวเลขเป็นค่าว่าง) หรือ None หากไม่มีข้อมูล"""
+        series = self.read(month, nod_id, itf_id)
+        if series is None:
+            return None
+        present = ~(np.isnan(series['in_bps']) & np.isnan(series['out_bps']) & np.isnan(series['bandwidth_mbps']))
+        raw_json_data = []
+        for hour, in_bps, out_bps, bandwidth in zip(series['hours'][present].tolist(), series['in_bps'][present].tolist(),
+                                                    series['out_bps'][present].tolist(), series['bandwidth_mbps'][present].tolist()):
+            item = {
+                "Customer_Curcuit_ID": series['customer_id'],
+                "Address": series['address'],
+                "Timestamp": {"date": hour.strftime(JSON_TIMESTAMP_FORMAT)},
+                "Bandwidth": '' if math.isnan(bandwidth) else f"{bandwidth:g} Mbps",
+            }
+            if not math.isnan(in_bps):
+                item["In_Averagebps"] = repr(in_bps)
+            if not math.isnan(out_bps):
+                item["Out_Averagebps"] = repr(out_bps)
+            raw_json_data.append(item)
+        return raw_json_data
+
+traffic_store = TrafficTimeSeriesStore(TIMESERIES_DIR) if TIMESERIES_DIR else None
+
+def record_circuit_traffic(nod_id, itf_id, series):
+    """บันทึกค่ารายชั่วโมงของวงจรลง traffic_store (ข้อผิดพลาดไม่กระทบการสร้างรายงาน)"""
+    if traffic_store is None or series is None:
+        return
     try:
-        doc = SimpleDocTemplate(filename, pagesize=letter)
-        styles = getSampleStyleSheet()
-        elements = []
-
-        # Constants for page dimensions
-        # letter size is 8.5 x 11 inches. 1 inch = 72 points
-        page_width, page_height = letter
-        left_margin = right_margin = 0.5 * inch # Set a consistent margin
-
-        # Calculate available width for the table
-        available_width = page_width - (left_margin + right_margin)
-
-        if headers and data:
-            data_by_date = {}
-            for row in data:
-                date_time_str = row.get('วันที่และเวลา', '')
-                try:
-                    date_key = datetime.datetime.strptime(date_time_str, '%Y-%m-%d %H.%M.%S').strftime('%Y-%m-%d')
-                except ValueError:
-                    date_key = 'Uncategorized' # Fallback for malformed date
-                if date_key not in data_by_date:
-                    data_by_date[date_key] = []
-                data_by_date[date_key].append(row)
-            
-            sorted_date_keys = sorted(data_by_date.keys())
-            last_date_key = sorted_date_keys[-1] if sorted_date_keys else None
+        traffic_store.write(nod_id, itf_id, series)
+    except Exception as e:
+        logger.warning(f"⚠️ บันทึกข้อมูลรายชั่วโมงของ NodeID: {nod_id}, Interface ID: {itf_id} ไม่สำเร็จ: {e}")
 
-            first_page = True
-            for i, date_key in enumerate(sorted_date_keys):
-                group_data = data_by_date[date_key]
+# --- Process pool สำหรับสร้างไฟล์ CSV/PDF ---
+_render_pool = None
+_render_pool_lock = threading.Lock()
+_render_log_listener = None
 
-                if not first_page:
-                    elements.append(PageBreak())
-                
-                # Title
-                title_style = styles['Title']
-                if THAI_FONT_REGISTERED:
-                    title_style.fontName = THAI_FONT_NAME
-                title_style.fontSize = 18
-                title_style.alignment = 1
-                elements.append(Paragraph("Custumer Interface Summary Report by Hour", title_style))
-                elements.append(Spacer(1, 0.2 * inch))
-
-                # Subtitle (Date)
-                sub_title_style = ParagraphStyle('SubTitle', parent=styles['Normal'])
-                if THAI_FONT_REGISTERED:
-                    sub_title_style.fontName = THAI_FONT_NAME
-                sub_title_style.fontSize = 12
-                sub_title_style.alignment = 1 
-                elements.append(Paragraph(f"<b>รายงานประจำวันที่:</b> {date_key}", sub_title_style))
-                elements.append(Spacer(1, 0.2 * inch))
-
-                table_headers = [
-                    "รหัสหน่วยงาน",
-                    "ชื่อหน่วยงาน",
-                    "วันที่และเวลา",
-                    "ขนาดBandwidth \n(หน่วย Mbps)",
-                    "ปริมาณการใช้งาน incoming\n (หน่วย bps)",
-                    "ปริมาณการใช้งาน outcoming\n (หน่วย bps)"
-                ]
-                
-                table_data = [table_headers]
-                last_customer_id = None
-                last_customer_name = None
-                
-                for row in group_data:
-                    current_customer_id = row.get('รหัสหน่วยงาน', '')
-                    current_customer_name = row.get('ชื่อหน่วยงาน', '')
-                    display_customer_id = current_customer_id if current_customer_id != last_customer_id else ''
-                    display_customer_name = current_customer_name if current_customer_name != last_customer_name else ''
-                    table_data.append([
-                        display_customer_id,
-                        display_customer_name,
-                        row.get('วันที่และเวลา', ''),
-                        row.get('ขนาดBandwidth (หน่วย Mbps)', ''),
-                        row.get('ปริมาณการใช้งาน incoming (หน่วย bps)', ''),
-                        row.get('ปริมาณการใช้งาน outcoming (หน่วย bps)', '')
-                    ])
-                    last_customer_id = current_customer_id
-                    last_customer_name = current_customer_name
-                
-                # Check if this is the last day's data and monthly averages exist
-                is_last_day_group = (date_key == last_date_key)
-                if is_last_day_group and monthly_averages:
-                    avg_in = monthly_averages['avg_in_month']
-                    avg_out = monthly_averages['avg_out_month']
-                    
-                    # Create a Paragraph for the average text to allow styling
-                    average_text_style = ParagraphStyle('AverageText', parent=styles['Normal'])
-                    if THAI_FONT_REGISTERED:
-                        average_text_style.fontName = THAI_FONT_NAME
-                    average_text_style.alignment = 0 # Left align in the cell
-                    average_text_style.fontSize = 10 # Match table body font size
-
-                    table_data.append([
-                        '', # Empty cell for 'รหัสหน่วยงาน'
-                        '', # Empty cell for 'ชื่อหน่วยงาน'
-                        Paragraph("<b>Total</b>", average_text_style), # Bold average text
-                        '', # Empty cell for 'ขนาดBandwidth'
-                        Paragraph(f"<b>{avg_in:,}</b>", average_text_style), # Bold and comma-formatted In_Averagebps
-                        Paragraph(f"<b>{avg_out:,}</b>", average_text_style)  # Bold and comma-formatted Out_Averagebps
-                    ])
-                
-                # Define column widths as percentages of available_width
-                # This ensures the table expands to fill the page width
-                # Total percentages should add up to 1.0 or 100%
-                col_widths = [
-                    0.10 * available_width,  # รหัสหน่วยงาน (Customer ID)
-                    0.29 * available_width,  # ชื่อหน่วยงาน (Customer Name)
-                    0.13 * available_width,  # วันที่และเวลา (Date and Time)
-                    0.13 * available_width,  # ขนาดBandwidth (Bandwidth)
-                    0.18 * available_width,  # ปริมาณการใช้งาน incoming (In usage)
-                    0.18 * available_width   # ปริมาณการใช้งาน outcoming (Out usage)
-                ]
-                
-                table = Table(table_data, colWidths=col_widths)
-                
-                table_style = [
-                    ('BACKGROUND', (0, 0), (-1, 0), '#cccccc'),
-                    ('TEXTCOLOR', (0, 0), (-1, 0), '#000000'),
-                    ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-                    ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-                    ('BACKGROUND', (0, 1), (-1, -1), '#f0f0f0'), 
-                    ('GRID', (0, 0), (-1, -1), 1, '#999999'),
-                    ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'), # Vertically align text in cells
-                ]
-                if THAI_FONT_REGISTERED:
-                    table_style.append(('FONTNAME', (0, 0), (-1, 0), THAI_FONT_NAME)) # Headers in Thai font
-                    table_style.append(('FONTNAME', (0, 1), (-1, -1), THAI_FONT_NAME)) # Body in Thai font
-                else:
-                    table_style.append(('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold')) # Headers in bold
-                    table_style.append(('FONTNAME', (0, 1), (-1, -1), 'Helvetica')) # Body in regular
-
-                # Apply specific style for the last row if it's the monthly average
-                if is_last_day_group and monthly_averages:
-                    last_row_index = len(table_data) - 1
-                    table_style.extend([
-                        ('BACKGROUND', (0, last_row_index), (-1, last_row_index), '#d3d3d3'), # Light grey background for average row
-                        ('SPAN', (0, last_row_index), (1, last_row_index)), # Span first two columns
-                        ('ALIGN', (2, last_row_index), (2, last_row_index), 'LEFT'), # Align 'Total' text left
-                        ('FONTNAME', (2, last_row_index), (2, last_row_index), THAI_FONT_NAME if THAI_FONT_REGISTERED else 'Helvetica-Bold'),
-                        ('FONTNAME', (4, last_row_index), (4, last_row_index), THAI_FONT_NAME if THAI_FONT_REGISTERED else 'Helvetica-Bold'),
-                        ('FONTNAME', (5, last_row_index), (5, last_row_index), THAI_FONT_NAME if THAI_FONT_REGISTERED else 'Helvetica-Bold'),
-                        ('ALIGN', (4, last_row_index), (4, last_row_index), 'CENTER'), # Center average values
-                        ('ALIGN', (5, last_row_index), (5, last_row_index), 'CENTER'), # Center average values
-                        ('BOTTOMPADDING', (0, last_row_index), (-1, last_row_index), 12),
-                        ('TOPPADDING', (0, last_row_index), (-1, last_row_index), 12),
-                    ])
-
-                table.setStyle(table_style)
-                elements.append(table)
-                elements.append(Spacer(1, 0.5 * inch))
-
-                first_page = False
+def get_render_pool(workers=RENDER_WORKERS):
+    """คืนค่า process pool ที่ใช้ร่วมกันทุกงาน (สร้างเมื่อใช้ครั้งแรกด้วย workers ของผู้เรียกครั้งนั้น) หรือ None หาก workers เป็น 0"""
+    global _render_pool, _render_log_listener
+    if workers <= 0:
+        return None
+    with _render_pool_lock:
+        if _render_pool is None:
+            # ใช้ spawn เพื่อไม่ให้ fork process ที่มีหลาย thread (Flask, fetch worker) อยู่
+            # process ลูก import เฉพาะ report_render (เมื่อรัน final.py โดยตรง spawn จะรันไฟล์ซ้ำเป็น __mp_main__ ดู open_database)
+            context = multiprocessing.get_context('spawn')
+            worker_log_queue = context.Queue()
+            if _render_log_listener is None:
+                _render_log_listener = logging.handlers.QueueListener(worker_log_queue, *logger.handlers, respect_handler_level=True)
+                _render_log_listener.start()
+            else:
+                worker_log_queue = _render_log_listener.queue
+            _render_pool = ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                               initializer=init_render_worker, initargs=(worker_log_queue, logger.getEffectiveLevel()))
+            logger.info(f"🖨️ เริ่ม process pool สำหรับสร้างไฟล์ {workers} process")
+        return _render_pool
+
+def _reset_render_pool(pool):
+    """ทิ้ง process pool ที่เสียหาย เพื่อให้งานถัดไปสร้างใหม่"""
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is pool:
+            _render_pool = None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def _render_in_thread(render_args):
+    future = Future()
+    try:
+        future.set_result(render_circuit_reports(*render_args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+def submit_render(render_args, workers=RENDER_WORKERS):
+    """ส่งงานสร้างไฟล์เข้า process pool คืนค่า (future, pool) หาก pool ใช้ไม่ได้จะสร้างใน thread ปัจจุบันแทน"""
+    pool = get_render_pool(workers)
+    if pool is not None:
+        try:
+            return pool.submit(render_circuit_reports, *render_args), pool
+        except (BrokenProcessPool, RuntimeError) as e:
+            logger.warning(f"⚠️ process pool สำหรับสร้างไฟล์ใช้งานไม่ได้ ({e}) กำลังสร้างไฟล์ใน thread ของงานแทน")
+            _reset_render_pool(pool)
+    return _render_in_thread(render_args), None
+
+def _render_font_id():
+    """ฟอนต์ที่ใช้ใน PDF (ชื่อและ sha256 ของไฟล์ฟอนต์) เปลี่ยนฟอนต์แล้วไฟล์ใน render_cache จะไม่ถูกใช้"""
+    if not THAI_FONT_REGISTERED:
+        return 'Helvetica'
+    with open(THAI_FONT_PATH, 'rb') as f:
+        return f"{THAI_FONT_NAME}:{hashlib.sha256(f.read()).hexdigest()}"
+
+def _render_cache_salt():
+    return f"{RENDER_TEMPLATE_VERSION}/{PDF_RENDERER}/{_render_font_id()}"
+
+# อ่านไฟล์ฟอนต์เพื่อสร้าง salt เมื่อใช้ cache ครั้งแรก ไม่ใช่ตอน import
+render_cache = RenderCache(RENDER_CACHE_PATH, max_bytes=RENDER_CACHE_MAX_BYTES, salt=_render_cache_salt) if RENDER_CACHE_MAX_BYTES > 0 else None
+
+# --- อ่านไฟล์รายชื่อวงจร (Excel/CSV) ---
+workbook_cache = WorkbookCache(WORKBOOK_CACHE_PATH, max_bytes=WORKBOOK_CACHE_MAX_BYTES)
+
+class _ChunkSpill:
+    """ไฟล์ชั่วคราวที่เก็บ object (pickle) ต่อท้ายกันทีละชุด อ่านกลับทีละชุดได้จากหลาย thread"""
+    def __init__(self):
+        self._file = tempfile.TemporaryFile(prefix='solarwind_rows_')
+        self._lock = threading.Lock()
+        self._entries = [] # (ตำแหน่งในไฟล์, ขนาด) ของแต่ละชุด
+
+    def __len__(self):
+        return len(self._entries)
+
+    def append(self, obj):
+        data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._entries.append((self._file.seek(0, os.SEEK_END), len(data)))
+            self._file.write(data)
+
+    def load(self, position):
+        offset, size = self._entries[position]
+        with self._lock:
+            self._file.seek(offset)
+            data = self._file.read(size)
+        return pickle.loads(data)
+
+    def __iter__(self):
+        return (self.load(position) for position in range(len(self._entries)))
+
+    def close(self):
+        self._file.close()
+
+class CircuitList:
+    """รายชื่อวงจร (REQUIRED_COLUMNS) ที่พักไว้ในไฟล์ชั่วคราวเป็น DataFrame ชุดละไม่เกิน CHUNK_ROWS แถว ผู้สร้างต้องเรียก close"""
+    def __init__(self):
+        self._spill = _ChunkSpill()
+        self._starts = [] # แถวแรกของแต่ละชุด
+        self._length = 0
+
+    @classmethod
+    def from_chunks(cls, chunks):
+        circuits = cls()
+        try:
+            for chunk in chunks:
+                circuits.append(chunk)
+        except BaseException:
+            circuits.close()
+            raise
+        return circuits
+
+    @classmethod
+    def from_frame(cls, df):
+        return cls.from_chunks(df.iloc[start:start + CHUNK_ROWS] for start in range(0, len(df), CHUNK_ROWS))
+
+    def __len__(self):
+        return self._length
+
+    def append(self, chunk):
+        """เพิ่มแถวของ DataFrame ต่อท้ายเป็นหนึ่งชุด (index ถูกตั้งเป็นลำดับแถวต่อจากชุดก่อน)"""
+        if len(chunk):
+            self._spill.append(chunk.set_axis(pd.RangeIndex(self._length, self._length + len(chunk))))
+            self._starts.append(self._length)
+            self._length += len(chunk)
+
+    def iter_chunks(self, start=0):
+        """คืนค่า DataFrame ทีละชุดตั้งแต่แถวที่ start (นับจาก 0)"""
+        for position in range(max(0, bisect.bisect_right(self._starts, start) - 1), len(self._starts)):
+            chunk = self._spill.load(position)
+            yield chunk.iloc[start - self._starts[position]:] if start > self._starts[position] else chunk
+
+    def iter_rows(self, start=0):
+        """คืนค่า (index, row เป็น dict) ของแถวตั้งแต่ start โดยสร้าง dict ทีละชุด"""
+        for chunk in self.iter_chunks(start):
+            yield from zip(chunk.index, chunk.to_dict('records'))
+
+    def close(self):
+        self._spill.close()
+
+_NUMERIC_DTYPES = {'int64', 'float64'}
+
+def _value_kind(values):
+    """ชนิดของค่าเดิมในคอลัมน์ของชุด: 'bool' หากมีค่า bool, 'text' หากเป็นข้อความ (หรือ NaN) ทั้งหมด มิฉะนั้น 'mixed'"""
+    if any(isinstance(value, bool) for value in values):
+        return 'bool'
+    if all(isinstance(value, str) or (isinstance(value, float) and math.isnan(value)) for value in values):
+        return 'text'
+    return 'mixed'
+
+def _chunk_summary(chunk, value_kinds=None):
+    """สรุปของแต่ละคอลัมน์ในชุด: (dtype ที่ pandas เดา, ว่างทั้งชุด, ชนิดของค่าเดิม ดู _value_kind, เป็น object ที่มีข้อความ)"""
+    return {column: (str(values.dtype), bool(values.isna().all()), 'text' if value_kinds is None else value_kinds[column],
+                     values.dtype == object and any(isinstance(value, str) for value in values))
+            for column, values in chunk.items()}
+
+def _combine_dtypes(summaries):
+    """dtype ของแต่ละคอลัมน์เมื่ออ่านทั้งไฟล์ครั้งเดียว ตัดสินจากสรุปของทุกชุด คืนค่า None หากตัดสินไม่ได้"""
+    dtypes = {}
+    for column in summaries[0]:
+        summary = [chunk[column] for chunk in summaries]
+        kinds = {dtype for dtype, empty, _, _ in summary if not empty}
+        has_empty = any(empty for _, empty, _, _ in summary)
+        if len(summary) == 1:
+            dtypes[column] = summary[0][0]
+        elif not kinds and len({dtype for dtype, _, _, _ in summary}) == 1:
+            dtypes[column] = summary[0][0]
+        elif kinds and kinds <= _NUMERIC_DTYPES:
+            dtypes[column] = 'float64' if 'float64' in kinds or has_empty else 'int64'
+        elif kinds == {'str'}:
+            dtypes[column] = 'str'
+        # มีชุดที่เป็นข้อความ: ใช้ค่าเดิมของไฟล์ ยกเว้นมีค่า bool (pandas อาจแปลง 'TRUE' ของทั้งไฟล์เป็น bool)
+        elif kinds and kinds <= _NUMERIC_DTYPES | {'str', 'object'} and any(
+                dtype == 'str' or has_text for dtype, empty, _, has_text in summary if not empty) and all(
+                value_kind != 'bool' for _, _, value_kind, _ in summary):
+            dtypes[column] = 'text:str' if all(value_kind == 'text' for _, _, value_kind, _ in summary) else 'text:object'
         else:
-            no_data_style = styles['Normal']
-            if THAI_FONT_REGISTERED:
-                no_data_style.fontName = THAI_FONT_NAME
-            elements.append(Paragraph("No circuit status data available.", no_data_style))
-        
-        # Build the document with the defined margins
-        doc.leftMargin = left_margin
-        doc.rightMargin = right_margin
-        doc.topMargin = 0.5 * inch # Set top margin
-        doc.bottomMargin = 0.5 * inch # Set bottom margin
-
-        doc.build(elements)
-        logger.info(f"✅ สร้าง PDF สำหรับ '{node_name}' สำเร็จแล้ว")
-        return True, "PDF generated successfully."
+            return None
+    return dtypes
+
+def _build_circuit_list(read_chunks, value_kinds=None):
+    """สร้าง CircuitList ด้วย read_chunks(dtype) สองรอบ (สรุป dtype แล้วแปลงทุกชุดเป็น dtype ของทั้งไฟล์) คืนค่า None หากตัดสิน dtype ไม่ได้"""
+    summaries = [_chunk_summary(chunk, value_kinds and value_kinds[position]) for position, chunk in enumerate(read_chunks(None))]
+    if not summaries:
+        return CircuitList()
+    dtypes = _combine_dtypes(summaries)
+    if dtypes is None:
+        return None
+    texts = read_chunks(object) if any(dtype.startswith('text:') for dtype in dtypes.values()) else itertools.repeat(None)
+
+    def finish(chunk, text):
+        for column, dtype in dtypes.items():
+            if dtype.startswith('text:'):
+                chunk[column] = text[column].astype('str') if dtype == 'text:str' else text[column]
+            elif str(chunk[column].dtype) != dtype:
+                chunk[column] = chunk[column].astype(dtype)
+        return chunk
+    return CircuitList.from_chunks(itertools.starmap(finish, zip(read_chunks(None), texts)))
+
+def _missing_columns(header):
+    return [column for column in REQUIRED_COLUMNS if column not in header]
+
+_UNHANDLED_CELL = object() # เซลล์ชนิดที่ _excel_cell_value ไม่รู้จัก (เช่นวันที่/เวลา)
+
+def _excel_cell_value(cell):
+    """แปลงค่าในเซลล์แบบเดียวกับ pd.read_excel (engine openpyxl) หรือคืนค่า _UNHANDLED_CELL สำหรับเซลล์ชนิดอื่น"""
+    value = cell.value
+    if value is None:
+        return ""
+    if cell.data_type == 'e':
+        return np.nan
+    if cell.data_type == 'n':
+        return int(value) if int(value) == value else float(value)
+    if cell.data_type in ('s', 'b'):
+        return value
+    return _UNHANDLED_CELL
+
+def _read_excel_columns(workbook):
+    """อ่านไฟล์ Excel ทั้งไฟล์ด้วย pd.read_excel แล้วตรวจหัวคอลัมน์ (ใช้กับ .xls และ .xlsx ที่ _read_xlsx_columns อ่านไม่ได้)"""
+    df = pd.read_excel(io.BytesIO(workbook))
+    missing = _missing_columns(df.columns)
+    return (None if missing else CircuitList.from_frame(df[REQUIRED_COLUMNS])), missing
+
+def _read_xlsx_columns(workbook):
+    """อ่านเฉพาะ REQUIRED_COLUMNS ของ sheet แรกในไฟล์ .xlsx ทีละ CHUNK_ROWS แถว คืนค่า (circuits, missing_columns)"""
+    book = openpyxl.load_workbook(io.BytesIO(workbook), read_only=True, data_only=True, keep_links=False)
+    raw_chunks = _ChunkSpill()
+    value_kinds = []
+    try:
+        rows = book.worksheets[0].iter_rows()
+        header = [_excel_cell_value(cell) for cell in next(rows, ())]
+        missing = _missing_columns(header)
+        if missing:
+            return None, missing
+        # ใช้คอลัมน์แรกของชื่อที่ซ้ำกัน (pandas ตั้งชื่อคอลัมน์ถัดไปเป็น 'ชื่อ.1')
+        positions = [header.index(column) for column in REQUIRED_COLUMNS]
+        data = []
+        blank_rows = 0
+        row_number = 1
+
+        def add(values):
+            data.append(values)
+            if len(data) >= CHUNK_ROWS:
+                flush()
+
+        def flush():
+            raw_chunks.append(data)
+            value_kinds.append({column: _value_kind([values[i] for values in data]) for i, column in enumerate(REQUIRED_COLUMNS)})
+            data.clear()
+
+        for row in rows:
+            row_number += 1
+            values = [_excel_cell_value(row[i]) if i < len(row) else "" for i in positions]
+            if any(value is _UNHANDLED_CELL for value in values):
+                logger.info(f"ℹ️ พบเซลล์ชนิดที่อ่านเองไม่ได้ในแถวที่ {row_number} อ่านทั้งไฟล์ด้วย pd.read_excel แทน")
+                break
+            # แถวว่างพิจารณาทุกคอลัมน์เหมือน pd.read_excel (เซลล์ที่เป็นข้อความว่างนับเป็นเซลล์ว่าง)
+            if not any(cell.value is not None and cell.value != "" for cell in row):
+                blank_rows += 1
+                continue
+            for _ in range(blank_rows):
+                add([""] * len(REQUIRED_COLUMNS))
+            blank_rows = 0
+            add(values)
+        else:
+            if data:
+                flush()
+
+            def read_chunks(dtype):
+                for chunk in raw_chunks:
+                    yield TextParser([list(REQUIRED_COLUMNS)] + chunk, header=0, skip_blank_lines=False, dtype=dtype).read()
+            circuits = _build_circuit_list(read_chunks, value_kinds)
+            if circuits is None:
+                logger.info("ℹ️ ชนิดข้อมูลในคอลัมน์ปนกันระหว่างช่วงของไฟล์ แปลงค่าทั้งไฟล์พร้อมกัน")
+                circuits = CircuitList.from_frame(TextParser([list(REQUIRED_COLUMNS)] + [values for chunk in raw_chunks for values in chunk],
+                                                             header=0, skip_blank_lines=False).read())
+            return circuits, []
+    finally:
+        book.close()
+        raw_chunks.close()
+    return _read_excel_columns(workbook)
+
+def _csv_encoding(workbook):
+    """UTF-8 หรือ TIS-620/cp874 (จาก Excel ภาษาไทย) ตรวจทีละส่วนโดยไม่สร้างข้อความของทั้งไฟล์"""
+    decoder = codecs.getincrementaldecoder('utf-8-sig')()
+    view = memoryview(workbook)
+    try:
+        for start in range(0, len(view), 1 << 16):
+            decoder.decode(view[start:start + (1 << 16)])
+        decoder.decode(b'', final=True)
+    except UnicodeDecodeError:
+        return 'cp874'
+    return 'utf-8-sig'
+
+def _read_csv_columns(workbook):
+    """อ่านเฉพาะ REQUIRED_COLUMNS ของไฟล์ CSV ทีละ CHUNK_ROWS แถวจากเนื้อหาไฟล์โดยตรง คืนค่า (circuits, missing_columns)"""
+    encoding = _csv_encoding(workbook)
+    header = next(csv.reader(io.TextIOWrapper(io.BytesIO(workbook), encoding=encoding, newline='')), [])
+    missing = _missing_columns(header)
+    if missing:
+        return None, missing
+
+    def read_csv(**kwargs):
+        return pd.read_csv(io.BytesIO(workbook), encoding=encoding, usecols=lambda column: column in REQUIRED_COLUMNS,
+                           skip_blank_lines=False, **kwargs)
+
+    def read_chunks(dtype):
+        with read_csv(chunksize=CHUNK_ROWS, dtype=dtype) as reader:
+            for chunk in reader:
+                yield chunk[REQUIRED_COLUMNS]
+    circuits = _build_circuit_list(read_chunks)
+    if circuits is None:
+        logger.info("ℹ️ ชนิดข้อมูลในคอลัมน์ปนกันระหว่างช่วงของไฟล์ อ่านทั้งไฟล์พร้อมกัน")
+        circuits = CircuitList.from_frame(read_csv()[REQUIRED_COLUMNS])
+    return circuits, []
+
+def read_circuit_list(workbook):
+    """อ่านรายชื่อวงจรจากไฟล์ .xlsx, .xls หรือ .csv (ผ่าน workbook_cache) คืนค่า (CircuitList ที่ผู้เรียกต้อง close, missing_columns)"""
+    digest = hashlib.sha256(workbook).hexdigest()
+    circuits = None
+    try:
+        chunks = workbook_cache.get(digest)
+        if chunks is not None:
+            circuits = CircuitList.from_chunks(chunks)
+    except Exception as e:
+        logger.warning(f"⚠️ อ่าน cache ของไฟล์ไม่สำเร็จ: {e}")
+    if circuits is not None:
+        logger.info(f"⚡ ใช้รายชื่อวงจรที่อ่านไว้แล้วจาก cache ({len(circuits)} รายการ)")
+        return circuits, []
+
+    if workbook[:4] == b'PK\x03\x04':
+        circuits, missing = _read_xlsx_columns(workbook)
+    elif workbook[:4] == b'\xd0\xcf\x11\xe0':
+        # ไฟล์ .xls รุ่นเก่า openpyxl อ่านไม่ได้ จึงใช้ pd.read_excel เหมือนเดิม
+        circuits, missing = _read_excel_columns(workbook)
+    else:
+        circuits, missing = _read_csv_columns(workbook)
+    if circuits is not None:
+        try:
+            workbook_cache.put(digest, circuits.iter_chunks())
+        except Exception as e:
+            logger.warning(f"⚠️ บันทึก cache ของไฟล์ไม่สำเร็จ: {e}")
+    return circuits, missing
+
+def last_occurrence_flags(keys, count):
+    """array ของ bool ว่าแต่ละตำแหน่งเป็นครั้งสุดท้ายของ key (hash แบบ int) นั้นหรือไม่ โดยไม่เก็บ dict ของทุก key"""
+    hashes = np.fromiter(keys, dtype=np.int64, count=count)
+    _, last_from_end = np.unique(hashes[::-1], return_index=True)
+    flags = np.zeros(count, dtype=bool)
+    flags[count - 1 - last_from_end] = True
+    return flags
+
+# --- เขียนไฟล์รายงานลง ZIP โดยตรง ---
+def report_entry_names(row):
+    """คืนค่าชื่อไฟล์ CSV และ PDF ภายใน ZIP ของแถวหนึ่ง (csv/<กระทรวง>/<กรม>/<จังหวัด>/<หน่วยงาน>/<Node Name>.csv)"""
+    folders = [str(row[column]).strip() for column in ('กระทรวง / สังกัด', 'กรม / สังกัด', 'จังหวัด', 'ชื่อหน่วยงาน')]
+    # Clean node_name for filenames
+    sanitized_node_name = re.sub(r'[\\/:*?"<>|]', '_', str(row['Node Name']).strip())
+    # MODIFIED: เพิ่ม ID เพื่อให้ไฟล์ชื่อไม่ซ้ำกันในกรณีที่ Node Name ซ้ำ
+    # OLD: filename_base = f"{sanitized_node_name}_{nod_id}_{itf_id}" 
+    # NEW: ให้เป็นแค่ Node Name
+    filename_base = f"{sanitized_node_name}"
+    sub_path = posixpath.join(*folders, filename_base)
+    return (posixpath.normpath(posixpath.join('csv', f"{sub_path}.csv")),
+            posixpath.normpath(posixpath.join('pdf', f"{sub_path}.pdf")))
+
+class ReportArchiveWriter:
+    """เขียนไฟล์ CSV/PDF ของแต่ละแถวลง <path>.part ทันที (ชื่อซ้ำใช้แถวสุดท้าย พักไว้ใน <path>.hold) แล้วเปลี่ยนชื่อเมื่อ close"""
+    def __init__(self, path, compresslevel=ZIP_COMPRESSLEVEL):
+        self.path = path
+        self.partial_path = f"{path}.part"
+        self.hold_path = f"{path}.hold"
+        self.compresslevel = compresslevel
+        self.entry_count = 0
+        self._latest = {} # ชื่อ -> (offset, size) ใน self._spill
+        self._spill = None
+        self._zipf = zipfile.ZipFile(self.partial_path, 'w', zipfile.ZIP_DEFLATED)
+
+    def add(self, name, data, last=True):
+        """บันทึกไฟล์ของแถวหนึ่ง (last=False หากยังมีแถวถัดไปที่ใช้ชื่อเดียวกัน) คืนค่าตำแหน่งไฟล์ (ดู read_entry) หรือ None หาก data เป็น None"""
+        if not last:
+            return self._hold(name, data) if data is not None else None
+        if data is None:
+            if name in self._latest:
+                self._write(name, self._read_held(name))
+                del self._latest[name]
+            return None
+        self._latest.pop(name, None)
+        return self._write(name, data)
+
+    def _hold(self, name, data):
+        if self._spill is None:
+            self._spill = open(self.hold_path, 'w+b')
+        offset = self._spill.seek(0, os.SEEK_END)
+        self._spill.write(data)
+        self._spill.flush() # ให้ read_entry ของ process อื่นอ่านได้แม้ process นี้หยุดทำงาน
+        self._latest[name] = (offset, len(data))
+        return name, self.hold_path, offset, len(data), None, zlib.crc32(data)
+
+    def _read_held(self, name):
+        offset, size = self._latest[name]
+        self._spill.seek(offset)
+        return self._spill.read(size)
+
+    def _write(self, name, data):
+        if name.endswith('.pdf'):
+            self._zipf.writestr(name, data, compress_type=zipfile.ZIP_STORED)
+        else:
+            self._zipf.writestr(name, data, compress_type=zipfile.ZIP_DEFLATED, compresslevel=self.compresslevel)
+        self.entry_count += 1
+        # writestr เขียน local header ซ้ำพร้อมขนาดจริงด้วย seek ข้อมูลจึงถูกส่งให้ระบบปฏิบัติการแล้ว
+        info = self._zipf.infolist()[-1]
+        return info.filename, self.partial_path, info.header_offset, info.compress_size, info.compress_type, info.CRC
+
+    @staticmethod
+    def read_entry(location):
+        """อ่านไฟล์จากตำแหน่งที่ add คืนค่าผ่าน local header (อ่านได้แม้ .part ยังไม่สมบูรณ์) ValueError หากชื่อ ขนาด หรือ CRC ไม่ตรง"""
+        name, path, offset, size, method, crc = location
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            if method is not None:
+                header = f.read(30)
+                if len(header) < 30 or header[:4] != b'PK\x03\x04':
+                    raise ValueError(f"ไม่พบไฟล์ '{name}' ใน {path}")
+                name_length, extra_length = struct.unpack('<HH', header[26:30])
+                if f.read(name_length).decode('utf-8', 'replace') != name:
+                    raise ValueError(f"ตำแหน่งของไฟล์ '{name}' ใน {path} ไม่ตรงกัน")
+                f.seek(extra_length, os.SEEK_CUR)
+            data = f.read(size)
+        if len(data) < size:
+            raise ValueError(f"ไฟล์ '{name}' ใน {path} ไม่สมบูรณ์")
+        if method == zipfile.ZIP_DEFLATED:
+            data = zlib.decompress(data, -zlib.MAX_WBITS)
+        if zlib.crc32(data) != crc:
+            raise ValueError(f"CRC ของไฟล์ '{name}' ใน {path} ไม่ตรงกัน")
+        return data
+
+    def close(self):
+        """เขียนไฟล์ที่ยังค้างอยู่ ปิด ZIP แล้วย้ายไปยัง path จริง"""
+        for name in list(self._latest):
+            self._write(name, self._read_held(name))
+        self._latest.clear()
+        self._close_spill()
+        self._zipf.close()
+        os.replace(self.partial_path, self.path)
+        if os.path.exists(self.hold_path):
+            os.remove(self.hold_path)
+
+    def _close_spill(self):
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+
+    def discard(self, keep=False):
+        """ปิด ZIP ที่ยังไม่สมบูรณ์และลบ .part/.hold (keep=True เก็บไว้ให้ทำงานต่อจาก checkpoint)"""
+        try:
+            self._zipf.close()
+        except Exception:
+            pass
+        self._close_spill()
+        if not keep:
+            for path in (self.partial_path, self.hold_path):
+                if os.path.exists(path):
+                    os.remove(path)
+
+def _is_job_canceled(job_id):
+    return current_job_store.get().is_canceled(job_id)
+
+def _transform_fetched_circuits(slots, job_id, report_month, report_mode):
+    """แปลงข้อมูลของทุกวงจรที่ดึงเสร็จแล้วด้วย process_json_batch ครั้งเดียว (incremental ทีละวงจร) แล้วส่งผลผ่าน slot['result']"""
+    ready_slots = []
+    raw_batch = []
+    for slot in slots:
+        try:
+            raw_json_data = slot['fetch'].result()
+        except Exception as e:
+            slot['result'].set_exception(e)
+            continue
+        if not raw_json_data:
+            slot['result'].set_result(None)
+            continue
+        ready_slots.append(slot)
+        raw_batch.append(raw_json_data)
+    if not ready_slots:
+        return
+
+    if report_mode == 'incremental':
+        for slot, raw_json_data in zip(ready_slots, raw_batch):
+            try:
+                with service_metrics.time('transform', job_id):
+                    circuit_result = transform_month_to_date(raw_json_data, *slot['key'], job_id, report_month)
+                slot['result'].set_result(circuit_result)
+            except Exception as e:
+                slot['result'].set_exception(e)
+        return
+
+    series = []
+    started = time.perf_counter()
+    try:
+        circuit_results = process_json_batch(raw_batch, job_id, series)
     except Exception as e:
-        logger.error(f"❌ สร้าง PDF สำหรับ '{node_name}' ล้มเหลว: {e}")
-        return False, f"Error generating PDF: {e}"
+        # หากทั้งชุดล้มเหลว ให้แปลงทีละวงจรเพื่อให้ error อยู่เฉพาะวงจรที่มีปัญหา
+        logger.warning(f"⚠️ ประมวลผลข้อมูลแบบชุดไม่สำเร็จ ({e}) กำลังประมวลผลทีละวงจร")
+        for slot, raw_json_data in zip(ready_slots, raw_batch):
+            try:
+                circuit_series = []
+                with service_metrics.time('transform', job_id):
+                    circuit_result = process_json_data(raw_json_data, job_id, circuit_series)
+                slot['result'].set_result(circuit_result)
+                record_circuit_traffic(*slot['key'], circuit_series[0])
+            except Exception as circuit_e:
+                slot['result'].set_exception(circuit_e)
+        return
+    per_circuit = (time.perf_counter() - started) / len(ready_slots) # เวลาของทั้งชุดเฉลี่ยต่อวงจร
+    for slot, circuit_result, circuit_series in zip(ready_slots, circuit_results, series):
+        service_metrics.observe('transform', per_circuit, job_id)
+        record_circuit_traffic(*slot['key'], circuit_series)
+        slot['result'].set_result(circuit_result)
+
+def _circuit_key_hashes(circuits, start=0):
+    """hash ของ (NodeID, Interface ID) ของทุกแถวตั้งแต่ start ตามลำดับ แปลงเป็นข้อความแบบเดียวกับ iter_prefetched_rows ทีละชุด"""
+    for chunk in circuits.iter_chunks(start):
+        yield from (hash((str(nod_id).strip(), str(itf_id).strip()))
+                    for nod_id, itf_id in zip(chunk['NodeID'].tolist(), chunk['Interface ID'].tolist()))
+
+def iter_prefetched_rows(circuits, job_id, report_month, max_workers=None, prefetch=None, report_mode='full', start=0):
+    """คืนค่า (index, row, future ของผลที่แปลงแล้ว หรือ None) ของแถวตั้งแต่ start โดยดึงข้อมูลล่วงหน้าไม่เกิน prefetch แถวผ่าน fetch_pool"""
+    prefetch = max(1, prefetch or (max_workers or FETCH_WORKERS) * 2)
+    pending = deque()
+    # แถวสุดท้ายของแต่ละวงจร: เก็บ future ไว้ใช้ซ้ำจนถึงแถวนั้นเท่านั้น (circuit_slots มีเฉพาะวงจรที่ยังมีแถวเหลือ)
+    last_rows = last_occurrence_flags(_circuit_key_hashes(circuits, start), len(circuits) - start)
+    circuit_slots = {}
+
+    def next_row():
+        index, row, slot = pending.popleft()
+        if slot is None:
+            return index, row, None
+        if not slot['result'].done():
+            # รอเฉพาะแถวที่เก่าที่สุด แล้วแปลงทุกวงจรในหน้าต่างที่ดึงเสร็จแล้วไปพร้อมกัน
+            slot['fetch'].exception()
+            batch = {id(slot): slot}
+            for _, _, other in pending:
+                if other is not None and not other['result'].done() and other['fetch'].done():
+                    batch[id(other)] = other
+            _transform_fetched_circuits(list(batch.values()), job_id, report_month, report_mode)
+        return index, row, slot['result']
 
-def process_file_in_background(file_stream, job_id):
+    try:
+        for position, (index, row) in enumerate(circuits.iter_rows(start)):
+            if _is_job_canceled(job_id):
+                break
+            slot = None
+            try:
+                nod_id = str(row['NodeID']).strip()
+                itf_id = str(row['Interface ID']).strip()
+                if nod_id and itf_id:
+                    key = (nod_id, itf_id)
+                    slot = circuit_slots.get(key)
+                    if slot is None:
+                        slot = {
+                            'key': key,
+                            'fetch': fetch_pool.submit(job_id, contextvars.copy_context().run, fetch_circuit_shared, nod_id, itf_id, job_id, report_month,
+                                                       max_running=max_workers),
+                            'result': Future()
+                        }
+                    else:
+                        _count_coalesced(job_id)
+                    if last_rows[position]:
+                        circuit_slots.pop(key, None)
+                    else:
+                        circuit_slots[key] = slot
+            except Exception:
+                # ปล่อยให้ลูปหลักจัดการข้อผิดพลาดของแถวนี้เอง
+                slot = None
+            pending.append((index, row, slot))
+            # รอผลของแถวที่เก่าที่สุดก่อน เมื่อมีงานค้างครบจำนวนที่กำหนด
+            if len(pending) >= prefetch:
+                yield next_row()
+        while pending:
+            yield next_row()
+    finally:
+        # กรณีถูกยกเลิก: ไม่ต้องรอแถวที่ยังไม่เริ่มดึงข้อมูล
+        fetch_pool.cancel(job_id)
+
+def _remove_previous_archives(job_id, archive):
+    """ลบ .part/.hold ของงานนี้จากการทำงานครั้งก่อน (ไฟล์ที่ยังใช้ถูกคัดลอกลง archive แล้ว)"""
+    directory = os.path.dirname(archive.partial_path) or '.'
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if (name.startswith(f"customer_reports_{job_id}_") and name.endswith(('.zip.part', '.zip.hold'))
+                and path not in (archive.partial_path, archive.hold_path)):
+            try:
+                os.remove(path)
+            except OSError as e:
+                logger.warning(f"⚠️ ลบไฟล์ ZIP ที่ค้างอยู่ไม่สำเร็จ: {name}: {e}")
+
+def finish_job_metrics(job_id):
+    """บันทึกสรุปเวลาแต่ละขั้นและตัวนับของการทำงานครั้งนี้ลงสถานะสุดท้ายของงาน (ดู ServiceMetrics.finish_job)"""
+    store = current_job_store.get()
+    summary = service_metrics.finish_job(job_id)
+    status = store.get(job_id)
+    if summary is None or status is None:
+        return
+    result = 'canceled' if status['canceled'] else 'failed' if status['error'] else 'completed'
+    service_metrics.inc('solarwind_jobs_finished_total', result, job_id=job_id)
+    summary['result'] = result
+    stages = ", ".join(f"{stage} {stats['total_seconds']:.2f}" for stage, stats in summary['stages'].items())
+    logger.info(f"⏱️ เวลาแต่ละขั้น (วินาที): {stages or '-'} ({summary['rows']} แถว, {summary['rows_per_second'] or 0:.2f} แถว/วินาที)")
+    store.update(job_id, metrics=json.dumps(summary, ensure_ascii=False))
+
+def process_file_in_background(file_stream, job_id, fetch_workers=None, report_month=None, resume_from=0, report_mode=None,
+                               render_workers=None):
     """
     ฟังก์ชันนี้จะทำงานในอีก Thread หนึ่ง
     โดยจะรับ file_stream (ข้อมูลไฟล์) และ job_id มาประมวลผล
     """
-    temp_dir = None # โฟลเดอร์สำหรับ CSV/PDF ย่อย
+    archive = None
+    circuits = None
+    store = current_job_store.get()
+    render_workers = RENDER_WORKERS if render_workers is None else max(0, render_workers)
+    report_month = report_month or CircuitResponseCache.current_month()
+    report_mode = report_mode or REPORT_MODE
+    current_job_id.set(job_id)
+    job_events.open(job_id)
+    service_metrics.start_job(job_id)
+    store.start_heartbeat(job_id)
     try:
-        df = pd.read_excel(file_stream)
-        total_rows = len(df)
-        with status_lock:
-            processing_status[job_id]['total'] = total_rows
-            processing_status[job_id]['results'] = []
-            # สร้าง directory ชั่วคราวสำหรับเก็บไฟล์ CSV/PDF ของงานนี้
-            temp_dir = tempfile.mkdtemp(prefix=f"report_job_{job_id}_")
-            processing_status[job_id]['temp_dir'] = temp_dir # เก็บ temp_dir ไว้ในสถานะ
-        
-        logger.info(f"📊 เริ่มประมวลผลไฟล์ Excel มีทั้งหมด {total_rows} รายการ")
-
-        required_columns = ['NodeID', 'Interface ID', 'กระทรวง / สังกัด', 'กรม / สังกัด', 'จังหวัด', 'ชื่อหน่วยงาน', 'Node Name']
-        if not all(col in df.columns for col in required_columns):
-            missing_cols = [c for c in required_columns if c not in df.columns]
-            with status_lock:
-                processing_status[job_id]['error'] = f"ไฟล์ Excel ขาดคอลัมน์ที่จำเป็น: {', '.join(missing_cols)}"
-                processing_status[job_id]['completed'] = True
-            logger.error(f"❌ {processing_status[job_id]['error']}")
+        # ตรวจหัวคอลัมน์ก่อนอ่านข้อมูล และอ่านเฉพาะคอลัมน์ที่ใช้
+        circuits, missing_cols = read_circuit_list(file_stream.getvalue())
+        if missing_cols:
+            error = f"ไฟล์ Excel ขาดคอลัมน์ที่จำเป็น: {', '.join(missing_cols)}"
+            store.update(job_id, error=error, completed=True)
+            store.clear_checkpoint(job_id) # ไฟล์ที่ขาดคอลัมน์ทำต่อไม่ได้
+            logger.error(f"❌ {error}")
             return
+        total_rows = len(circuits)
+        store.update(job_id, total=total_rows, report_month=report_month)
+        publish_job_progress(job_id)
         
-        # ใช้ temp_dir เป็น root สำหรับการบันทึกไฟล์ชั่วคราว
-        csv_root_dir = os.path.join(temp_dir, 'csv')
-        pdf_root_dir = os.path.join(temp_dir, 'pdf')
-        os.makedirs(csv_root_dir, exist_ok=True)
-        os.makedirs(pdf_root_dir, exist_ok=True)
+        logger.info(f"📊 เริ่มประมวลผลไฟล์ Excel มีทั้งหมด {total_rows} รายการ")
         
-        for index, row in df.iterrows():
-            with status_lock:
-                if processing_status[job_id].get('canceled'):
-                    logger.info(f"⛔ งานถูกยกเลิกโดยผู้ใช้")
+        def add_to_archive(index, names, csv_bytes, pdf_bytes):
+            # คืนค่าตำแหน่งของไฟล์ใน ZIP/ไฟล์พัก สำหรับบันทึกเป็น checkpoint
+            with service_metrics.time('zip'):
+                locations = {'csv': archive.add(names[0], csv_bytes, last_names[index]),
+                             'pdf': archive.add(names[1], pdf_bytes, last_names[index])}
+            for kind, content in (('csv', csv_bytes), ('pdf', pdf_bytes)):
+                if content is not None:
+                    service_metrics.inc('solarwind_bytes_written_total', kind, len(content))
+            return locations
+
+        def entry_names_of(row):
+            # ชื่อไฟล์ภายใน ZIP ของแถว (None หากสร้างชื่อไม่ได้ แถวนั้นจะไม่มีไฟล์ใน ZIP)
+            try:
+                return report_entry_names(row)
+            except Exception:
+                return None
+
+        zip_filename = f"customer_reports_{job_id}_{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}.zip"
+        # ให้ zip_file_path ชี้ไปที่ tempfile.gettempdir() โดยตรง
+        zip_file_path = os.path.join(tempfile.gettempdir(), zip_filename)
+        # แถวสุดท้ายของชื่อไฟล์ที่ซ้ำกัน (hash ของชื่อไฟล์ของทุกแถว สร้างทีละชุด ไม่เก็บชื่อไว้ทั้งหมด)
+        last_names = last_occurrence_flags((hash(entry_names_of(row)) for _, row in circuits.iter_rows()), total_rows)
+        archive = ReportArchiveWriter(zip_file_path)
+
+        if resume_from:
+            logger.info(f"⏩ ทำงานต่อจากแถวที่ {resume_from + 1} (ใช้ไฟล์ของ {resume_from} แถวที่เสร็จแล้วจาก checkpoint)")
+            # คัดลอกไฟล์ของแถวที่เสร็จแล้วจาก .part/.hold ของครั้งก่อนลง ZIP ใหม่ แล้วบันทึกตำแหน่งใหม่แทน
+            for (seq, locations), (_, row) in zip(store.iter_artifacts(job_id, resume_from), circuits.iter_rows()):
+                try:
+                    csv_bytes, pdf_bytes = [ReportArchiveWriter.read_entry(locations[kind]) if locations[kind] is not None else None
+                                            for kind in ('csv', 'pdf')]
+                except (KeyError, OSError, ValueError, zlib.error) as e:
+                    logger.warning(f"⚠️ อ่านไฟล์ของแถวที่ {seq + 1} จาก checkpoint ไม่ได้ ({e}) จะสร้างไฟล์ตั้งแต่แถวนี้ใหม่")
+                    resume_from = seq
+                    store.truncate(job_id, resume_from)
                     break
+                names = entry_names_of(row)
+                if names is not None:
+                    store.save_artifacts(job_id, seq, add_to_archive(seq, names, csv_bytes, pdf_bytes))
+            _remove_previous_archives(job_id, archive)
+            # ส่งผลของแถวที่เสร็จแล้วให้ผู้รับเหตุการณ์ที่เพิ่งเชื่อมต่อมีสรุปผลครบทุกแถว (อ่านจาก job_store ทีละชุด)
+            for start in range(0, resume_from, CHUNK_ROWS):
+                for seq, result in enumerate(store.results(job_id, start, min(CHUNK_ROWS, resume_from - start)), start):
+                    job_events.publish(job_id, 'result', {'result': result, 'index': seq, 'processed': seq + 1, 'total': total_rows})
+        
+        # pipeline: ดึงข้อมูล (thread pool) -> แปลงข้อมูล (เป็นชุดในหน้าต่าง prefetch) -> สร้างไฟล์ (process pool) -> ZIP
+        # แต่ละขั้นมีคิวขนาดจำกัด และผลลัพธ์ของแต่ละแถวจะถูกบันทึกตามลำดับแถวเดิม
+        render_window = max(1, render_workers) * 2
+        pending_renders = deque()
+
+        def record_result(node_name, csv_bytes, pdf_bytes, error_message, locations):
+            result = {
+                'node_name': node_name,
+                'csv_success': csv_bytes is not None,
+                'pdf_success': pdf_bytes is not None,
+                'error_message': error_message
+            }
+            processed = store.add_result(job_id, result, locations)
+            service_metrics.inc('solarwind_rows_processed_total', 'error' if error_message or not (result['csv_success'] and result['pdf_success']) else 'ok')
+            job_events.publish(job_id, 'result', {'result': result, 'index': processed - 1, 'processed': processed, 'total': total_rows})
+
+        def finish_oldest_render():
+            index, names, node_name, render_future, render_pool, render_args, error_message, render_key = pending_renders.popleft()
+            csv_bytes = None
+            pdf_bytes = None
+            if render_future is not None:
+                try:
+                    try:
+                        csv_bytes, pdf_bytes, render_seconds = render_future.result()
+                    except BrokenProcessPool as e:
+                        logger.warning(f"⚠️ process สำหรับสร้างไฟล์หยุดทำงาน ({e}) กำลังสร้างไฟล์ของ '{node_name}' ใหม่")
+                        _reset_render_pool(render_pool)
+                        csv_bytes, pdf_bytes, render_seconds = _render_in_thread(render_args).result()
+                    for stage, seconds in render_seconds.items():
+                        service_metrics.observe(stage, seconds, job_id)
+                    if render_key is not None and csv_bytes is not None and pdf_bytes is not None:
+                        try:
+                            render_cache.put(render_key, csv_bytes, pdf_bytes)
+                        except Exception as e:
+                            logger.warning(f"⚠️ บันทึกไฟล์ของ '{node_name}' ลง cache ไม่สำเร็จ: {e}")
+                except Exception as e:
+                    error_message = f"เกิดข้อผิดพลาดที่ไม่คาดคิดในแถวที่ {index + 1}: {e}"
+                    logger.error(f"❌ {error_message}")
+            locations = add_to_archive(index, names, csv_bytes, pdf_bytes) if names is not None else None
+            record_result(node_name, csv_bytes, pdf_bytes, error_message, locations)
+
+        prefetched_rows = iter_prefetched_rows(circuits, job_id, report_month, max_workers=fetch_workers, report_mode=report_mode, start=resume_from)
+        for index, row, circuit_future in prefetched_rows:
+            if _is_job_canceled(job_id):
+                logger.info("⛔ งานถูกยกเลิกโดยผู้ใช้")
+                break
             
             node_name = ''
-            csv_success = False
-            pdf_success = False
+            names = entry_names_of(row)
+            render_future = None
+            render_pool = None
+            render_args = None
+            render_key = None # key ของ render_cache เมื่อต้องสร้างไฟล์ใหม่ (บันทึกลง cache เมื่อสร้างเสร็จ)
             error_message = None
 
             try:
                 nod_id = str(row['NodeID']).strip()
                 itf_id = str(row['Interface ID']).strip()
-                
-                folder1 = str(row['กระทรวง / สังกัด']).strip()
-                folder2 = str(row['กรม / สังกัด']).strip()
-                folder3 = str(row['จังหวัด']).strip()
-                folder4 = str(row['ชื่อหน่วยงาน']).strip()
                 node_name = str(row['Node Name']).strip()
 
                 if not nod_id or not itf_id:
                     error_message = "ข้อมูล NodeID หรือ Interface ID ไม่สมบูรณ์"
                     logger.warning(f"⚠️ ข้ามแถวที่ {index + 1} เนื่องจาก {error_message} (NodeID: '{nod_id}', ITF ID: '{itf_id}')")
-                    with status_lock:
-                        processing_status[job_id]['processed'] += 1
-                        processing_status[job_id]['results'].append({
-                            'node_name': node_name,
-                            'csv_success': False,
-                            'pdf_success': False,
-                            'error_message': error_message
-                        })
-                    continue
-                
-                logger.info(f"▶ กำลังประมวลผล NodeID: {nod_id}, Interface ID: {itf_id} (แถวที่ {index + 1})")
-
-                # สร้าง sub-directory ภายใต้ temp_dir
-                current_csv_dir = os.path.join(csv_root_dir, folder1, folder2, folder3, folder4)
-                current_pdf_dir = os.path.join(pdf_root_dir, folder1, folder2, folder3, folder4)
-                
-                os.makedirs(current_csv_dir, exist_ok=True)
-                os.makedirs(current_pdf_dir, exist_ok=True)
-                
-                raw_json_data = get_data_from_api(nod_id, itf_id, job_id)
+                else:
+                    logger.info(f"▶ กำลังประมวลผล NodeID: {nod_id}, Interface ID: {itf_id} (แถวที่ {index + 1})")
 
-                if raw_json_data:
-                    headers, processed_data, monthly_averages = process_json_data(raw_json_data, job_id)
+                    if names is None:
+                        report_entry_names(row) # ให้ข้อผิดพลาดของชื่อไฟล์ถูกรายงานเป็นข้อผิดพลาดของแถวนี้
                     
-                    # Clean node_name for filenames
-                    sanitized_node_name = re.sub(r'[\\/:*?"<>|]', '_', node_name)
-                    # MODIFIED: เพิ่ม ID เพื่อให้ไฟล์ชื่อไม่ซ้ำกันในกรณีที่ Node Name ซ้ำ
-                    # OLD: filename_base = f"{sanitized_node_name}_{nod_id}_{itf_id}" 
-                    # NEW: ให้เป็นแค่ Node Name
-                    filename_base = f"{sanitized_node_name}" 
-
-                    csv_filename = os.path.join(current_csv_dir, f"{filename_base}.csv")
-                    pdf_filename = os.path.join(current_pdf_dir, f"{filename_base}.pdf")
-
-                    csv_success, csv_msg = export_to_csv(headers, processed_data, monthly_averages, csv_filename, job_id, node_name)
-                    pdf_success, pdf_msg = export_to_pdf(headers, processed_data, monthly_averages, pdf_filename, job_id, node_name)
-                else:
-                    error_message = f"ไม่สามารถดึงข้อมูลจาก API ได้สำหรับ NodeID: {nod_id}, Interface ID: {itf_id}"
-                    logger.error(f"❌ {error_message}")
+                    if circuit_future is not None:
+                        circuit_data = circuit_future.result()
+                    else:
+                        circuit_data = load_circuit(nod_id, itf_id, job_id, report_month, report_mode)
+
+                    if circuit_data:
+                        headers, processed_data, monthly_averages = circuit_data
+                        render_args = (headers, processed_data, monthly_averages, job_id, node_name)
+                        cached_files = None
+                        if render_cache is not None:
+                            render_key = render_cache.key(headers, processed_data, monthly_averages)
+                            try:
+                                cached_files = render_cache.get(render_key)
+                            except Exception as e:
+                                logger.warning(f"⚠️ อ่านไฟล์ของ '{node_name}' จาก cache ไม่สำเร็จ: {e}")
+                            service_metrics.inc('solarwind_render_cache_requests_total', 'misses' if cached_files is None else 'hits')
+                        if cached_files is not None:
+                            logger.info(f"💾 ใช้ไฟล์ CSV/PDF เดิมของ '{node_name}' (ข้อมูลไม่เปลี่ยน)")
+                            render_key = None
+                            render_future = Future()
+                            render_future.set_result((*cached_files, {}))
+                        else:
+                            render_future, render_pool = submit_render(render_args, render_workers)
+                    else:
+                        error_message = f"ไม่สามารถดึงข้อมูลจาก API ได้สำหรับ NodeID: {nod_id}, Interface ID: {itf_id}"
+                        logger.error(f"❌ {error_message}")
             
             except Exception as e:
                 error_message = f"เกิดข้อผิดพลาดที่ไม่คาดคิดในแถวที่ {index + 1}: {e}"
                 logger.error(f"❌ {error_message}")
                 
             finally:
-                with status_lock:
-                    processing_status[job_id]['processed'] += 1
-                    processing_status[job_id]['results'].append({
-                        'node_name': node_name,
-                        'csv_success': csv_success,
-                        'pdf_success': pdf_success,
-                        'error_message': error_message
-                    })
+                pending_renders.append((index, names, node_name, render_future, render_pool, render_args, error_message, render_key))
+                # รอไฟล์ของแถวที่เก่าที่สุดก่อน เมื่อมีงานสร้างไฟล์ค้างครบจำนวนที่กำหนด
+                while len(pending_renders) >= render_window or (pending_renders and pending_renders[0][3] is None):
+                    finish_oldest_render()
+        prefetched_rows.close() # หยุด worker ที่ยังค้างอยู่ (กรณีถูกยกเลิก)
+
+        if _is_job_canceled(job_id):
+            # ไม่ต้องรอไฟล์ที่ยังสร้างไม่เสร็จของงานที่ถูกยกเลิก
+            for _, _, _, render_future, _, _, _, _ in pending_renders:
+                if render_future is not None:
+                    render_future.cancel()
+            pending_renders.clear()
+        while pending_renders:
+            finish_oldest_render()
         
-        # หลังประมวลผลทั้งหมด สร้างไฟล์ ZIP
-        if not processing_status[job_id].get('canceled'):
-            zip_filename = f"customer_reports_{job_id}_{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}.zip"
-            # ให้ zip_file_path ชี้ไปที่ tempfile.gettempdir() โดยตรง
-            zip_file_path = os.path.join(tempfile.gettempdir(), zip_filename)
-            
-            if temp_dir and os.path.exists(temp_dir):
-                with zipfile.ZipFile(zip_file_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                    for root, _, files in os.walk(temp_dir):
-                        for file in files:
-                            file_path = os.path.join(root, file)
-                            # สร้าง relative path ภายใน zip (ตัด temp_dir ออก)
-                            arcname = os.path.relpath(file_path, temp_dir)
-                            zipf.write(file_path, arcname)
-                
-                with status_lock:
-                    processing_status[job_id]['zip_file_path'] = zip_file_path
-                    processing_status[job_id]['completed'] = True
-                logger.info(f"✅ การสร้างรายงานเสร็จสมบูรณ์! ไฟล์ ZIP: {zip_file_path.split(os.sep)[-1]}")
+        # หลังประมวลผลทั้งหมด ปิดไฟล์ ZIP
+        if not _is_job_canceled(job_id):
+            archive.close()
+            if store.complete(job_id, zip_file_path):
+                store.clear_checkpoint(job_id)
+                logger.info(f"✅ การสร้างรายงานเสร็จสมบูรณ์! ไฟล์ ZIP: {zip_file_path.split(os.sep)[-1]} ({archive.entry_count} ไฟล์)")
             else:
-                with status_lock:
-                    processing_status[job_id]['error'] = "ไม่พบโฟลเดอร์ชั่วคราวสำหรับสร้าง ZIP"
-                    processing_status[job_id]['completed'] = True
-                logger.error(f"❌ ไม่พบโฟลเดอร์ชั่วคราว '{temp_dir}' ไม่สามารถสร้าง ZIP ได้")
+                logger.warning("⚠️ งานนี้ถูก process อื่นรับไปทำต่อแล้ว ไม่บันทึกผลของ process นี้")
+            archive = None
         else:
-            with status_lock:
-                 processing_status[job_id]['completed'] = True
-                 processing_status[job_id]['error'] = "การประมวลผลถูกยกเลิก"
+            store.update(job_id, completed=True, error=JobStore.CANCEL_ERROR)
 
     except Exception as e:
-        with status_lock:
-            processing_status[job_id]['error'] = f"เกิดข้อผิดพลาดในระหว่างการประมวลผลเบื้องหลัง: {e}"
-            processing_status[job_id]['completed'] = True
-        logger.critical(f"❌ {processing_status[job_id]['error']}")
+        error = f"เกิดข้อผิดพลาดในระหว่างการประมวลผลเบื้องหลัง: {e}"
+        store.update(job_id, error=error, completed=True)
+        store.clear_checkpoint(job_id) # งานที่ล้มเหลวทำต่อไม่ได้ (ดู JobStore.resume)
+        logger.critical(f"❌ {error}")
     finally:
-        # **สำคัญ:** ลบเฉพาะโฟลเดอร์ชั่วคราวสำหรับ CSV/PDF (temp_dir)
-        # ไฟล์ ZIP จะถูกเก็บไว้ใน tempfile.gettempdir() และไม่ถูกลบจากที่นี่
-        if temp_dir and os.path.exists(temp_dir):
-            try:
-                shutil.rmtree(temp_dir, ignore_errors=True)
-                logger.info(f"📁 ลบโฟลเดอร์ CSV/PDF ชั่วคราว: {temp_dir.split(os.sep)[-1]} แล้ว (ไม่รวมไฟล์ ZIP)")
-            except Exception as e:
-                logger.error(f"❌ ข้อผิดพลาดในการลบโฟลเดอร์ CSV/PDF ชั่วค้าง: {e}")
+        store.stop_heartbeat(job_id)
+        if circuits is not None:
+            circuits.close()
+        # ZIP ที่ยังไม่สมบูรณ์ (กรณีถูกยกเลิกหรือเกิดข้อผิดพลาด): เก็บไว้ทำงานต่อหากมี checkpoint มิฉะนั้นลบ
+        if archive is not None:
+            keep = store.has_checkpoint(job_id)
+            archive.discard(keep=keep)
+            if keep:
+                logger.info("📁 เก็บไฟล์ ZIP ที่ยังไม่สมบูรณ์ของงานนี้ไว้สำหรับทำงานต่อ")
+            else:
+                logger.info("📁 ลบไฟล์ ZIP ที่ยังไม่สมบูรณ์ของงานนี้แล้ว")
+        finish_job_metrics(job_id)
+        publish_job_progress(job_id, final=True)
         
-        # *** สำคัญมาก: ไม่มีการลบ job_id ออกจาก processing_status ที่นี่แล้ว ***
+        # *** สำคัญมาก: ไม่มีการลบ job_id ออกจาก job_store ที่นี่แล้ว ***
         # เพื่อให้สามารถดาวน์โหลดไฟล์ ZIP ซ้ำได้
         # แต่คุณจะต้องจัดการการล้างสถานะและไฟล์ ZIP เก่าๆ ด้วยตัวเองในภายหลัง
         # ดูฟังก์ชัน `cleanup_old_jobs` ด้านล่างเป็นตัวอย่าง
 
 
+# --- คิวงาน: ประมวลผลพร้อมกันได้ไม่เกิน MAX_CONCURRENT_JOBS งาน ---
+class JobScheduler:
+    """รันงานด้วย thread max_jobs ตัว งานที่เกินรอในคิวโดยบันทึกตำแหน่งใน job_store ทุก heartbeat_seconds"""
+    def __init__(self, max_jobs, heartbeat_seconds=60):
+        self.max_jobs = max_jobs
+        self.heartbeat_seconds = heartbeat_seconds
+        self._cond = threading.Condition()
+        self._publish_lock = threading.Lock()
+        self._queue = deque() # (job_id, fn, args, kwargs)
+        self._threads = []
+        self._running = 0
+
+    def submit(self, job_id, fn, *args, **kwargs):
+        """ส่งงานเข้าคิว fn(*args, **kwargs) จะถูกเรียกเมื่อถึงคิว"""
+        with self._cond:
+            self._queue.append((job_id, fn, args, kwargs))
+            if not self._threads:
+                threading.Thread(target=self._heartbeat, name="job-queue-heartbeat", daemon=True).start()
+            if len(self._threads) < self.max_jobs:
+                thread = threading.Thread(target=self._worker, name=f"job-{len(self._threads)}", daemon=True)
+                self._threads.append(thread)
+                thread.start()
+            self._cond.notify()
+        self._publish_positions()
+
+    def discard(self, job_id):
+        """นำงานที่ยังรออยู่ออกจากคิว คืนค่า True หากพบ"""
+        with self._cond:
+            kept = deque(item for item in self._queue if item[0] != job_id)
+            found = len(kept) != len(self._queue)
+            self._queue = kept
+        if found:
+            job_store.update(job_id, queue_position=0)
+            self._publish_positions()
+        return found
+
+    def _publish_positions(self):
+        # อ่านคิวหลังได้ lock เสมอ ผู้บันทึกคนสุดท้ายจึงบันทึกตำแหน่งล่าสุด
+        with self._publish_lock:
+            with self._cond:
+                queued = [item[0] for item in self._queue]
+            for position, job_id in enumerate(queued, 1):
+                job_store.update(job_id, queue_position=position)
+                publish_job_progress(job_id)
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(self.heartbeat_seconds)
+            try:
+                self._publish_positions()
+            except Exception as e:
+                logger.warning(f"⚠️ บันทึกตำแหน่งในคิวไม่สำเร็จ: {e}")
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                job_id, fn, args, kwargs = self._queue.popleft()
+                self._running += 1
+            try:
+                job_store.update(job_id, queue_position=0)
+                self._publish_positions()
+                if job_store.is_canceled(job_id):
+                    # ถูกยกเลิกระหว่างรอในคิว (จาก process อื่น)
+                    job_store.update(job_id, completed=True, error=JobStore.CANCEL_ERROR)
+                    publish_job_progress(job_id, final=True)
+                    continue
+                # เริ่มแต่ละงานด้วย context ใหม่ (เหมือน thread ใหม่) เพื่อไม่ให้ current_job_id ของงานก่อนติดมา
+                contextvars.Context().run(fn, *args, **kwargs)
+            except Exception as e:
+                logger.error(f"❌ เกิดข้อผิดพลาดในการเริ่มงานจากคิว: {e}", extra={'job_id': job_id})
+            finally:
+                with self._cond:
+                    self._running -= 1
+
+    def snapshot(self):
+        """จำนวนงานที่รอในคิวและกำลังทำงานใน process นี้"""
+        with self._cond:
+            return {'queued': len(self._queue), 'running': self._running}
+
+job_scheduler = JobScheduler(MAX_CONCURRENT_JOBS, heartbeat_seconds=max(1, JOB_STALE_SECONDS // 3))
+
 # --- Route สำหรับ Flask App ---
 @app.route('/')
 def upload_form():
@@ -757,52 +2779,145 @@ def generate_report():
     if file.filename == '':
         return jsonify({"error": "No selected file"}), 400
     
+    # เดือนของรายงาน (YYYY-MM) ใช้ค้นหาข้อมูลใน cache หากไม่ระบุจะใช้เดือนปัจจุบัน
+    report_month = request.form.get('report_month', '').strip() or None
+    if report_month and not re.fullmatch(r"\d{4}-(0[1-9]|1[0-2])", report_month):
+        return jsonify({"error": "Invalid report_month (expected YYYY-MM)"}), 400
+    # โหมดรายงาน: 'full' หรือ 'incremental' หากไม่ระบุจะใช้ REPORT_MODE
+    report_mode = request.form.get('report_mode', '').strip() or REPORT_MODE
+    if report_mode not in REPORT_MODES:
+        return jsonify({"error": f"Invalid report_mode (expected one of: {', '.join(REPORT_MODES)})"}), 400
+
     if file:
         job_id = str(uuid.uuid4())
-        file_stream = io.BytesIO(file.read())
+        workbook = file.read()
+        file_stream = io.BytesIO(workbook)
         
-        with status_lock:
-            processing_status[job_id] = {
-                'total': -1, 
-                'processed': 0, 
-                'completed': False, 
-                'error': None,
-                'canceled': False,
-                'results': [],
-                'temp_dir': None,       # เก็บ directory ชั่วคราว (สำหรับ CSV/PDF)
-                'zip_file_path': None,  # เก็บ path ของไฟล์ zip
-                'timestamp': datetime.datetime.now() # เพิ่ม timestamp สำหรับการล้างข้อมูลในอนาคต
-            }
-        logger.info(f"📂 ได้รับไฟล์ excel '{file.filename}' และเริ่มการประมวลผล (Job ID: {job_id})")
-
-        thread = threading.Thread(target=process_file_in_background, args=(file_stream, job_id))
-        thread.daemon = True # ทำให้ thread จบเมื่อ process หลักจบ
-        thread.start()
+        # สถานะเริ่มต้น: total -1, ตัวนับเป็น 0, timestamp เป็นเวลาปัจจุบัน (ใช้ในการล้างข้อมูล)
+        job_store.create(job_id, report_month=report_month, report_mode=report_mode)
+        job_store.save_source(job_id, file.filename, workbook) # เก็บไว้สำหรับทำงานต่อ (resume)
+        job_events.open(job_id)
+        logger.info(f"📂 ได้รับไฟล์ excel '{file.filename}' และเริ่มการประมวลผล (Job ID: {job_id})", extra={'job_id': job_id})
+
+        # รอในคิวหากมีงานทำงานอยู่ครบ MAX_CONCURRENT_JOBS แล้ว (ดูตำแหน่งได้จาก queue_position ใน /status)
+        job_scheduler.submit(job_id, process_file_in_background, file_stream, job_id,
+                             report_month=report_month, report_mode=report_mode)
         
         return jsonify({"message": "Processing started", "job_id": job_id})
 
+def _gzip_json_response(payload):
+    """สร้าง JSON response และบีบอัดด้วย gzip เมื่อ client รองรับและมีขนาดตั้งแต่ STATUS_GZIP_MIN_BYTES"""
+    response = jsonify(payload)
+    response.vary.add('Accept-Encoding')
+    body = response.get_data()
+    if len(body) >= STATUS_GZIP_MIN_BYTES and 'gzip' in request.accept_encodings:
+        response.set_data(gzip.compress(body, compresslevel=5))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
 @app.route('/status/<job_id>')
 def get_status(job_id):
     """
-    ตรวจสอบสถานะของงานที่กำลังประมวลผลอยู่
+    ตรวจสอบสถานะของงานที่กำลังประมวลผลอยู่ (?cursor=<n> คืนเฉพาะ results หลังแถวที่ n)
     """
-    with status_lock:
-        status = processing_status.get(job_id, {})
-    return jsonify(status)
+    cursor = request.args.get('cursor', type=int)
+    payload = job_store.get(job_id)
+    if payload is None:
+        return jsonify({})
+    payload['api_concurrency'] = api_concurrency.snapshot() # ค่าของ process นี้ (ใช้ร่วมกันทุกงาน)
+    if cursor is None:
+        payload['results'] = job_store.results(job_id)
+    else:
+        cursor = max(0, cursor)
+        payload['results'] = job_store.results(job_id, cursor)
+        payload['cursor'] = cursor + len(payload['results'])
+    return _gzip_json_response(payload)
+
+@app.route('/metrics')
+def get_metrics():
+    """ตัววัดของ process นี้ในรูปแบบ Prometheus (เวลาแต่ละขั้น, ตัวนับ และค่าปัจจุบันของ API/คิวงาน)"""
+    concurrency = api_concurrency.snapshot()
+    scheduler = job_scheduler.snapshot()
+    gauges = [
+        ('solarwind_api_concurrency_limit', 'จำนวนคำขอ API พร้อมกันที่อนุญาตในขณะนี้ (AIMD)', concurrency['limit']),
+        ('solarwind_api_in_flight', 'จำนวนคำขอ API ที่กำลังรอผล', concurrency['in_flight']),
+        ('solarwind_api_breaker_open', '1 เมื่อ circuit breaker ของ API เปิดอยู่', int(api_breaker.is_open)),
+        ('solarwind_job_queue_length', 'จำนวนงานที่รอในคิว', scheduler['queued']),
+        ('solarwind_jobs_running', 'จำนวนงานที่กำลังทำงาน', scheduler['running']),
+    ]
+    return Response(service_metrics.render(gauges), mimetype='text/plain; version=0.0.4')
 
 @app.route('/logs/<job_id>')
 def get_logs(job_id):
     """
-    ดึง log ของงานที่กำลังประมวลผลอยู่
+    ดึง log ของงานที่เกิดขึ้นหลัง ?cursor=<id> พร้อม cursor ใหม่
     """
-    logs = []
-    # ดึง log ออกจาก queue จนกว่าจะว่างเปล่า
-    while not log_queue.empty():
-        try:
-            logs.append(log_queue.get_nowait())
-        except Exception:
+    events = job_events.get(job_id)
+    if events is None:
+        return jsonify({"logs": [], "cursor": 0})
+    cursor = request.args.get('cursor', 0, type=int)
+    new_events, _ = events.read(cursor, replay=False)
+    logs = [data['message'] for _, event_type, data in new_events if event_type == 'log']
+    return jsonify({"logs": logs, "cursor": new_events[-1][0] if new_events else cursor})
+
+def _format_sse(event_id, event_type, data):
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event_type}")
+    lines.append(f"data: {json.dumps(data, ensure_ascii=False, default=str)}")
+    return "\n".join(lines) + "\n\n"
+
+def _poll_job_store_events(job_id, snapshot):
+    """สร้างเหตุการณ์ progress/result/done จาก job_store สำหรับงานของ process อื่น (ไม่มี log และไม่มี id ของเหตุการณ์)"""
+    yield "retry: 2000\n" + _format_sse(None, 'progress', snapshot)
+    cursor = 0
+    last_sent = time.monotonic()
+    while True:
+        # อ่านสถานะก่อน results เพื่อให้ได้ผลครบทุกแถวเมื่อสถานะบอกว่างานเสร็จแล้ว
+        snapshot = job_status_snapshot(job_id)
+        for result in job_store.results(job_id, cursor):
+            cursor += 1
+            yield _format_sse(None, 'result', {'result': result, 'index': cursor - 1, 'processed': cursor, 'total': snapshot['total'] if snapshot else cursor})
+            last_sent = time.monotonic()
+        if snapshot is None or snapshot['completed']:
+            yield _format_sse(None, 'done', snapshot or {})
             break
-    return jsonify({"logs": logs})
+        if time.monotonic() - last_sent >= EVENT_STREAM_KEEPALIVE:
+            yield ": keep-alive\n\n"
+            last_sent = time.monotonic()
+        time.sleep(EVENT_STORE_POLL_SECONDS)
+
+@app.route('/events/<job_id>')
+def stream_job_events(job_id):
+    """ส่ง progress, result, log และ done ของงานแบบ Server-Sent Events (ต่อจากเดิมได้ด้วย Last-Event-ID หรือ ?cursor=<id>)"""
+    events = job_events.get(job_id)
+    snapshot = job_status_snapshot(job_id)
+    if snapshot is None:
+        return jsonify({"error": "Job not found"}), 404
+    if events is None:
+        # งานนี้ทำงานอยู่ใน process อื่น (หรือ process ถูก recycle): อ่านความคืบหน้าจาก job_store แทน
+        return Response(stream_with_context(_poll_job_store_events(job_id, snapshot)), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    cursor = request.headers.get('Last-Event-ID', type=int)
+    if cursor is None:
+        cursor = request.args.get('cursor', 0, type=int)
+
+    def generate(cursor):
+        # สรุปสถานะปัจจุบันก่อน (ไม่มี id เพื่อไม่ให้ cursor ของผู้รับเปลี่ยน)
+        yield "retry: 2000\n" + _format_sse(None, 'progress', snapshot)
+        while True:
+            new_events, closed = events.read(cursor, timeout=EVENT_STREAM_KEEPALIVE)
+            for event_id, event_type, data in new_events:
+                yield _format_sse(event_id, event_type, data)
+                cursor = event_id
+            if closed:
+                break
+            if not new_events:
+                yield ": keep-alive\n\n"
+
+    return Response(stream_with_context(generate(cursor)), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 @app.route('/cancel/<job_id>', methods=['POST'])
@@ -810,22 +2925,44 @@ def cancel_job(job_id):
     """
     รับคำสั่งยกเลิกงานที่กำลังประมวลผลอยู่
     """
-    with status_lock:
-        if job_id in processing_status:
-            processing_status[job_id]['canceled'] = True
-            logger.info(f"⛔ ได้รับคำขอยกเลิกงาน (Job ID: {job_id})")
-            return jsonify({"message": "Job cancellation requested"}), 200
-        else:
-            logger.warning(f"⚠️ พยายามยกเลิกงานที่ไม่พบ (Job ID: {job_id})")
-            return jsonify({"error": "Job not found"}), 404
+    # worker ของงาน (อาจอยู่คนละ process) จะเห็นสถานะยกเลิกจาก job_store ก่อนเริ่มแถวถัดไป
+    if job_store.request_cancel(job_id):
+        logger.info(f"⛔ ได้รับคำขอยกเลิกงาน (Job ID: {job_id})", extra={'job_id': job_id})
+        if job_scheduler.discard(job_id):
+            # ยังไม่เริ่มทำงาน: ปิดงานทันที (ทำต่อด้วย /resume ได้)
+            job_store.update(job_id, completed=True, error=JobStore.CANCEL_ERROR)
+            publish_job_progress(job_id, final=True)
+        return jsonify({"message": "Job cancellation requested"}), 200
+    else:
+        logger.warning(f"⚠️ พยายามยกเลิกงานที่ไม่พบ (Job ID: {job_id})")
+        return jsonify({"error": "Job not found"}), 404
+
+@app.route('/resume/<job_id>', methods=['POST'])
+def resume_job(job_id):
+    """ทำงานที่ถูกยกเลิกหรือหยุดกลางคันต่อจากแถวแรกที่ยังไม่เสร็จ โดยใช้ไฟล์ของแถวที่เสร็จแล้วจาก checkpoint"""
+    job_info = job_store.get(job_id)
+    if not job_info:
+        return jsonify({"error": "Job not found"}), 404
+    resume_from = job_store.resume(job_id)
+    if resume_from is None:
+        if not job_info['completed']:
+            return jsonify({"error": "Job is still running"}), 409
+        return jsonify({"error": "Job cannot be resumed (already completed, failed, or has no checkpoint)"}), 409
+    # .part/.hold ของครั้งก่อนถูกอ่านแล้วลบใน process_file_in_background
+    workbook = job_store.load_source(job_id)
+    job_events.open(job_id)
+    logger.info(f"⏩ ได้รับคำขอทำงานต่อ (Job ID: {job_id}) เสร็จแล้ว {resume_from} จาก {job_info['total']} รายการ", extra={'job_id': job_id})
+
+    job_scheduler.submit(job_id, process_file_in_background, io.BytesIO(workbook), job_id,
+                         report_month=job_info['report_month'], resume_from=resume_from, report_mode=job_info['report_mode'])
+    return jsonify({"message": "Processing resumed", "job_id": job_id, "resume_from": resume_from})
 
 @app.route('/download_report/<job_id>')
 def download_report(job_id):
     """
     ให้ผู้ใช้ดาวน์โหลดไฟล์ ZIP ที่สร้างขึ้น
     """
-    with status_lock:
-        job_info = processing_status.get(job_id)
+    job_info = job_store.get(job_id)
 
     if not job_info:
         logger.error(f"❌ ไม่พบข้อมูลงานสำหรับดาวน์โหลด (Job ID: {job_id})")
@@ -842,7 +2979,7 @@ def download_report(job_id):
     try:
         directory = tempfile.gettempdir()
         filename = os.path.basename(zip_file_path)
-        logger.info(f"📥 กำลังส่งไฟล์ ZIP: {filename} จาก {directory} (Job ID: {job_id})")
+        logger.info(f"📥 กำลังส่งไฟล์ ZIP: {filename} จาก {directory} (Job ID: {job_id})", extra={'job_id': job_id})
         
         # MODIFIED: กำหนดชื่อไฟล์ ZIP ที่ผู้ใช้จะดาวน์โหลด
         current_date_str = datetime.datetime.now().strftime('%Y%m%d') # รูปแบบ ปีเดือนวัน
@@ -875,25 +3012,31 @@ def cleanup_old_jobs():
     retention_hours = 24  # กำหนดเวลาที่ต้องการเก็บไฟล์ (เช่น 24 ชั่วโมง) # ควรปรับค่านี้ตามความเหมาะสมของการใช้งานและพื้นที่ดิสก์
     retention_seconds = retention_hours * 3600
 
-    with status_lock:
-        # ใช้ list() เพื่อสร้างสำเนาของ keys/items เพื่อป้องกัน RuntimeError: dictionary changed size during iteration
-        for job_id, job_info in list(processing_status.items()): 
-            # ลบงานที่เสร็จสมบูรณ์แล้วและเกินเวลาที่กำหนด
-            # หรือลบงานที่เกิดข้อผิดพลาดและนานเกินไป
-            if job_info.get('completed') and job_info.get('timestamp'): 
-                job_timestamp = job_info['timestamp']
-                if (current_time - job_timestamp).total_seconds() > retention_seconds:
-                    jobs_to_remove.append(job_id)
-            elif (not job_info.get('completed')) and (current_time - job_info.get('timestamp', current_time)).total_seconds() > (retention_seconds / 4): # หากยังไม่เสร็จ อาจจะลบเร็วขึ้น
-                # อาจจะเพิ่ม logic สำหรับงานที่ค้างนานเกินไปและยังไม่เสร็จสมบูรณ์
-                logger.warning(f"⚠️ พบงานค้างเก่า (ไม่สมบูรณ์) กำลังถูกลบ: {job_id}")
+    try:
+        stale_jobs = job_store.fail_stale_jobs()
+        if stale_jobs:
+            logger.warning(f"⚠️ ปิดงานที่ process ประมวลผลหยุดทำงานแล้ว {stale_jobs} งาน")
+    except Exception as e:
+        logger.error(f"❌ ข้อผิดพลาดในการปิดงานที่หยุดกลางคัน: {e}")
+
+    for job_id, job_info in job_store.list_jobs():
+        # ลบงานที่เสร็จสมบูรณ์แล้วและเกินเวลาที่กำหนด
+        # หรือลบงานที่เกิดข้อผิดพลาดและนานเกินไป
+        if job_info.get('completed') and job_info.get('timestamp'): 
+            job_timestamp = job_info['timestamp']
+            if (current_time - job_timestamp).total_seconds() > retention_seconds:
                 jobs_to_remove.append(job_id)
+        elif (not job_info.get('completed')) and (current_time - job_info.get('timestamp', current_time)).total_seconds() > (retention_seconds / 4): # หากยังไม่เสร็จ อาจจะลบเร็วขึ้น
+            # อาจจะเพิ่ม logic สำหรับงานที่ค้างนานเกินไปและยังไม่เสร็จสมบูรณ์
+            logger.warning(f"⚠️ พบงานค้างเก่า (ไม่สมบูรณ์) กำลังถูกลบ: {job_id}")
+            jobs_to_remove.append(job_id)
 
 
     for job_id in jobs_to_remove:
-        with status_lock:
-            # ใช้ .pop() เพื่อลบ key ออกจาก dictionary พร้อมกับได้ value กลับมา
-            job_info = processing_status.pop(job_id, None) 
+        # job_store.delete คืนค่าสถานะก่อนลบ (None หาก process อื่นลบไปแล้ว)
+        job_scheduler.discard(job_id)
+        job_info = job_store.delete(job_id)
+        job_events.discard(job_id)
         if job_info:
             zip_file_path = job_info.get('zip_file_path')
             if zip_file_path and os.path.exists(zip_file_path):
@@ -903,14 +3046,139 @@ def cleanup_old_jobs():
                 except Exception as e:
                     logger.error(f"❌ ข้อผิดพลาดในการลบไฟล์ ZIP เก่า: {e} (Job ID: {job_id})")
             logger.info(f"✨ ล้างสถานะงานสำหรับ Job ID: {job_id} แล้ว")
+    try:
+        removed = month_to_date_store.purge(MONTH_TO_DATE_RETENTION_DAYS * 86400)
+        if removed:
+            logger.info(f"🗑️ ลบสถานะรายงานสะสมที่ไม่ได้ใช้ {removed} วงจร")
+    except Exception as e:
+        logger.error(f"❌ ข้อผิดพลาดในการลบสถานะรายงานสะสม: {e}")
     logger.info("🧹 กระบวนการล้างข้อมูลงานเก่าเสร็จสมบูรณ์")
     # ตั้งเวลาเรียกตัวเองใหม่
     threading.Timer(retention_seconds / 2, cleanup_old_jobs).start() # รันบ่อยขึ้นเล็กน้อย (เช่น ทุกๆ 12 ชั่วโมง)
 
-# --- ส่วนของการรัน Flask App ---
-if __name__ == '__main__':
-    cleanup_thread = threading.Thread(target=cleanup_old_jobs)
-    cleanup_thread.daemon = True # ทำให้ thread จบเมื่อ process หลักจบ
-    cleanup_thread.start()
+# --- โหมด command line: สร้างรายงานจากไฟล์โดยไม่เริ่ม Flask (เช่น cron รายเดือน) ---
+OUTPUT_FORMATS = ('zip', 'files')
+
+def _report_month_arg(value):
+    if not re.fullmatch(r"\d{4}-(0[1-9]|1[0-2])", value):
+        raise argparse.ArgumentTypeError("ต้องอยู่ในรูปแบบ YYYY-MM")
+    return value
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(
+        description="สร้างรายงาน Solarwinds (CSV/PDF) หากไม่ระบุไฟล์รายชื่อวงจรจะเริ่มเว็บ (Flask) ตามปกติ",
+        epilog="exit code: 0 = สำเร็จทุกแถว, 1 = งานล้มเหลว, 3 = บางแถวไม่สำเร็จ")
+    parser.add_argument('workbook', nargs='?', help="ไฟล์รายชื่อวงจร (.xlsx, .xls หรือ .csv)")
+    parser.add_argument('-o', '--output-dir', default='.', help="โฟลเดอร์สำหรับไฟล์ผลลัพธ์ (ค่าเริ่มต้น: โฟลเดอร์ปัจจุบัน)")
+    parser.add_argument('--format', choices=OUTPUT_FORMATS, default='zip',
+                        help="zip = ไฟล์ ZIP เดียวแบบเดียวกับที่ดาวน์โหลดจากเว็บ, files = แตกไฟล์ CSV/PDF ลง output-dir")
+    parser.add_argument('--month', type=_report_month_arg, help="เดือนของรายงาน (YYYY-MM) ค่าเริ่มต้นคือเดือนปัจจุบัน")
+    parser.add_argument('--mode', choices=REPORT_MODES, default=REPORT_MODE, help=f"โหมดรายงาน (ค่าเริ่มต้น: {REPORT_MODE})")
+    parser.add_argument('--fetch-workers', type=int,
+                        help=f"จำนวนคำขอ API ของงานนี้ที่ทำงานพร้อมกันได้สูงสุด (ไม่เกินขีดจำกัดของ process ดู SOLARWINDS_API_MAX_CONCURRENCY) "
+                             f"และดึงข้อมูลล่วงหน้าไม่เกินสองเท่าของค่านี้ (ค่าเริ่มต้น: ไม่จำกัดเพิ่ม ดึงล่วงหน้า {FETCH_WORKERS * 2} แถว)")
+    parser.add_argument('--render-workers', type=int, default=RENDER_WORKERS,
+                        help=f"จำนวน process สร้างไฟล์ 0 = สร้างใน thread หลัก (ค่าเริ่มต้น: {RENDER_WORKERS})")
+    parser.add_argument('--summary', help="บันทึกสรุปผล (JSON) ลงไฟล์นี้ด้วย (สรุปผลจะแสดงทาง stdout เสมอ)")
+    parser.add_argument('--profile', help="บันทึกผล cProfile ของ thread หลักลงไฟล์นี้ (อ่านด้วย python -m pstats) "
+                                          "ใช้คู่กับ --render-workers 0 เพื่อรวมการสร้างไฟล์ไว้ในผล")
+    parser.add_argument('--quiet', action='store_true', help="แสดง log ทาง stderr เฉพาะคำเตือนและข้อผิดพลาด")
+    return parser
+
+def run_batch(args):
+    """รัน pipeline ของเว็บกับไฟล์หนึ่งใน thread ปัจจุบันโดยใช้ JobStore ชั่วคราวของตัวเอง คืนค่า (สรุปผล, exit code)"""
+    with open(args.workbook, 'rb') as f:
+        workbook = f.read()
+    os.makedirs(args.output_dir, exist_ok=True)
+    job_id = str(uuid.uuid4())
+    store_dir = tempfile.mkdtemp(prefix='solarwind_batch_')
+    store = JobStore(os.path.join(store_dir, 'jobs.sqlite3'), stale_seconds=JOB_STALE_SECONDS, files_dir=os.path.join(store_dir, 'files'))
+    token = current_job_store.set(store)
+    profiler = cProfile.Profile() if args.profile else None
+    try:
+        store.create(job_id, report_month=args.month, report_mode=args.mode)
+        logger.info(f"📂 เริ่มสร้างรายงานจากไฟล์ '{args.workbook}' (Job ID: {job_id})")
+        started = time.monotonic()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            process_file_in_background(io.BytesIO(workbook), job_id, fetch_workers=args.fetch_workers, report_month=args.month,
+                                       report_mode=args.mode, render_workers=args.render_workers)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(args.profile)
+        elapsed = time.monotonic() - started
+        status = store.get(job_id)
+        results = store.results(job_id)
+    finally:
+        current_job_store.reset(token)
+        job_events.discard(job_id)
+        shutil.rmtree(store_dir, ignore_errors=True)
+
+    output = None
+    zip_file_path = status['zip_file_path']
+    if zip_file_path:
+        if args.format == 'files':
+            with zipfile.ZipFile(zip_file_path) as zipf:
+                zipf.extractall(args.output_dir)
+            os.remove(zip_file_path)
+            output = os.path.abspath(args.output_dir)
+        else:
+            output = os.path.abspath(os.path.join(args.output_dir, f"Solarwind_{datetime.datetime.now().strftime('%Y%m%d')}.zip"))
+            shutil.move(zip_file_path, output)
+    failures = [{'row': seq + 1, **result} for seq, result in enumerate(results)
+                if result['error_message'] or not (result['csv_success'] and result['pdf_success'])]
+    summary = {
+        'job_id': job_id,
+        'workbook': os.path.abspath(args.workbook),
+        'report_month': status['report_month'],
+        'report_mode': status['report_mode'],
+        'format': args.format,
+        'output': output,
+        'total': status['total'],
+        'processed': status['processed'],
+        'succeeded': len(results) - len(failures),
+        'failed': len(failures),
+        'failures': failures,
+        'error': status['error'],
+        'elapsed_seconds': round(elapsed, 3),
+        'cache': status['cache'],
+        'metrics': status['metrics'],
+        'profile': os.path.abspath(args.profile) if args.profile else None
+    }
+    exit_code = 1 if status['error'] or output is None else 3 if failures else 0
+    return summary, exit_code
+
+def main(argv=None):
+    parser = build_arg_parser()
+    args = parser.parse_args(argv)
+    if args.workbook is None:
+        # --- ส่วนของการรัน Flask App ---
+        cleanup_thread = threading.Thread(target=cleanup_old_jobs)
+        cleanup_thread.daemon = True # ทำให้ thread จบเมื่อ process หลักจบ
+        cleanup_thread.start()
+
+        app.run(debug=True,host='0.0.0.0', port=5050) # debug=True จะช่วยในการพัฒนา แต่ไม่ควรใช้ใน Production
+        return 0
+
+    if not os.path.isfile(args.workbook):
+        parser.error(f"ไม่พบไฟล์ '{args.workbook}'")
+    if args.quiet:
+        console_handler.setLevel(logging.WARNING)
+    try:
+        summary, exit_code = run_batch(args)
+    finally:
+        if _render_pool is not None:
+            _render_pool.shutdown()
+        if _render_log_listener is not None:
+            _render_log_listener.stop()
+    text = json.dumps(summary, ensure_ascii=False, indent=2)
+    if args.summary:
+        with open(args.summary, 'w', encoding='utf-8') as f:
+            f.write(text + "\n")
+    print(text)
+    return exit_code
 
-    app.run(debug=True,host='0.0.0.0', port=5050) # debug=True จะช่วยในการพัฒนา แต่ไม่ควรใช้ใน Production
+if __name__ == '__main__':
+    sys.exit(main())
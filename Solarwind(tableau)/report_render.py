@@ -0,0 +1,497 @@
+"""สร้างไฟล์รายงาน CSV/PDF ของวงจร process ลูกใน pool ที่สร้างไฟล์ import เพียงโมดูลนี้ จึงต้องไม่มีสถานะอื่นตอน import (มีเพียงการลงทะเบียนฟอนต์)"""
+import csv
+import contextvars
+import datetime
+import functools
+import io
+import logging
+import logging.handlers
+import os
+import time
+from reportlab.lib.pagesizes import letter
+from reportlab.platypus import SimpleDocTemplate, Table, Paragraph, Spacer, PageBreak
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from reportlab.lib.units import inch
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.pdfgen import canvas as pdf_canvas
+from reportlab.lib.colors import toColor
+from reportlab.lib.fonts import tt2ps
+
+# วิธีสร้าง PDF: 'platypus' (Table แบบเดิม) หรือ 'canvas' (ผังหน้าคงที่ วาดลง canvas โดยตรง)
+# ผลของทั้งสองแบบถูกเทียบกันใน tests/test_pdf_renderer.py
+PDF_RENDERER = os.environ.get('SOLARWIND_PDF_RENDERER', 'platypus')
+REPORT_TIMESTAMP_FORMAT = '%Y-%m-%d %H.%M.%S'
+
+# job_id ของงานที่ thread/process ปัจจุบันกำลังทำอยู่ ใช้ผูก log เข้ากับงาน
+current_job_id = contextvars.ContextVar('current_job_id', default=None)
+
+class JobContextFilter(logging.Filter):
+    """ใส่ job_id ของงานปัจจุบัน (จาก current_job_id) ให้กับ log record ที่ยังไม่ได้ระบุผ่าน extra"""
+    def filter(self, record):
+        if getattr(record, 'job_id', None) is None:
+            record.job_id = current_job_id.get()
+        return True
+
+# logger ลูกของ logger 'solarwind' ใน final.py: ใน process หลัก log จะไปยัง handler ของ final.py ตามปกติ
+# ส่วนใน process ลูกจะถูกส่งกลับผ่าน queue (ดู init_render_worker)
+logger = logging.getLogger('solarwind.render')
+for log_filter in list(logger.filters):
+    logger.removeFilter(log_filter)
+logger.addFilter(JobContextFilter())
+
+# --- ตั้งค่าฟอนต์ภาษาไทยสำหรับ PDF ---
+THAI_FONT_NAME = 'THSarabunNew'
+# ตรวจสอบให้แน่ใจว่า 'THSarabunNew.ttf' อยู่ใน directory เดียวกันกับ app.py
+THAI_FONT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'THSarabunNew.ttf')
+
+THAI_FONT_REGISTERED = False
+if os.path.exists(THAI_FONT_PATH):
+    try:
+        pdfmetrics.registerFont(TTFont(THAI_FONT_NAME, THAI_FONT_PATH))
+        THAI_FONT_REGISTERED = True
+        logger.info(f"Thai font '{THAI_FONT_NAME}' registered successfully from '{THAI_FONT_PATH}'.")
+    except Exception as e:
+        logger.error(f"ERROR: Could not register Thai font '{THAI_FONT_NAME}'. Error: {e}")
+else:
+    logger.warning(f"WARNING: Thai font file '{THAI_FONT_PATH}' not found. Please ensure the font file is in the same directory as the script.")
+
+# --- การสร้าง CSV ---
+def _write_csv_rows(f, headers, data, monthly_averages):
+    cw = csv.writer(f)
+    if headers and data:
+        # กำหนดหัวตารางใหม่ตามที่ต้องการแสดงใน CSV
+        csv_display_headers = [
+            "รหัสหน่วยงาน",
+            "ชื่อหน่วยงาน",
+            "วันที่และเวลา",
+            "ขนาดBandwidth (หน่วย Mbps)",
+            "In_Averagebps",  # เปลี่ยนชื่อหัวตาราง
+            "Out_Averagebps"  # เปลี่ยนชื่อหัวตาราง
+        ]
+        cw.writerow(csv_display_headers) # เขียนหัวตารางใหม่ลงไป
+        
+        for row in data:
+            new_row = [
+                row.get('รหัสหน่วยงาน', ''),
+                row.get('ชื่อหน่วยงาน', ''),
+                row.get('วันที่และเวลา', ''),
+                row.get('ขนาดBandwidth (หน่วย Mbps)', ''),
+                # ดึงข้อมูลจากคีย์เดิมที่เป็นภาษาไทย ซึ่งเป็นคีย์ที่อยู่ใน 'data' ที่ถูกส่งเข้ามา
+                row.get('ปริมาณการใช้งาน incoming (หน่วย bps)', ''),
+                row.get('ปริมาณการใช้งาน outcoming (หน่วย bps)', '')
+            ]
+            cw.writerow(new_row)
+        
+        # Insert monthly average row at the very end
+        if monthly_averages:
+            avg_in = monthly_averages['avg_in_month']
+            avg_out = monthly_averages['avg_out_month']
+            cw.writerow([
+                '', '', # Empty for customer ID/name
+                'Total', 
+                '', # Bandwidth
+                f'{avg_in:,}', 
+                f'{avg_out:,}'
+            ])
+    else:
+        cw.writerow(["No Data"])
+
+def export_to_csv(headers, data, monthly_averages, filename, job_id, node_name):
+    """สร้างและบันทึกไฟล์ CSV โดยให้ 'รหัสหน่วยงาน' และ 'ชื่อหน่วยงาน' แสดงในทุกแถว
+       และเพิ่มแถวสำหรับค่าเฉลี่ยรวมทั้งเดือนในแถวสุดท้าย
+       
+       แก้ไข:
+       - 'ปริมาณการใช้งาน incoming (หน่วย bps)' เป็น 'In_Averagebps'
+       - 'ปริมาณการใช้งาน outcoming (หน่วย bps)' เป็น 'Out_Averagebps'
+    """
+    try:
+        if isinstance(filename, (str, os.PathLike)):
+            with open(filename, 'w', newline='', encoding='utf-8-sig') as f:
+                _write_csv_rows(f, headers, data, monthly_averages)
+        else:
+            text = io.StringIO(newline='')
+            _write_csv_rows(text, headers, data, monthly_averages)
+            filename.write(text.getvalue().encode('utf-8-sig'))
+        logger.info(f"✅ สร้าง CSV สำหรับ '{node_name}' สำเร็จแล้ว")
+        return True, "Success"
+    except Exception as e:
+        logger.error(f"❌ สร้าง CSV สำหรับ '{node_name}' ล้มเหลว: {e}")
+        return False, str(e)
+
+
+# --- การสร้าง PDF ---
+PDF_TITLE = "Custumer Interface Summary Report by Hour"
+PDF_MARGIN = 0.5 * inch
+PDF_DATE_LABEL = "รายงานประจำวันที่:"
+PDF_TABLE_HEADERS = [
+    "รหัสหน่วยงาน",
+    "ชื่อหน่วยงาน",
+    "วันที่และเวลา",
+    "ขนาดBandwidth \n(หน่วย Mbps)",
+    "ปริมาณการใช้งาน incoming\n (หน่วย bps)",
+    "ปริมาณการใช้งาน outcoming\n (หน่วย bps)"
+]
+# สัดส่วนความกว้างคอลัมน์เทียบกับความกว้างหน้ากระดาษหลังหักขอบ
+PDF_COLUMN_FRACTIONS = [0.10, 0.29, 0.13, 0.13, 0.18, 0.18]
+PDF_ROW_KEYS = [
+    'วันที่และเวลา',
+    'ขนาดBandwidth (หน่วย Mbps)',
+    'ปริมาณการใช้งาน incoming (หน่วย bps)',
+    'ปริมาณการใช้งาน outcoming (หน่วย bps)'
+]
+
+def _group_rows_by_date(data):
+    """แบ่งแถวตามวันที่ (หนึ่งวันต่อหนึ่งหน้า) คืนค่า (วันที่ที่เรียงแล้ว, dict วันที่ -> แถว)"""
+    data_by_date = {}
+    for row in data:
+        date_time_str = row.get('วันที่และเวลา', '')
+        try:
+            date_key = datetime.datetime.strptime(date_time_str, REPORT_TIMESTAMP_FORMAT).strftime('%Y-%m-%d')
+        except ValueError:
+            date_key = 'Uncategorized' # Fallback for malformed date
+        if date_key not in data_by_date:
+            data_by_date[date_key] = []
+        data_by_date[date_key].append(row)
+    return sorted(data_by_date.keys()), data_by_date
+
+def _iter_display_rows(group_data):
+    """คืนค่าแถวของตาราง โดยแสดงรหัส/ชื่อหน่วยงานเฉพาะแถวแรกที่ค่าเปลี่ยน"""
+    last_customer_id = None
+    last_customer_name = None
+    for row in group_data:
+        current_customer_id = row.get('รหัสหน่วยงาน', '')
+        current_customer_name = row.get('ชื่อหน่วยงาน', '')
+        yield [
+            current_customer_id if current_customer_id != last_customer_id else '',
+            current_customer_name if current_customer_name != last_customer_name else '',
+        ] + [row.get(key, '') for key in PDF_ROW_KEYS]
+        last_customer_id = current_customer_id
+        last_customer_name = current_customer_name
+
+@functools.lru_cache(maxsize=None)
+def _pdf_paragraph_styles():
+    """สร้าง ParagraphStyle ครั้งเดียวต่อ process (ไม่แก้ไข style ที่ใช้ร่วมกันของ getSampleStyleSheet)"""
+    styles = getSampleStyleSheet()
+    title_style = ParagraphStyle('ReportTitle', parent=styles['Title'], fontSize=18, alignment=1)
+    sub_title_style = ParagraphStyle('SubTitle', parent=styles['Normal'], fontSize=12, alignment=1)
+    average_text_style = ParagraphStyle('AverageText', parent=styles['Normal'], fontSize=10, alignment=0)
+    no_data_style = ParagraphStyle('NoData', parent=styles['Normal'])
+    if THAI_FONT_REGISTERED:
+        for style in (title_style, sub_title_style, average_text_style, no_data_style):
+            style.fontName = THAI_FONT_NAME
+    return {'title': title_style, 'sub_title': sub_title_style, 'average': average_text_style, 'no_data': no_data_style}
+
+def _export_to_pdf_platypus(headers, data, monthly_averages, filename):
+    """สร้าง PDF ด้วย platypus (Table หนึ่งตารางต่อวัน) รองรับวันที่มีจำนวนแถวเท่าใดก็ได้"""
+    doc = SimpleDocTemplate(filename, pagesize=letter)
+    styles = _pdf_paragraph_styles()
+    elements = []
+
+    # Constants for page dimensions
+    # letter size is 8.5 x 11 inches. 1 inch = 72 points
+    page_width, page_height = letter
+    left_margin = right_margin = PDF_MARGIN # Set a consistent margin
+
+    # Calculate available width for the table
+    available_width = page_width - (left_margin + right_margin)
+
+    if headers and data:
+        sorted_date_keys, data_by_date = _group_rows_by_date(data)
+        last_date_key = sorted_date_keys[-1] if sorted_date_keys else None
+
+        first_page = True
+        for i, date_key in enumerate(sorted_date_keys):
+            group_data = data_by_date[date_key]
+
+            if not first_page:
+                elements.append(PageBreak())
+            
+            # Title
+            elements.append(Paragraph(PDF_TITLE, styles['title']))
+            elements.append(Spacer(1, 0.2 * inch))
+
+            # Subtitle (Date)
+            elements.append(Paragraph(f"<b>{PDF_DATE_LABEL}</b> {date_key}", styles['sub_title']))
+            elements.append(Spacer(1, 0.2 * inch))
+
+            table_data = [PDF_TABLE_HEADERS]
+            table_data.extend(_iter_display_rows(group_data))
+            
+            # Check if this is the last day's data and monthly averages exist
+            is_last_day_group = (date_key == last_date_key)
+            if is_last_day_group and monthly_averages:
+                avg_in = monthly_averages['avg_in_month']
+                avg_out = monthly_averages['avg_out_month']
+                average_text_style = styles['average']
+
+                table_data.append([
+                    '', # Empty cell for 'รหัสหน่วยงาน'
+                    '', # Empty cell for 'ชื่อหน่วยงาน'
+                    Paragraph("<b>Total</b>", average_text_style), # Bold average text
+                    '', # Empty cell for 'ขนาดBandwidth'
+                    Paragraph(f"<b>{avg_in:,}</b>", average_text_style), # Bold and comma-formatted In_Averagebps
+                    Paragraph(f"<b>{avg_out:,}</b>", average_text_style)  # Bold and comma-formatted Out_Averagebps
+                ])
+            
+            # Define column widths as percentages of available_width
+            # This ensures the table expands to fill the page width
+            col_widths = [fraction * available_width for fraction in PDF_COLUMN_FRACTIONS]
+            
+            table = Table(table_data, colWidths=col_widths)
+            
+            table_style = [
+                ('BACKGROUND', (0, 0), (-1, 0), '#cccccc'),
+                ('TEXTCOLOR', (0, 0), (-1, 0), '#000000'),
+                ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+                ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+                ('BACKGROUND', (0, 1), (-1, -1), '#f0f0f0'), 
+                ('GRID', (0, 0), (-1, -1), 1, '#999999'),
+                ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'), # Vertically align text in cells
+            ]
+            if THAI_FONT_REGISTERED:
+                table_style.append(('FONTNAME', (0, 0), (-1, 0), THAI_FONT_NAME)) # Headers in Thai font
+                table_style.append(('FONTNAME', (0, 1), (-1, -1), THAI_FONT_NAME)) # Body in Thai font
+            else:
+                table_style.append(('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold')) # Headers in bold
+                table_style.append(('FONTNAME', (0, 1), (-1, -1), 'Helvetica')) # Body in regular
+
+            # Apply specific style for the last row if it's the monthly average
+            if is_last_day_group and monthly_averages:
+                last_row_index = len(table_data) - 1
+                table_style.extend([
+                    ('BACKGROUND', (0, last_row_index), (-1, last_row_index), '#d3d3d3'), # Light grey background for average row
+                    ('SPAN', (0, last_row_index), (1, last_row_index)), # Span first two columns
+                    ('ALIGN', (2, last_row_index), (2, last_row_index), 'LEFT'), # Align 'Total' text left
+                    ('FONTNAME', (2, last_row_index), (2, last_row_index), THAI_FONT_NAME if THAI_FONT_REGISTERED else 'Helvetica-Bold'),
+                    ('FONTNAME', (4, last_row_index), (4, last_row_index), THAI_FONT_NAME if THAI_FONT_REGISTERED else 'Helvetica-Bold'),
+                    ('FONTNAME', (5, last_row_index), (5, last_row_index), THAI_FONT_NAME if THAI_FONT_REGISTERED else 'Helvetica-Bold'),
+                    ('ALIGN', (4, last_row_index), (4, last_row_index), 'CENTER'), # Center average values
+                    ('ALIGN', (5, last_row_index), (5, last_row_index), 'CENTER'), # Center average values
+                    ('BOTTOMPADDING', (0, last_row_index), (-1, last_row_index), 12),
+                    ('TOPPADDING', (0, last_row_index), (-1, last_row_index), 12),
+                ])
+
+            table.setStyle(table_style)
+            elements.append(table)
+            elements.append(Spacer(1, 0.5 * inch))
+
+            first_page = False
+    else:
+        elements.append(Paragraph("No circuit status data available.", styles['no_data']))
+    
+    # Build the document with the defined margins
+    doc.leftMargin = left_margin
+    doc.rightMargin = right_margin
+    doc.topMargin = PDF_MARGIN # Set top margin
+    doc.bottomMargin = PDF_MARGIN # Set bottom margin
+
+    doc.build(elements)
+
+class CanvasPdfLayout:
+    """ผังหน้ารายงานรายวันแบบคงที่สำหรับวาดลง canvas โดยตรง คำนวณครั้งเดียวต่อ process ให้ตรงกับผลของ _export_to_pdf_platypus"""
+    FRAME_PADDING = 6
+    CELL_PADDING_X = 6
+    FONT_SIZE = 10
+    LEADING = 12
+    HEADER_ROW_HEIGHT = 2 * 12 + 3 + 12 # 2 บรรทัด + topPadding 3 + bottomPadding 12
+    DATA_ROW_HEIGHT = 12 + 3 + 3
+    TOTAL_ROW_HEIGHT = 12 + 12 + 12
+    TABLE_SPACE_AFTER = 0.5 * inch
+
+    def __init__(self):
+        page_width, page_height = letter
+        self.page_center = page_width / 2
+        self.frame_left = PDF_MARGIN + self.FRAME_PADDING
+        self.frame_width = page_width - 2 * PDF_MARGIN - 2 * self.FRAME_PADDING
+        self.frame_top = page_height - PDF_MARGIN - self.FRAME_PADDING
+        self.frame_bottom = PDF_MARGIN + self.FRAME_PADDING
+
+        self.regular_font = THAI_FONT_NAME if THAI_FONT_REGISTERED else 'Helvetica'
+        self.bold_font = tt2ps(self.regular_font, 1, 0)
+        self.header_font = THAI_FONT_NAME if THAI_FONT_REGISTERED else 'Helvetica-Bold'
+        self.title_font = THAI_FONT_NAME if THAI_FONT_REGISTERED else 'Helvetica-Bold'
+
+        # Title (leading 22 + spaceAfter 6) -> Spacer -> Subtitle (leading 12) -> Spacer -> ตาราง
+        self.title_baseline = self.frame_top - 18
+        subtitle_top = self.frame_top - 22 - 6 - 0.2 * inch
+        self.subtitle_baseline = subtitle_top - 12
+        self.table_top = subtitle_top - 12 - 0.2 * inch
+        self.no_data_baseline = self.frame_top - self.FONT_SIZE
+
+        available_width = page_width - 2 * PDF_MARGIN
+        self.column_widths = [fraction * available_width for fraction in PDF_COLUMN_FRACTIONS]
+        table_width = sum(self.column_widths)
+        self.table_left = self.frame_left + (self.frame_width - table_width) / 2
+        self.table_right = self.table_left + table_width
+        # สะสมจาก 0 แล้วเลื่อนทีหลัง แบบเดียวกับ Table._colpositions
+        offsets = [0]
+        for width in self.column_widths:
+            offsets.append(offsets[-1] + width)
+        self.column_edges = [self.table_left + offset for offset in offsets]
+        self.column_centers = [(left + right) / 2 for left, right in zip(self.column_edges, self.column_edges[1:])]
+
+    def fits(self, row_count, with_total):
+        """ตรวจว่าตารางของวันหนึ่ง (รวมช่องว่างหลังตาราง) อยู่ในหน้าเดียวได้หรือไม่"""
+        height = self.HEADER_ROW_HEIGHT + row_count * self.DATA_ROW_HEIGHT + (self.TOTAL_ROW_HEIGHT if with_total else 0)
+        return self.table_top - height - self.TABLE_SPACE_AFTER >= self.frame_bottom
+
+    def draw_day(self, c, date_key, display_rows, totals):
+        """วาดหน้าของวันหนึ่ง totals เป็น (avg_in, avg_out) สำหรับวันสุดท้าย หรือ None"""
+        # ตำแหน่งขอบล่างของแต่ละแถว (จากบนลงล่าง)
+        row_bottoms = [self.table_top - self.HEADER_ROW_HEIGHT]
+        for _ in display_rows:
+            row_bottoms.append(row_bottoms[-1] - self.DATA_ROW_HEIGHT)
+        if totals is not None:
+            row_bottoms.append(row_bottoms[-1] - self.TOTAL_ROW_HEIGHT)
+        table_bottom = row_bottoms[-1]
+        table_width = self.table_right - self.table_left
+
+        # พื้นหลัง
+        c.setFillColor(_PDF_HEADER_COLOR)
+        c.rect(self.table_left, row_bottoms[0], table_width, self.HEADER_ROW_HEIGHT, stroke=0, fill=1)
+        c.setFillColor(_PDF_BODY_COLOR)
+        c.rect(self.table_left, table_bottom, table_width, row_bottoms[0] - table_bottom, stroke=0, fill=1)
+        if totals is not None:
+            c.setFillColor(_PDF_TOTAL_COLOR)
+            c.rect(self.table_left, table_bottom, table_width, self.TOTAL_ROW_HEIGHT, stroke=0, fill=1)
+        c.setFillColor(_PDF_TEXT_COLOR)
+
+        # ข้อความทั้งหน้าอยู่ใน text object เดียว (drawString สร้าง text object ใหม่ทุกครั้ง)
+        text = c.beginText()
+
+        def draw_centred(center, y, value, font_name, font_size):
+            text.setTextOrigin(center - _pdf_string_width(value, font_name, font_size) / 2, y)
+            # textLine ไม่คำนวณความกว้างซ้ำแบบ textOut (ไม่มี cache) ซึ่งเป็นต้นทุนหลักของทั้งหน้า
+            # การขึ้นบรรทัดใหม่ของ textLine ไม่มีผล เพราะข้อความถัดไปกำหนดตำแหน่งเองเสมอ
+            text.textLine(value)
+
+        text.setFont(self.title_font, 18, 22)
+        draw_centred(self.page_center, self.title_baseline, PDF_TITLE, self.title_font, 18)
+
+        label = PDF_DATE_LABEL
+        value = f" {date_key}"
+        label_width = _pdf_string_width(label, self.bold_font, 12)
+        value_width = _pdf_string_width(value, self.regular_font, 12)
+        text.setFont(self.bold_font, 12, 12)
+        text.setTextOrigin(self.page_center - (label_width + value_width) / 2, self.subtitle_baseline)
+        text.textOut(label)
+        text.setFont(self.regular_font, 12, 12)
+        text.textOut(value)
+
+        # หัวตาราง (จัดกึ่งกลางแนวตั้งแบบ VALIGN MIDDLE ของ Table)
+        text.setFont(self.header_font, self.FONT_SIZE, self.LEADING)
+        for center, header in zip(self.column_centers, PDF_TABLE_HEADERS):
+            lines = header.split('\n')
+            y = row_bottoms[0] + (12 + self.HEADER_ROW_HEIGHT - 3 + len(lines) * self.LEADING) / 2 - self.FONT_SIZE
+            for line in lines:
+                draw_centred(center, y, line, self.header_font, self.FONT_SIZE)
+                y -= self.LEADING
+
+        # ข้อมูลรายชั่วโมง
+        text.setFont(self.regular_font, self.FONT_SIZE, self.LEADING)
+        baseline_offset = (self.DATA_ROW_HEIGHT + self.LEADING) / 2 - self.FONT_SIZE
+        for row_bottom, values in zip(row_bottoms[1:], display_rows):
+            y = row_bottom + baseline_offset
+            for center, value in zip(self.column_centers, values):
+                if value != '':
+                    draw_centred(center, y, str(value), self.regular_font, self.FONT_SIZE)
+
+        # แถวค่าเฉลี่ยทั้งเดือน (Paragraph ชิดซ้ายในเซลล์)
+        if totals is not None:
+            text.setFont(self.bold_font, self.FONT_SIZE, self.LEADING)
+            y = table_bottom + (self.TOTAL_ROW_HEIGHT + self.LEADING) / 2 - self.FONT_SIZE
+            avg_in, avg_out = totals
+            for column, value in ((2, "Total"), (4, f"{avg_in:,}"), (5, f"{avg_out:,}")):
+                text.setTextOrigin(self.column_edges[column] + self.CELL_PADDING_X, y)
+                text.textOut(value)
+        c.drawText(text)
+
+        # เส้นตาราง (GRID 1pt) โดยแถวค่าเฉลี่ยรวมคอลัมน์แรกกับคอลัมน์ที่สองเป็นช่องเดียว
+        c.setStrokeColor(_PDF_GRID_COLOR)
+        c.setLineWidth(1)
+        lines = [(self.table_left, self.table_top, self.table_right, self.table_top)]
+        lines.extend((self.table_left, y, self.table_right, y) for y in row_bottoms)
+        grid_bottom_split = table_bottom + (self.TOTAL_ROW_HEIGHT if totals is not None else 0)
+        for column, x in enumerate(self.column_edges):
+            bottom = grid_bottom_split if column == 1 else table_bottom
+            lines.append((x, self.table_top, x, bottom))
+        c.lines(lines)
+
+    def draw_no_data(self, c):
+        c.setFont(self.regular_font, self.FONT_SIZE, self.LEADING)
+        c.drawString(self.frame_left, self.no_data_baseline, "No circuit status data available.")
+
+# ความกว้างของข้อความซ้ำกันมาก (เวลา, Bandwidth, หัวตาราง) จึงเก็บผลไว้ใช้ซ้ำ
+_pdf_string_width = functools.lru_cache(maxsize=16384)(pdfmetrics.stringWidth)
+
+_PDF_HEADER_COLOR = toColor('#cccccc')
+_PDF_BODY_COLOR = toColor('#f0f0f0')
+_PDF_TOTAL_COLOR = toColor('#d3d3d3')
+_PDF_GRID_COLOR = toColor('#999999')
+_PDF_TEXT_COLOR = toColor('#000000')
+
+@functools.lru_cache(maxsize=None)
+def _canvas_pdf_layout():
+    return CanvasPdfLayout()
+
+def _export_to_pdf_canvas(headers, data, monthly_averages, filename):
+    """วาดผังหน้าคงที่ลง canvas โดยตรง (เร็วกว่า platypus) คืนค่า False โดยไม่สร้างไฟล์หากมีวันที่ตารางยาวเกินหนึ่งหน้า"""
+    layout = _canvas_pdf_layout()
+    pages = []
+    if headers and data:
+        sorted_date_keys, data_by_date = _group_rows_by_date(data)
+        last_date_key = sorted_date_keys[-1] if sorted_date_keys else None
+        for date_key in sorted_date_keys:
+            totals = None
+            if date_key == last_date_key and monthly_averages:
+                totals = (monthly_averages['avg_in_month'], monthly_averages['avg_out_month'])
+            group_data = data_by_date[date_key]
+            if not layout.fits(len(group_data), totals is not None):
+                return False
+            pages.append((date_key, list(_iter_display_rows(group_data)), totals))
+
+    c = pdf_canvas.Canvas(filename, pagesize=letter)
+    if pages:
+        for date_key, display_rows, totals in pages:
+            layout.draw_day(c, date_key, display_rows, totals)
+            c.showPage()
+    else:
+        layout.draw_no_data(c)
+        c.showPage()
+    c.save()
+    return True
+
+def export_to_pdf(headers, data, monthly_averages, filename, job_id, node_name, renderer=None):
+    """สร้างและบันทึกไฟล์ PDF โดยให้แต่ละวันขึ้นหน้าใหม่ และเพิ่มค่าเฉลี่ยรวมทั้งเดือนในแถวสุดท้ายของตารางข้อมูลสุดท้าย"""
+    try:
+        renderer = renderer or PDF_RENDERER
+        if renderer != 'canvas' or not _export_to_pdf_canvas(headers, data, monthly_averages, filename):
+            _export_to_pdf_platypus(headers, data, monthly_averages, filename)
+        logger.info(f"✅ สร้าง PDF สำหรับ '{node_name}' สำเร็จแล้ว")
+        return True, "PDF generated successfully."
+    except Exception as e:
+        logger.error(f"❌ สร้าง PDF สำหรับ '{node_name}' ล้มเหลว: {e}")
+        return False, f"Error generating PDF: {e}"
+
+# --- process ที่สร้างไฟล์ ---
+def render_circuit_reports(headers, data, monthly_averages, job_id, node_name):
+    """สร้าง CSV และ PDF ของวงจรเดียวในหน่วยความจำ คืนค่า (csv_bytes, pdf_bytes, {'csv': วินาที, 'pdf': วินาที}) โดยไฟล์ที่สร้างไม่สำเร็จเป็น None"""
+    current_job_id.set(job_id)
+    csv_buffer = io.BytesIO()
+    pdf_buffer = io.BytesIO()
+    started = time.perf_counter()
+    csv_success, _ = export_to_csv(headers, data, monthly_averages, csv_buffer, job_id, node_name)
+    csv_seconds = time.perf_counter() - started
+    pdf_success, _ = export_to_pdf(headers, data, monthly_averages, pdf_buffer, job_id, node_name)
+    pdf_seconds = time.perf_counter() - started - csv_seconds
+    return (csv_buffer.getvalue() if csv_success else None), (pdf_buffer.getvalue() if pdf_success else None), \
+        {'csv': csv_seconds, 'pdf': pdf_seconds}
+
+def init_render_worker(worker_log_queue, level=logging.INFO):
+    """initializer ของ process ลูก: ส่ง log กลับไปยัง process หลัก เพื่อให้แสดงบนหน้าเว็บได้ตามปกติ"""
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.addHandler(logging.handlers.QueueHandler(worker_log_queue))
+    logger.setLevel(level)
+    logger.propagate = False
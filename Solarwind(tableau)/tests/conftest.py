@@ -0,0 +1,20 @@
+"""
+ตั้งค่าที่เก็บข้อมูลทั้งหมดให้อยู่ในโฟลเดอร์ชั่วคราวก่อน import final เพื่อไม่ให้ทดสอบแตะฐานข้อมูลของบริการจริง
+
+วิธีใช้ (จากโฟลเดอร์ Solarwind(tableau)):
+    python -m pytest -q tests
+"""
+import os
+import sys
+import tempfile
+
+STATE_DIR = tempfile.mkdtemp(prefix="solarwind_tests_")
+for name, filename in (("SOLARWIND_JOB_STORE_PATH", "jobs.sqlite3"), ("SOLARWIND_CACHE_PATH", "cache.sqlite3"),
+                       ("SOLARWIND_MONTH_TO_DATE_PATH", "month_to_date.sqlite3"), ("SOLARWIND_TIMESERIES_DIR", "timeseries"),
+                       ("SOLARWIND_WORKBOOK_CACHE_PATH", "workbooks.sqlite3"), ("SOLARWIND_RENDER_CACHE_PATH", "renders.sqlite3"),
+                       ("SOLARWIND_JOB_FILES_DIR", "job_files")):
+    os.environ[name] = os.path.join(STATE_DIR, filename)
+os.environ["SOLARWIND_RENDER_WORKERS"] = "0" # สร้างไฟล์ใน thread ของงาน ไม่ต้องเปิด process pool
+os.environ["SOLARWINDS_API_URL"] = "http://127.0.0.1:9/unreachable" # ทดสอบต้องไม่เรียก API จริง
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
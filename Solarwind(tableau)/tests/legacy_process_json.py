@@ -0,0 +1,205 @@
+"""
+process_json_data แบบเดิม (วนทีละแถว) จาก commit แรกของ repo เก็บไว้เป็นผลอ้างอิงของ process_json_batch
+ห้ามแก้ไขให้ตรงกับโค้ดใหม่ หากผลต่างกันให้แก้ที่ final.py
+"""
+import datetime
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+def process_json_data(raw_json_data, job_id):
+    """ประมวลผลข้อมูล JSON เพื่อให้พร้อมสำหรับสร้างไฟล์"""
+    column_mapping = {
+        "รหัสหน่วยงาน": "Customer_Curcuit_ID",
+        "ชื่อหน่วยงาน": "Address",
+        "วันที่และเวลา": "Timestamp",
+        "ขนาดBandwidth (หน่วย Mbps)": "Bandwidth",
+        "ปริมาณการใช้งาน incoming (หน่วย bps)": "In_Averagebps",
+        "ปริมาณการใช้งาน outcoming (หน่วย bps)": "Out_Averagebps"
+    }
+    desired_headers_th = list(column_mapping.keys())
+    
+    # ตรวจสอบว่า raw_json_data เป็น list หรือ dict
+    data_to_process = raw_json_data if isinstance(raw_json_data, list) else [raw_json_data]
+
+    # --- Step 1: Parse all existing timestamps and find earliest/latest dates ---
+    formatted_data = []
+    earliest_json_date = None
+    latest_json_date = None
+
+    for item in data_to_process:
+        date_time_value = item.get("Timestamp")
+        if isinstance(date_time_value, dict) and 'date' in date_time_value:
+            try:
+                # Parse timestamp from JSON string. Keep original format to reconstruct for output
+                dt_obj = datetime.datetime.strptime(date_time_value['date'], '%Y-%m-%d %H:%M:%S.%f')
+                formatted_item = item.copy()
+                formatted_item['Parsed_Timestamp'] = dt_obj
+                formatted_data.append(formatted_item)
+
+                if earliest_json_date is None or dt_obj < earliest_json_date:
+                    earliest_json_date = dt_obj
+                if latest_json_date is None or dt_obj > latest_json_date:
+                    latest_json_date = dt_obj
+            except ValueError:
+                # If date parsing fails, just add the item without a parsed timestamp
+                # These items won't be considered for filling gaps
+                formatted_data.append(item.copy()) 
+                logger.warning(f"⚠️ ไม่สามารถ parse วันที่ได้: {date_time_value.get('date')}. รายการนี้จะถูกข้ามการเติมข้อมูล.")
+
+        else:
+            # If 'Timestamp' is not a dict or 'date' is missing, add as is
+            formatted_data.append(item.copy())
+
+    # If no valid dates were found, just process the raw data as is
+    if earliest_json_date is None or latest_json_date is None:
+        logger.warning("ไม่พบข้อมูลวันที่ที่ถูกต้องใน JSON สำหรับการเติมวันที่/ชั่วโมงที่ขาดหายไป")
+        processed_data = []
+        for item in data_to_process: # Use original data_to_process to ensure all items are included
+            row_data = {}
+            for th_header, json_key in column_mapping.items():
+                value = item.get(json_key, '')
+                if th_header in ["ปริมาณการใช้งาน incoming (หน่วย bps)", "ปริมาณการใช้งาน outcoming (หน่วย bps)"]:
+                    try:
+                        value_float = float(value)
+                        row_data[th_header] = f"{int(value_float):,}" # Format with comma
+                    except (ValueError, TypeError):
+                        row_data[th_header] = str(value)
+                elif th_header == "วันที่และเวลา" and isinstance(value, dict) and 'date' in value:
+                    try:
+                        dt_obj = datetime.datetime.strptime(value['date'], '%Y-%m-%d %H:%M:%S.%f')
+                        row_data[th_header] = dt_obj.strftime('%Y-%m-%d %H.%M.%S')
+                    except ValueError:
+                        row_data[th_header] = str(value)
+                elif th_header == "ขนาดBandwidth (หน่วย Mbps)":
+                    if "FTTx" in str(value):
+                        row_data[th_header] = "20 Mbps." # Changed from 0 Mbps.
+                    else:
+                        try:
+                            numeric_value = float(re.search(r'[\d.]+', str(value)).group())
+                            row_data[th_header] = f"{int(numeric_value):,} Mbps." # Format with comma
+                        except (ValueError, TypeError, AttributeError):
+                            row_data[th_header] = str(value)
+                else:
+                    row_data[th_header] = str(value)
+            processed_data.append(row_data)
+        return desired_headers_th, processed_data, {} # Return empty averages
+
+    # --- Step 2: Determine the full time range for filling ---
+    first_day_of_month_start_hour = earliest_json_date.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    # The end point for filling is the last hour of the latest_json_date
+    # We want to fill up to and including the last full hour of the latest data.
+    # If latest_json_date is 2025-07-13 10:30:00, we want to fill up to 2025-07-13 23:00:00
+    last_day_of_data_end_hour = latest_json_date.replace(hour=23, minute=0, second=0, microsecond=0)
+
+
+    # --- Step 3: Get common data for new entries (customer ID, name, bandwidth) ---
+    first_actual_entry = None
+    for item in formatted_data:
+        if 'Parsed_Timestamp' in item: # Find the first entry that actually has a parsed timestamp
+            first_actual_entry = item
+            break
+    
+    # Use default empty strings if no valid first entry is found
+    customer_id = first_actual_entry.get("Customer_Curcuit_ID", "") if first_actual_entry else ""
+    customer_name = first_actual_entry.get("Address", "") if first_actual_entry else ""
+    bandwidth = first_actual_entry.get("Bandwidth", "") if first_actual_entry else ""
+
+    # --- Step 4: Create a set of existing date-hour combinations for quick lookup ---
+    existing_date_hours = set()
+    for item in formatted_data:
+        if 'Parsed_Timestamp' in item:
+            existing_date_hours.add(item['Parsed_Timestamp'].replace(minute=0, second=0, microsecond=0)) # Store only year, month, day, hour
+
+    # --- Step 5: Generate and fill in missing entries ---
+    dates_to_add_data = []
+    current_hour_dt = first_day_of_month_start_hour
+
+    # Loop from the first hour of the month to the last hour of the latest data day
+    while current_hour_dt <= last_day_of_data_end_hour:
+        if current_hour_dt not in existing_date_hours:
+            # Create a new entry for the missing hour
+            missing_entry = {
+                "Customer_Curcuit_ID": customer_id,
+                "Address": customer_name,
+                "Timestamp": {"date": current_hour_dt.strftime('%Y-%m-%d %H:%M:%S.%f')},
+                "Bandwidth": bandwidth,
+                "In_Averagebps": "0",
+                "Out_Averagebps": "0",
+                "Parsed_Timestamp": current_hour_dt
+            }
+            dates_to_add_data.append(missing_entry)
+            logger.info(f"✨ เพิ่มข้อมูลสำหรับชั่วโมงที่ขาดหายไป: {current_hour_dt.strftime('%Y-%m-%d %H:%M')}")
+        current_hour_dt += datetime.timedelta(hours=1) # Move to the next hour
+    
+    # --- Step 6: Combine all data and sort by timestamp ---
+    combined_data = dates_to_add_data + formatted_data
+    
+    # Ensure all data is sorted by the parsed timestamp
+    # Filter out items that might not have a Parsed_Timestamp due to parsing errors
+    sorted_combined_data = sorted(
+        [item for item in combined_data if 'Parsed_Timestamp' in item],
+        key=lambda x: x['Parsed_Timestamp']
+    )
+
+    # --- Step 7: Calculate monthly averages for In_Averagebps and Out_Averagebps ---
+    total_sum_in = 0
+    total_count_in = 0
+    total_sum_out = 0
+    total_count_out = 0
+
+    for item in sorted_combined_data:
+        try:
+            in_bps = float(item.get("In_Averagebps", 0))
+            total_sum_in += in_bps
+            total_count_in += 1
+        except (ValueError, TypeError):
+            pass # Ignore non-numeric values
+
+        try:
+            out_bps = float(item.get("Out_Averagebps", 0))
+            total_sum_out += out_bps
+            total_count_out += 1
+        except (ValueError, TypeError):
+            pass # Ignore non-numeric values
+    
+    monthly_averages = {}
+    if total_count_in > 0 and total_count_out > 0:
+        avg_in_month = (total_sum_in / total_count_in)
+        avg_out_month = (total_sum_out / total_count_out)
+        monthly_averages = {
+            "avg_in_month": int(avg_in_month),
+            "avg_out_month": int(avg_out_month)
+        }
+
+    # --- Step 8: Final formatting for output ---
+    processed_data = []
+    for item in sorted_combined_data:
+        row_data = {}
+        for th_header, json_key in column_mapping.items():
+            # For 'วันที่และเวลา', use the 'Parsed_Timestamp' for consistent formatting
+            if th_header == "วันที่และเวลา":
+                row_data[th_header] = item['Parsed_Timestamp'].strftime('%Y-%m-%d %H.%M.%S')
+            else:
+                value = item.get(json_key, '')
+                if th_header in ["ปริมาณการใช้งาน incoming (หน่วย bps)", "ปริมาณการใช้งาน outcoming (หน่วย bps)"]:
+                    try:
+                        value_float = float(value)
+                        row_data[th_header] = f"{int(value_float):,}" # Format with comma
+                    except (ValueError, TypeError):
+                        row_data[th_header] = str(value)
+                elif th_header == "ขนาดBandwidth (หน่วย Mbps)":
+                    if "FTTx" in str(value):
+                        row_data[th_header] = "20 Mbps." # Changed from 0 Mbps.
+                    else:
+                        try:
+                            numeric_value = float(re.search(r'[\d.]+', str(value)).group())
+                            row_data[th_header] = f"{int(numeric_value):,} Mbps." # Format with comma
+                        except (ValueError, TypeError, AttributeError):
+                            row_data[th_header] = str(value)
+                else:
+                    row_data[th_header] = str(value)
+        processed_data.append(row_data)
+
+    return desired_headers_th, processed_data, monthly_averages
@@ -0,0 +1,29 @@
+"""ข้อมูลดิบแบบที่ได้จาก decode_return_text สำหรับทดสอบ (สุ่มแบบคงที่ ผลจึงเหมือนเดิมทุกครั้ง)"""
+import datetime
+import random
+
+ADDRESS = "สำนักงานเขตพื้นที่การศึกษา จังหวัดตัวอย่าง"
+MONTH_START = datetime.datetime(2025, 7, 1)
+MONTH_HOURS = 31 * 24
+
+
+def soap_item(hour, rnd, bandwidth="100 Mbps", date=None, address=ADDRESS):
+    ts = MONTH_START + datetime.timedelta(hours=hour)
+    return {
+        "Customer_Curcuit_ID": "GIN0001234",
+        "Address": address,
+        "Timestamp": {"date": date or ts.strftime("%Y-%m-%d %H:%M:%S.000000"), "timezone_type": 3, "timezone": "Asia/Bangkok"},
+        "Bandwidth": bandwidth,
+        "In_Averagebps": f"{rnd.random() * 1e8:.4f}",
+        "Out_Averagebps": f"{rnd.random() * 1e8:.4f}",
+    }
+
+
+def month(hours=range(MONTH_HOURS), seed=0, **kwargs):
+    rnd = random.Random(seed)
+    return [soap_item(hour, rnd, **kwargs) for hour in hours]
+
+
+def sparse_month(seed=0):
+    rnd = random.Random(seed)
+    return [soap_item(hour, rnd) for hour in range(MONTH_HOURS) if rnd.random() < 0.3]
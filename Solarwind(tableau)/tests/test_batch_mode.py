@@ -0,0 +1,27 @@
+import json
+import zipfile
+
+import final
+import soap_fixtures
+from test_job_store import circuit_workbook
+
+
+def test_run_batch_keeps_its_job_out_of_the_shared_job_store(tmp_path, monkeypatch):
+    workbook = tmp_path / "circuits.xlsx"
+    workbook.write_bytes(circuit_workbook([(nod_id, f"วงจร {nod_id}") for nod_id in range(1, 4)]))
+    monkeypatch.setattr(final, "fetch_circuit_shared", lambda nod_id, itf_id, job_id, report_month: soap_fixtures.month(range(48), seed=int(nod_id)))
+    monkeypatch.setattr(final, "render_cache", None)
+    shared_jobs = []
+    monkeypatch.setattr(final.job_store, "create", lambda job_id, **fields: shared_jobs.append(job_id))
+    settings = (final.FETCH_WORKERS, final.RENDER_WORKERS, final.SOLARWINDS_API_MAX_CONCURRENCY, final.fetch_pool.workers)
+
+    args = final.build_arg_parser().parse_args([str(workbook), "-o", str(tmp_path / "out"), "--fetch-workers", "1", "--render-workers", "0"])
+    summary, exit_code = final.run_batch(args)
+
+    assert exit_code == 0, json.dumps(summary, ensure_ascii=False)
+    assert summary["succeeded"] == 3
+    with zipfile.ZipFile(summary["output"]) as archive:
+        assert len(archive.namelist()) == 6
+    assert shared_jobs == []
+    assert final.current_job_store.get() is final.job_store
+    assert (final.FETCH_WORKERS, final.RENDER_WORKERS, final.SOLARWINDS_API_MAX_CONCURRENCY, final.fetch_pool.workers) == settings
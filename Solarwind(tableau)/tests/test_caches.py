@@ -0,0 +1,69 @@
+import os
+import time
+
+import pandas as pd
+
+import caches
+import soap_fixtures
+
+
+def test_caches_do_not_touch_the_database_until_first_use(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    caches.CircuitResponseCache(path)
+    caches.RenderCache(path)
+    caches.WorkbookCache(path)
+    assert not os.path.exists(path)
+
+
+def test_circuit_response_cache_round_trip_and_lru_eviction(tmp_path):
+    cache = caches.CircuitResponseCache(str(tmp_path / "cache.sqlite3"), ttl_seconds=3600)
+    data = soap_fixtures.month(range(48))
+    assert cache.put("1", "1", data) == "2025-07"
+    assert cache.get("1", "1", "2025-07") == data
+    assert cache.get("1", "1", "2025-06") is None
+    assert cache.put("2", "1", [{"Timestamp": "no date"}]) is None
+
+    cache.max_bytes = cache._conn.execute("SELECT size FROM circuit_cache").fetchone()[0] + 1
+    time.sleep(0.01)
+    cache.put("3", "1", soap_fixtures.month(range(48), seed=1))
+    assert cache.get("1", "1", "2025-07") is None
+    assert cache.get("3", "1", "2025-07") is not None
+
+
+def test_render_cache_keeps_the_newest_entry_even_when_it_alone_exceeds_max_bytes(tmp_path):
+    cache = caches.RenderCache(str(tmp_path / "cache.sqlite3"), max_bytes=10, salt=lambda: "v1")
+    headers = ["a", "b"]
+    first = cache.key(headers, [{"a": "1", "b": "2"}], {})
+    second = cache.key(headers, [{"a": "1", "b": 2}], {})
+    assert first != second and cache.salt == "v1"
+    cache.put(first, b"csv-1", b"pdf-1")
+    cache.put(second, b"csv-2", b"pdf-2")
+    assert cache.get(first) is None
+    assert cache.get(second) == (b"csv-2", b"pdf-2")
+
+
+def test_workbook_cache_round_trip_keeps_dtypes(tmp_path):
+    cache = caches.WorkbookCache(str(tmp_path / "cache.sqlite3"))
+    df = pd.DataFrame({"NodeID": [404.0, float("nan"), 7.0], "Interface ID": [1, 2, 3], "ชื่อหน่วยงาน": ["ก", None, "ค"]})
+    chunks = [df.iloc[:2], df.iloc[2:]]
+    assert cache.put("digest", iter(chunks))
+    stored = list(cache.get("digest"))
+    assert len(stored) == 2
+    pd.testing.assert_frame_equal(pd.concat(stored, ignore_index=True), df)
+    assert cache.get("other") is None
+
+
+def test_workbook_cache_skips_lists_over_max_bytes_and_evicts_chunks(tmp_path):
+    cache = caches.WorkbookCache(str(tmp_path / "cache.sqlite3"), max_bytes=200)
+    small = pd.DataFrame({"NodeID": [1, 2]})
+    large = pd.DataFrame({"NodeID": [str(value) * 50 for value in range(50)]})
+    assert not cache.put("large", iter([small, large]))
+    assert cache.get("large") is None
+    assert cache._conn.execute("SELECT COUNT(*) FROM workbook_chunks").fetchone()[0] == 0
+
+    assert cache.put("first", iter([small]))
+    time.sleep(0.01)
+    cache.max_bytes = cache._conn.execute("SELECT size FROM workbook_lists").fetchone()[0] + 1
+    assert cache.put("second", iter([small]))
+    assert cache.get("first") is None
+    assert cache._conn.execute("SELECT DISTINCT digest FROM workbook_chunks").fetchall() == [("second",)]
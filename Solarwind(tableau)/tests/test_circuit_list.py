@@ -0,0 +1,235 @@
+"""read_circuit_list ต้องได้ผลเหมือน pd.read_excel กับไฟล์ .xlsx ที่เขียนเซลล์หลายรูปแบบ (สร้าง XML เองเพื่อคุมชนิดของเซลล์)"""
+import datetime
+import io
+import tracemalloc
+import zipfile
+from xml.sax.saxutils import escape
+
+import pandas as pd
+import pytest
+
+import final
+
+CONTENT_TYPES = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
+<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
+<Default Extension="xml" ContentType="application/xml"/>
+<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>
+<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>
+<Override PartName="/xl/sharedStrings.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sharedStrings+xml"/>
+<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>
+</Types>"""
+ROOT_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>
+</Relationships>"""
+WORKBOOK = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">
+<sheets><sheet name="Sheet1" sheetId="1" r:id="rId1"/></sheets>
+</workbook>"""
+WORKBOOK_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>
+<Relationship Id="rId2" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/sharedStrings" Target="sharedStrings.xml"/>
+<Relationship Id="rId3" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>
+</Relationships>"""
+# style 1 เป็นรูปแบบวันที่ (numFmtId 14) เซลล์ตัวเลขที่ใช้ style นี้ openpyxl อ่านเป็น datetime
+STYLES = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">
+<fonts count="1"><font><sz val="11"/><name val="Calibri"/></font></fonts>
+<fills count="1"><fill><patternFill patternType="none"/></fill></fills>
+<borders count="1"><border/></borders>
+<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>
+<cellXfs count="2"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/><xf numFmtId="14" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/></cellXfs>
+<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>
+</styleSheet>"""
+
+
+def column_letter(index):
+    return chr(ord("A") + index)
+
+
+def build_xlsx(rows):
+    """
+    rows เป็น list ของแถว แต่ละเซลล์เป็น None (ไม่มีเซลล์), ('s', text) shared string, ('inline', text), ('str', text) ผลของสูตร,
+    ('n', number), ('b', bool), ('e', error), ('date', serial), ('empty',) เซลล์ที่ไม่มีค่า หรือข้อความธรรมดา (เป็น shared string)
+    """
+    shared = []
+    sheet_rows = []
+    for r, row in enumerate(rows, 1):
+        cells = []
+        for c, cell in enumerate(row):
+            if cell is None:
+                continue
+            if isinstance(cell, str):
+                cell = ("s", cell)
+            ref = f'{column_letter(c)}{r}'
+            kind = cell[0]
+            if kind == "s":
+                shared.append(cell[1])
+                cells.append(f'<c r="{ref}" t="s"><v>{len(shared) - 1}</v></c>')
+            elif kind == "inline":
+                cells.append(f'<c r="{ref}" t="inlineStr"><is><t>{escape(cell[1])}</t></is></c>')
+            elif kind == "str":
+                cells.append(f'<c r="{ref}" t="str"><f>"x"</f><v>{escape(cell[1])}</v></c>')
+            elif kind == "n":
+                cells.append(f'<c r="{ref}"><v>{cell[1]}</v></c>')
+            elif kind == "b":
+                cells.append(f'<c r="{ref}" t="b"><v>{int(cell[1])}</v></c>')
+            elif kind == "e":
+                cells.append(f'<c r="{ref}" t="e"><v>{escape(cell[1])}</v></c>')
+            elif kind == "date":
+                cells.append(f'<c r="{ref}" s="1"><v>{cell[1]}</v></c>')
+            elif kind == "empty":
+                cells.append(f'<c r="{ref}"/>')
+        sheet_rows.append(f'<row r="{r}">{"".join(cells)}</row>')
+    sheet = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+             '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+             f'<sheetData>{"".join(sheet_rows)}</sheetData></worksheet>')
+    strings = "".join(f"<si><t>{escape(text)}</t></si>" for text in shared)
+    shared_xml = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                  f'<sst xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" count="{len(shared)}" uniqueCount="{len(shared)}">{strings}</sst>')
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        for name, content in (("[Content_Types].xml", CONTENT_TYPES), ("_rels/.rels", ROOT_RELS), ("xl/workbook.xml", WORKBOOK),
+                              ("xl/_rels/workbook.xml.rels", WORKBOOK_RELS), ("xl/styles.xml", STYLES),
+                              ("xl/worksheets/sheet1.xml", sheet), ("xl/sharedStrings.xml", shared_xml)):
+            archive.writestr(name, content)
+    return buffer.getvalue()
+
+
+HEADER = ["หมายเหตุ"] + [("inline", column) if column == "Node Name" else column for column in final.REQUIRED_COLUMNS]
+
+
+def circuit_row(nod_id, itf_id, node_name="node", note=None, agency=("inline", "หน่วยงาน")):
+    return [note, nod_id, itf_id, "กระทรวง", ("str", "กรม"), "จังหวัด", agency, node_name]
+
+
+SHEETS = {
+    "numeric_ids": [HEADER, circuit_row(("n", 404), ("n", 1)), circuit_row(("n", "404.0"), ("n", 2)), circuit_row(("n", 7), ("n", "1.5"))],
+    "string_ids": [HEADER, circuit_row("00404", ("inline", "1")), circuit_row(("str", "405"), "2"), circuit_row(("n", 406), "3")],
+    "empty_cells": [HEADER, circuit_row(("n", 1), ("n", 1), node_name=None), circuit_row(None, ("empty",), agency=("inline", "")),
+                    circuit_row(("n", 3), ("n", 3), node_name=("empty",)), [None] * 8,
+                    circuit_row(("n", 4), ("n", 4)), [("empty",)] * 8, [("inline", "")] * 8],
+    "bool_and_errors": [HEADER, circuit_row(("b", True), ("e", "#N/A")), circuit_row(("n", 2), ("e", "#DIV/0!")),
+                        circuit_row(("n", 3), "#DIV/0!", node_name=("b", False))],
+    "dates_outside_required_columns": [HEADER, circuit_row(("n", 1), ("n", 1), note=("date", 45000)), [("date", 45001)]],
+    "short_rows": [HEADER, circuit_row(("n", 1), ("n", 1))[:3], circuit_row(("n", 2), ("n", 2))],
+}
+
+
+def frame(circuits):
+    """ต่อทุกชุดของ CircuitList เป็น DataFrame เดียว แล้วปิด"""
+    try:
+        return pd.concat(list(circuits.iter_chunks()))
+    finally:
+        circuits.close()
+
+
+def assert_reads_like_pandas(workbook):
+    circuits, missing = final.read_circuit_list(workbook)
+    assert missing == []
+    df = frame(circuits)
+    pd.testing.assert_frame_equal(df, pd.read_excel(io.BytesIO(workbook))[final.REQUIRED_COLUMNS])
+    return df
+
+
+@pytest.fixture(params=[1, 2, 500], ids=lambda chunk_rows: f"chunk_rows={chunk_rows}")
+def chunk_rows(request, monkeypatch):
+    monkeypatch.setattr(final, "CHUNK_ROWS", request.param)
+    return request.param
+
+
+@pytest.mark.parametrize("sheet", sorted(SHEETS))
+def test_xlsx_reader_matches_pandas(sheet, chunk_rows):
+    workbook = build_xlsx(SHEETS[sheet])
+    circuits, missing = final._read_xlsx_columns(workbook)
+    assert missing == []
+    pd.testing.assert_frame_equal(frame(circuits), pd.read_excel(io.BytesIO(workbook))[final.REQUIRED_COLUMNS])
+    assert_reads_like_pandas(workbook)
+
+
+def test_unhandled_cell_types_fall_back_to_pandas(caplog, chunk_rows):
+    # NodeID ที่เป็นวันที่ (เซลล์ตัวเลขที่จัดรูปแบบเป็นวันที่) อ่านด้วย pd.read_excel แทน
+    workbook = build_xlsx([HEADER, circuit_row(("n", 1), ("n", 1)), circuit_row(("date", 45000 + chunk_rows), ("n", 2))])
+    df = assert_reads_like_pandas(workbook)
+    assert df["NodeID"].iloc[1] == datetime.datetime(2023, 3, 15) + datetime.timedelta(days=chunk_rows)
+    assert "pd.read_excel" in caplog.text
+
+
+def test_missing_columns_are_reported_before_reading_rows():
+    workbook = build_xlsx([[column for column in final.REQUIRED_COLUMNS if column != "จังหวัด"], ["1"] * 6])
+    assert final.read_circuit_list(workbook) == (None, ["จังหวัด"])
+
+
+CSV_HEADER = ",".join(final.REQUIRED_COLUMNS)
+CSV_FILES = {
+    "numeric_ids": [f"{nod_id},1,ก,ข,ค,ง,node {nod_id}" for nod_id in range(1, 8)],
+    "ids_with_blanks": ["1,1,ก,ข,ค,ง,a", ",,,,,,", "3,1.5,ก,ข,ค,ง,c", "", "5,2,ก,ข,ค,ง,e"],
+    "text_after_numbers": ["1,1,ก,ข,ค,ง,a", "2,1,ก,ข,ค,ง,b", "3,1,ก,ข,ค,ง,c", "00404,abc,ก,ข,ค,ง,d"],
+    "mixed_bool_and_numbers": ["True,1,ก,ข,ค,ง,a", "False,1,ก,ข,ค,ง,b", "1,1,ก,ข,ค,ง,c"],
+}
+
+
+@pytest.mark.parametrize("name", sorted(CSV_FILES))
+def test_csv_reader_matches_read_csv(name, chunk_rows):
+    workbook = "\n".join([CSV_HEADER] + CSV_FILES[name]).encode("utf-8")
+    circuits, missing = final._read_csv_columns(workbook)
+    assert missing == []
+    expected = pd.read_csv(io.BytesIO(workbook), skip_blank_lines=False)[final.REQUIRED_COLUMNS]
+    pd.testing.assert_frame_equal(frame(circuits), expected)
+
+
+def test_mixed_types_across_chunks_are_read_like_the_whole_file(chunk_rows):
+    # bool ในชุดหนึ่งและข้อความในอีกชุด ตัดสินจากสรุปของแต่ละชุดไม่ได้ จึงแปลงค่าทั้งไฟล์พร้อมกัน
+    workbook = build_xlsx([HEADER, circuit_row(("b", True), ("n", 1)), circuit_row("TRUE", ("n", 2)), circuit_row(("n", 3), ("n", 3))])
+    assert_reads_like_pandas(workbook)
+
+
+def test_iter_rows_from_the_middle_of_a_chunk(chunk_rows):
+    circuits = final.CircuitList.from_frame(pd.DataFrame({"NodeID": range(5), "Node Name": list("abcde")}))
+    try:
+        assert len(circuits) == 5
+        assert [(index, row["Node Name"]) for index, row in circuits.iter_rows(3)] == [(3, "d"), (4, "e")]
+        assert [row["NodeID"] for _, row in circuits.iter_rows()] == list(range(5))
+    finally:
+        circuits.close()
+
+
+def large_xlsx(rows):
+    # เขียนข้อความเป็น inline string ตาราง shared strings (ซึ่ง openpyxl โหลดทั้งตาราง) จึงไม่โตตามจำนวนแถว
+    # ชื่อวงจรยาวเพื่อให้ข้อมูลของแต่ละแถวใหญ่กว่าเศษที่ openpyxl เหลือไว้ต่อแถว (element ว่างของแถวที่อ่านแล้ว)
+    inline = [("inline", text) for text in ("กระทรวงตัวอย่าง", "กรมตัวอย่าง", "กรุงเทพมหานคร", "หน่วยงานตัวอย่าง")]
+    return build_xlsx([HEADER] + [[None, ("n", 100000 + nod_id), ("n", nod_id % 4), *inline, ("inline", f"วงจร {nod_id} " + "ก" * 200)]
+                                  for nod_id in range(rows)])
+
+
+def large_csv(rows):
+    lines = [",".join(final.REQUIRED_COLUMNS)] + [
+        f"{100000 + nod_id},{nod_id % 4},กระทรวงตัวอย่าง,กรมตัวอย่าง,กรุงเทพมหานคร,หน่วยงานตัวอย่าง,วงจร {nod_id % 50}" for nod_id in range(rows)]
+    return "\n".join(lines).encode("utf-8")
+
+
+def peak_memory_while_reading(workbook):
+    tracemalloc.start()
+    try:
+        circuits, _ = final.read_circuit_list(workbook)
+        try:
+            count = sum(1 for _ in circuits.iter_rows())
+        finally:
+            circuits.close()
+        return count, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+# parser ของ pandas (CSV) ใช้ buffer ขนาดคงที่ไม่กี่ MB ซึ่งเต็มเมื่อไฟล์ใหญ่กว่าราว 2 MB จึงวัดไฟล์ CSV ที่ใหญ่กว่านั้น
+@pytest.mark.parametrize("make_workbook, rows", [(large_xlsx, 2000), (large_csv, 20000)], ids=["xlsx", "csv"])
+def test_peak_memory_is_bounded_by_the_chunk_size(make_workbook, rows, monkeypatch):
+    monkeypatch.setattr(final, "CHUNK_ROWS", 200)
+    peaks = {}
+    for count in (rows, rows * 4):
+        read, peaks[count] = peak_memory_while_reading(make_workbook(count))
+        assert read == count
+    # สี่เท่าของจำนวนแถวต้องไม่ทำให้หน่วยความจำสูงสุดโตตาม (ไม่นับเนื้อหาไฟล์ที่อัปโหลด)
+    assert peaks[rows * 4] < peaks[rows] * 1.5, peaks
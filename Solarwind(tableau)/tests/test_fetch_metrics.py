@@ -0,0 +1,59 @@
+import threading
+import time
+import uuid
+
+import final
+
+
+def test_coalesced_callers_count_cache_access_in_their_own_job(monkeypatch):
+    started, release = threading.Event(), threading.Event()
+
+    def slow_api(nod_id, itf_id, job_id):
+        started.set()
+        release.wait(5)
+        return [{"Customer_Curcuit_ID": "GIN0000001"}]
+
+    monkeypatch.setattr(final, "get_data_from_api", slow_api)
+    monkeypatch.setattr(final.response_cache, "put", lambda nod_id, itf_id, data: None)
+    leader_job, follower_job = str(uuid.uuid4()), str(uuid.uuid4())
+    for job_id in (leader_job, follower_job):
+        final.job_store.create(job_id, report_month="2025-07")
+
+    results = {}
+    leader = threading.Thread(target=lambda: results.setdefault("leader", final.fetch_circuit_shared("900001", "1", leader_job, "2025-07")))
+    leader.start()
+    assert started.wait(5)
+    follower = threading.Thread(target=lambda: results.setdefault("follower", final.fetch_circuit_shared("900001", "1", follower_job, "2025-07")))
+    follower.start()
+    time.sleep(0.2) # ให้ผู้เรียกคนที่สองเข้าไปรอผลของคำขอเดียวกัน
+    release.set()
+    leader.join(5)
+    follower.join(5)
+
+    assert results["leader"] is results["follower"]
+    leader_status, follower_status = final.job_store.get(leader_job), final.job_store.get(follower_job)
+    assert leader_status["cache"] == {"hits": 0, "misses": 1}
+    assert follower_status["cache"] == {"hits": 0, "misses": 1}
+    assert follower_status["coalesced"] == 1
+
+
+def test_fair_fetch_pool_limits_running_requests_per_job():
+    pool = final.FairFetchPool(4)
+    lock = threading.Lock()
+    running, peak = {"limited": 0, "free": 0}, {"limited": 0, "free": 0}
+
+    def request(job_id):
+        with lock:
+            running[job_id] += 1
+            peak[job_id] = max(peak[job_id], running[job_id])
+        time.sleep(0.02)
+        with lock:
+            running[job_id] -= 1
+
+    futures = [pool.submit("limited", request, "limited", max_running=1) for _ in range(6)]
+    futures += [pool.submit("free", request, "free") for _ in range(6)]
+    for future in futures:
+        future.result(5)
+    assert peak["limited"] == 1
+    assert peak["free"] > 1
+    assert not pool._running and not pool._limits
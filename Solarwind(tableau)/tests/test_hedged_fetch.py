@@ -0,0 +1,49 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import final
+
+
+@pytest.fixture
+def hedging(monkeypatch):
+    """เปิด hedged request ด้วย delay สั้นๆ และคำขอปลอมที่คำขอแรกช้า คืนค่ารายการ (NodeID, hedge) ของคำขอที่ส่ง"""
+    calls = []
+
+    def fake_fetch(nod_id, itf_id, hedge=False):
+        calls.append((nod_id, hedge))
+        if not hedge:
+            time.sleep(0.3)
+        return f"{nod_id}:{'hedge' if hedge else 'first'}"
+
+    executor = ThreadPoolExecutor(max_workers=4)
+    monkeypatch.setattr(final, "hedge_executor", executor)
+    monkeypatch.setattr(final, "fetch_soap_return", fake_fetch)
+    monkeypatch.setattr(final.api_latency, "percentile", lambda q: 0.05)
+    monkeypatch.setattr(final, "api_concurrency", final.AdaptiveConcurrencyLimit(2))
+    monkeypatch.setattr(final, "hedge_budget", threading.BoundedSemaphore(1))
+    yield calls
+    executor.shutdown(wait=True)
+
+
+def test_slow_request_is_hedged_outside_the_concurrency_limit(hedging):
+    assert final._fetch_soap_return_hedged("1", "1") == "1:hedge"
+    assert hedging == [("1", False), ("1", True)]
+    assert final.api_concurrency.snapshot()["in_flight"] == 0
+
+
+def test_no_hedge_while_the_concurrency_limit_is_saturated(hedging):
+    held = [final.api_concurrency.acquire(), final.api_concurrency.acquire()]
+    assert final._fetch_soap_return_hedged("1", "1") == "1:first"
+    assert hedging == [("1", False)]
+    for started in held:
+        final.api_concurrency.release(started)
+
+
+def test_no_hedge_once_the_hedge_budget_is_used(hedging):
+    assert final.hedge_budget.acquire(blocking=False)
+    assert final._fetch_soap_return_hedged("1", "1") == "1:first"
+    assert hedging == [("1", False)]
+    final.hedge_budget.release()
@@ -0,0 +1,149 @@
+import io
+import os
+import sqlite3
+import zipfile
+
+import openpyxl
+from reportlab import rl_config
+
+import final
+import soap_fixtures
+
+
+def make_store(tmp_path):
+    return final.JobStore(str(tmp_path / "jobs.sqlite3"), files_dir=str(tmp_path / "files"))
+
+
+def test_source_is_kept_as_a_file_in_the_job_directory(tmp_path):
+    store = make_store(tmp_path)
+    store.create("job-1")
+    store.save_source("job-1", "circuits.xlsx", b"PK\x03\x04workbook")
+
+    filename, path = store._conn().execute("SELECT filename, path FROM job_sources WHERE job_id = 'job-1'").fetchone()
+    assert filename == "circuits.xlsx"
+    assert os.path.dirname(path) == store.job_dir("job-1")
+    assert store.load_source("job-1") == b"PK\x03\x04workbook"
+    assert store.has_checkpoint("job-1")
+
+    store.clear_checkpoint("job-1")
+    assert store.load_source("job-1") is None
+    assert not os.path.exists(store.job_dir("job-1"))
+
+
+def test_delete_removes_the_job_directory(tmp_path):
+    store = make_store(tmp_path)
+    store.create("job-1")
+    store.save_source("job-1", "circuits.csv", b"NodeID\n1\n")
+    store.delete("job-1")
+    assert not os.path.exists(store.job_dir("job-1"))
+
+
+def test_missing_source_file_cannot_be_resumed(tmp_path):
+    store = make_store(tmp_path)
+    for job_id in ("job-1", "job-2"):
+        store.create(job_id)
+        store.save_source(job_id, "circuits.csv", b"NodeID\n1\n")
+        store.request_cancel(job_id)
+        with store._conn() as conn:
+            conn.execute("UPDATE jobs SET completed = 1 WHERE job_id = ?", (job_id,))
+    os.remove(os.path.join(store.job_dir("job-1"), "source"))
+    assert store.load_source("job-1") is None
+    assert store.resume("job-1") is None
+    assert store.resume("job-2") == 0
+
+
+def test_workbook_blobs_of_the_previous_schema_are_moved_to_files(tmp_path):
+    path = str(tmp_path / "jobs.sqlite3")
+    with sqlite3.connect(path) as conn:
+        conn.execute("CREATE TABLE job_sources (job_id TEXT PRIMARY KEY, filename TEXT, workbook BLOB NOT NULL)")
+        conn.execute("INSERT INTO job_sources VALUES ('old-job', 'old.xlsx', ?)", (b"old workbook",))
+    store = final.JobStore(path, files_dir=str(tmp_path / "files"))
+    assert store.load_source("old-job") == b"old workbook"
+    columns = [column[1] for column in store._conn().execute("PRAGMA table_info(job_sources)")]
+    assert "workbook" not in columns
+
+
+def finish(store, job_id, **fields):
+    store.update(job_id, completed=True, **fields)
+
+
+def test_only_canceled_or_stale_jobs_can_be_resumed(tmp_path):
+    store = make_store(tmp_path)
+    errors = {
+        "canceled": final.JobStore.CANCEL_ERROR,
+        "stale": final.JobStore.STALE_ERROR,
+        "missing-columns": "ไฟล์ Excel ขาดคอลัมน์ที่จำเป็น: NodeID",
+        "failed": "เกิดข้อผิดพลาดในระหว่างการประมวลผลเบื้องหลัง: boom",
+    }
+    for job_id, error in errors.items():
+        store.create(job_id)
+        store.save_source(job_id, "circuits.csv", b"NodeID\n1\n")
+        if job_id == "canceled":
+            store.request_cancel(job_id)
+        finish(store, job_id, error=error)
+    store.create("running")
+    store.save_source("running", "circuits.csv", b"NodeID\n1\n")
+
+    assert store.resume("canceled") == 0
+    assert store.resume("stale") == 0
+    assert store.resume("missing-columns") is None
+    assert store.resume("failed") is None
+    assert store.resume("running") is None
+    assert store.get("failed")["error"] == errors["failed"]
+
+
+def circuit_workbook(rows):
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    sheet.append(final.REQUIRED_COLUMNS)
+    for nod_id, node_name in rows:
+        sheet.append([nod_id, 1, "กระทรวงตัวอย่าง", "กรมตัวอย่าง", "กรุงเทพมหานคร", "หน่วยงานตัวอย่าง", node_name])
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+    return buffer.getvalue()
+
+
+def zip_entries(job_id):
+    with zipfile.ZipFile(final.job_store.get(job_id)["zip_file_path"]) as archive:
+        names = archive.namelist()
+        return names, {name: archive.read(name) for name in names}
+
+
+def test_cancel_then_resume_writes_every_entry_once(monkeypatch):
+    # แถวที่ 4 ใช้ชื่อไฟล์เดียวกับแถวที่ 2 (ไฟล์ของแถวหลังต้องแทนแถวแรก)
+    workbook = circuit_workbook([(nod_id, "วงจร 2" if nod_id == 4 else f"วงจร {nod_id}") for nod_id in range(1, 13)])
+    monkeypatch.setattr(final, "fetch_circuit_shared", lambda nod_id, itf_id, job_id, report_month: soap_fixtures.month(range(48), seed=int(nod_id)))
+    monkeypatch.setattr(final, "render_cache", None)
+    monkeypatch.setattr(rl_config, "invariant", 1) # PDF ที่สร้างซ้ำต้องได้ไฟล์เดียวกันทุกไบต์
+
+    final.job_store.create("full")
+    final.process_file_in_background(io.BytesIO(workbook), "full", fetch_workers=1)
+    expected_names, expected = zip_entries("full")
+
+    renders = []
+    render = final.render_circuit_reports
+
+    def render_then_cancel(*args):
+        renders.append(args[-1])
+        if len(renders) == 5:
+            final.job_store.request_cancel("partial")
+        return render(*args)
+
+    final.job_store.create("partial")
+    final.job_store.save_source("partial", "circuits.xlsx", workbook)
+    monkeypatch.setattr(final, "render_circuit_reports", render_then_cancel)
+    final.process_file_in_background(io.BytesIO(workbook), "partial", fetch_workers=1)
+    status = final.job_store.get("partial")
+    assert status["canceled"] and status["error"] == final.JobStore.CANCEL_ERROR
+    assert 0 < status["processed"] < 12
+
+    resume_from = final.job_store.resume("partial")
+    assert resume_from == status["processed"]
+    final.process_file_in_background(io.BytesIO(final.job_store.load_source("partial")), "partial", fetch_workers=1, resume_from=resume_from)
+    names, entries = zip_entries("partial")
+
+    assert len(names) == len(set(names))
+    assert sorted(names) == sorted(expected_names)
+    assert entries == expected
+    assert final.job_store.get("partial")["processed"] == 12
+    assert final.job_store.load_source("partial") is None
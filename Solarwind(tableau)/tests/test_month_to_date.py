@@ -0,0 +1,55 @@
+"""รายงานสะสม (process_json_month_to_date) ที่ต่อยอดหลายครั้งต้องได้ผลเหมือน process_json_data ครั้งเดียวของข้อมูลทั้งหมด"""
+import random
+
+import pytest
+
+import final
+import soap_fixtures
+
+
+def _month_with_gaps_and_duplicates():
+    rnd = random.Random(4)
+    items = soap_fixtures.month([hour for hour in range(5, soap_fixtures.MONTH_HOURS - 3) if rnd.random() < 0.85], seed=4)
+    items[40:40] = [dict(item, In_Averagebps="7.5") for item in items[35:38]]
+    items[100]["Out_Averagebps"] = "n/a"
+    return items
+
+
+MONTHS = {"full": soap_fixtures.month(), "gaps_and_duplicates": _month_with_gaps_and_duplicates()}
+
+
+def _until(items, hour):
+    """ข้อมูลที่ API คืนค่า ณ ชั่วโมงที่ hour ของเดือน (ข้อมูลตั้งแต่ต้นเดือนจนถึงก่อนชั่วโมงนั้น)"""
+    end = soap_fixtures.MONTH_START.timestamp() + hour * 3600
+    return [item for item in items
+            if final.datetime.datetime.strptime(item["Timestamp"]["date"], "%Y-%m-%d %H:%M:%S.%f").timestamp() < end]
+
+
+@pytest.mark.parametrize("month", sorted(MONTHS))
+def test_two_partial_updates_equal_one_full_run(tmp_path, monkeypatch, month):
+    formatted = [] # จำนวนชั่วโมงที่จัดรูปแบบในแต่ละครั้ง ใช้ตรวจว่าครั้งหลังประมวลผลเฉพาะส่วนที่ต่อจากสถานะเดิม
+    format_timestamps = final._format_report_timestamps
+    monkeypatch.setattr(final, "_format_report_timestamps", lambda ts: formatted.append(len(ts)) or format_timestamps(ts))
+    store = final.MonthToDateStore(str(tmp_path / "month_to_date.sqlite3"))
+    items = MONTHS[month]
+    state = None
+    for hour in (10 * 24 + 7, 20 * 24 + 15, soap_fixtures.MONTH_HOURS):
+        carried = len(state["rows"]) if state else 0
+        formatted.clear()
+        result, new_state = final.process_json_month_to_date(_until(items, hour), "test", state)
+        assert formatted == [len(result[1]) - carried]
+        assert result == final.process_json_data(_until(items, hour), "test")
+        store.save("1", "1", "2025-07", new_state)
+        state = store.load("1", "1", "2025-07")
+        assert state == new_state
+
+    assert state["frozen_end"] == final.np.datetime64("2025-07-31T00", "h")
+
+
+def test_changed_history_is_processed_again():
+    items = soap_fixtures.month()
+    _, state = final.process_json_month_to_date(_until(items, 15 * 24), "test")
+    changed = [dict(item) for item in items]
+    changed[30]["In_Averagebps"] = "1"
+    result, _ = final.process_json_month_to_date(changed, "test", state)
+    assert result == final.process_json_data(changed, "test")
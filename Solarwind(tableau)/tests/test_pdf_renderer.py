@@ -0,0 +1,42 @@
+"""ผลของ PDF แบบ canvas ต้องเหมือนแบบ platypus (จำนวนหน้า ข้อความในแต่ละหน้า และแถวของตารางที่อยู่ในแต่ละหน้า)"""
+import re
+
+import pytest
+
+import final
+import report_render
+import soap_fixtures
+
+pymupdf = pytest.importorskip("pymupdf")
+
+ROW_RE = re.compile(r"^\d{4}-\d{2}-\d{2} \d{2}\.\d{2}\.\d{2}")
+
+FIXTURES = {
+    "full": soap_fixtures.month(),
+    "sparse": soap_fixtures.sparse_month(),
+    "fttx": soap_fixtures.month(bandwidth="FTTx 1000/500"),
+    "long_address": soap_fixtures.month(range(0, soap_fixtures.MONTH_HOURS, 5), address="ที่อยู่ยาวมาก " * 20),
+}
+
+
+def render_pages(tmp_path, raw, renderer):
+    headers, data, monthly_averages = final.process_json_data(raw, "test")
+    filename = str(tmp_path / f"{renderer}.pdf")
+    if renderer == "canvas": # ไม่ผ่าน export_to_pdf ซึ่งจะใช้ platypus แทนเมื่อวาดด้วย canvas ไม่ได้
+        assert report_render._export_to_pdf_canvas(headers, data, monthly_averages, filename)
+    else:
+        report_render._export_to_pdf_platypus(headers, data, monthly_averages, filename)
+    with pymupdf.open(filename) as doc:
+        return [page.get_text() for page in doc]
+
+
+@pytest.mark.parametrize("fixture", sorted(FIXTURES))
+def test_canvas_matches_platypus(tmp_path, fixture):
+    platypus = render_pages(tmp_path, FIXTURES[fixture], "platypus")
+    canvas = render_pages(tmp_path, FIXTURES[fixture], "canvas")
+
+    assert len(canvas) == len(platypus)
+    row_breaks = [[line[:19] for line in page.splitlines() if ROW_RE.match(line)] for page in platypus]
+    assert [[line[:19] for line in page.splitlines() if ROW_RE.match(line)] for page in canvas] == row_breaks
+    assert sum(map(len, row_breaks)) > 0
+    assert canvas == platypus
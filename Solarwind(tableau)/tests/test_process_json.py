@@ -0,0 +1,67 @@
+"""process_json_batch ต้องให้ผลเหมือน process_json_data แบบเดิมที่วนทีละแถว (tests/legacy_process_json.py)"""
+import random
+
+import pandas as pd
+import pytest
+
+import final
+import legacy_process_json
+import soap_fixtures
+
+
+def _gaps_at_both_ends():
+    rnd = random.Random(1)
+    hours = [hour for hour in range(30, soap_fixtures.MONTH_HOURS - 40) if rnd.random() < 0.8]
+    return soap_fixtures.month(hours, seed=1)
+
+
+def _duplicate_timestamps():
+    items = soap_fixtures.month(range(0, 96), seed=2)
+    duplicates = [dict(item, In_Averagebps="123.9", Out_Averagebps="bad") for item in items[10:20]]
+    return items[:15] + duplicates + items[15:] + [dict(items[5])]
+
+
+def _bad_timestamps():
+    items = soap_fixtures.month(range(0, 72), seed=3)
+    items[3]["Timestamp"] = {"date": "0000-00-00 00:00:00.000000"}
+    items[7]["Timestamp"] = {"date": "2025-07-32 25:61:00"}
+    del items[9]["Timestamp"]
+    items[11]["In_Averagebps"] = None
+    items[12]["Out_Averagebps"] = ""
+    del items[13]["In_Averagebps"]
+    return items
+
+
+CASES = {
+    "full_month": soap_fixtures.month(),
+    "sparse": soap_fixtures.sparse_month(),
+    "gaps_at_start_and_end": _gaps_at_both_ends(),
+    "duplicate_timestamps": _duplicate_timestamps(),
+    "bad_timestamps": _bad_timestamps(),
+    "fttx": soap_fixtures.month(range(0, 48), bandwidth="FTTx 1000/500"),
+    "empty_list": [],
+    "empty_dict": {},
+    "no_valid_dates": [{"Customer_Curcuit_ID": "GIN1", "Timestamp": {"date": "bad"}, "In_Averagebps": "12.5", "Bandwidth": "1 Gbps"}],
+}
+
+
+def assert_same_result(result, expected):
+    headers, rows, averages = result
+    expected_headers, expected_rows, expected_averages = expected
+    assert headers == expected_headers
+    pd.testing.assert_frame_equal(pd.DataFrame(rows, columns=headers), pd.DataFrame(expected_rows, columns=expected_headers))
+    assert averages == expected_averages
+
+
+@pytest.mark.parametrize("case", list(CASES))
+def test_process_json_data_matches_legacy(case):
+    raw = CASES[case]
+    assert_same_result(final.process_json_data(raw, "test"), legacy_process_json.process_json_data(raw, "test"))
+
+
+def test_batch_matches_legacy_per_circuit():
+    batch = list(CASES.values())
+    results = final.process_json_batch(batch, "test")
+    assert len(results) == len(batch)
+    for raw, result in zip(batch, results):
+        assert_same_result(result, legacy_process_json.process_json_data(raw, "test"))